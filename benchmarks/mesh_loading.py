@@ -0,0 +1,100 @@
+import sys
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from plyfile import PlyData, PlyElement
+from PySide2.Qt3DCore import Qt3DCore
+
+sys.path.insert( 0, str( Path(__file__).resolve().parents[1] / 'src' ) )
+from athena import plymesh, diskcache
+
+# Times how long Athena takes to turn ply files into PlyMesh vertex and index
+# buffers, for every sample input and for two large synthetic meshes: a grid of
+# 99,458 triangles and a tiling of 12,000 hexagons.  Each mesh is timed from the
+# ply file to finished buffers without the mesh cache ("build"), then again
+# through a warm mesh cache ("cached"), and finally as a PlyMesh entity, which
+# adds the upload into Qt3D buffers.  From the repository root:
+#
+#   python benchmarks/mesh_loading.py
+#
+# The exit status is 1 if any mesh takes longer than --limit seconds to build.
+
+SAMPLE_DIR = Path(__file__).resolve().parents[1] / 'sample_inputs'
+
+def writePly( path, xyz, faces ):
+    vertices = np.array( [ tuple(v) for v in xyz ], dtype=[('x','f4'), ('y','f4'), ('z','f4')] )
+    face_rows = np.empty( len(faces), dtype=[('vertex_indices', 'i4', (faces.shape[1],))] )
+    face_rows['vertex_indices'] = faces
+    PlyData( [ PlyElement.describe( vertices, 'vertex' ),
+               PlyElement.describe( face_rows, 'face' ) ], text=False ).write( str(path) )
+    return path
+
+def triangleGrid( path, n=224 ):
+    '''An n by n grid of vertices, split into 2*(n-1)**2 triangles'''
+    ii, jj = np.meshgrid( np.arange(n-1), np.arange(n-1), indexing='ij' )
+    corner = (ii * n + jj).reshape(-1)
+    faces = np.concatenate( [ np.stack( [corner, corner + n, corner + 1], axis=1 ),
+                              np.stack( [corner + 1, corner + n, corner + n + 1], axis=1 ) ] )
+    x, y = np.meshgrid( np.arange(n), np.arange(n), indexing='ij' )
+    xyz = np.stack( [x.reshape(-1), y.reshape(-1), np.zeros(n*n)], axis=1 )
+    return writePly( path, xyz, faces )
+
+def hexagonTiling( path, rows=100, cols=120 ):
+    '''A rows by cols tiling of regular hexagons, which share their vertices'''
+    angles = np.pi / 3 * np.arange(6)
+    centers = [ ( 1.5 * c, np.sqrt(3) * (r + 0.5 * (c % 2)) ) for r in range(rows) for c in range(cols) ]
+    corners = np.array( centers )[:,np.newaxis,:] + np.stack( [np.cos(angles), np.sin(angles)], axis=1 )
+    keys, faces = np.unique( np.round( corners.reshape(-1, 2), 6 ), axis=0, return_inverse=True )
+    xyz = np.hstack( [ keys, np.zeros( (len(keys), 1) ) ] )
+    return writePly( path, xyz, faces.reshape(-1, 6) )
+
+def timeMesh( path, cache, root ):
+    start = time.perf_counter()
+    buffers = plymesh.buildMeshBuffers( plymesh.readPly( path ) )
+    build = time.perf_counter() - start
+
+    plymesh.loadMeshBuffers( path, cache )
+    start = time.perf_counter()
+    plymesh.loadMeshBuffers( path, cache )
+    cached = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mesh = plymesh.PlyMesh( root, buffers=buffers )
+    entity = time.perf_counter() - start
+    mesh.setParent( None )
+    return len(buffers.indices), build, cached, entity
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description='Time PlyMesh loading for sample and synthetic meshes' )
+    parser.add_argument( 'paths', nargs='*', help='ply files or directories of them; defaults to all sample inputs' )
+    parser.add_argument( '--limit', type=float, default=1.0, help='slowest acceptable build time, in seconds' )
+    args = parser.parse_args( argv )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        paths = [ Path(p) for p in args.paths ] or [ SAMPLE_DIR / '2D', SAMPLE_DIR / '3D' ]
+        plyfiles = [ f for p in paths for f in ( sorted( p.glob('*.ply') ) if p.is_dir() else [p] ) ]
+        if not args.paths:
+            plyfiles += [ triangleGrid( tmp / 'synthetic_triangle_grid.ply' ),
+                          hexagonTiling( tmp / 'synthetic_hexagon_tiling.ply' ) ]
+        cache = diskcache.DiskCache( tmp / 'cache', 1 << 30 )
+        root = Qt3DCore.QEntity()
+
+        print( '{:<45} {:>9} {:>9} {:>9} {:>9}'.format( 'mesh', 'triangles', 'build s', 'cached s', 'entity s' ) )
+        slow = list()
+        for plyfile in plyfiles:
+            triangles, build, cached, entity = timeMesh( plyfile, cache, root )
+            print( '{:<45} {:>9} {:>9.3f} {:>9.3f} {:>9.3f}'.format( plyfile.name, triangles, build, cached, entity ) )
+            if build > args.limit:
+                slow.append( plyfile.name )
+
+    print( '{} of {} meshes built in under {} s'.format( len(plyfiles) - len(slow), len(plyfiles), args.limit ) )
+    if slow:
+        print( 'Too slow:', ', '.join( slow ) )
+    return 1 if slow else 0
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -35,11 +35,35 @@ else:
     ATHENA_SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     ATHENA_DIR = os.path.dirname(ATHENA_SRC_DIR)
 
-ATHENA_OUTPUT_HOME = tempfile.TemporaryDirectory(prefix='Athena')
-ATHENA_OUTPUT_DIR = Path(ATHENA_OUTPUT_HOME.name)
+# Tool outputs go to a temporary directory that is deleted on quit, unless the
+# ATHENA_WORKSPACE environment variable names a persistent workspace directory
+# to keep them in (and index them in; see workspace.py) across sessions
+ATHENA_WORKSPACE = os.environ.get('ATHENA_WORKSPACE')
+if ATHENA_WORKSPACE:
+    ATHENA_OUTPUT_HOME = None
+    ATHENA_OUTPUT_DIR = Path(ATHENA_WORKSPACE).expanduser().resolve()
+    ATHENA_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+else:
+    ATHENA_OUTPUT_HOME = tempfile.TemporaryDirectory(prefix='Athena')
+    ATHENA_OUTPUT_DIR = Path(ATHENA_OUTPUT_HOME.name)
+
+# ATHENA_CACHE_DIR holds data that is expensive to recompute and safe to delete,
+# kept in the platform's usual per-user cache location unless overridden
+# by the ATHENA_CACHE_DIR environment variable
+def _user_cache_dir():
+    home = Path.home()
+    if platform.system() == 'Windows':
+        return Path(os.environ.get('LOCALAPPDATA', home / 'AppData' / 'Local'), 'Athena', 'Cache')
+    elif platform.system() == 'Darwin':
+        return home / 'Library' / 'Caches' / 'Athena'
+    else:
+        return Path(os.environ.get('XDG_CACHE_HOME', home / '.cache'), 'athena')
+
+ATHENA_CACHE_DIR = Path(os.environ.get('ATHENA_CACHE_DIR', _user_cache_dir()))
 
 def athena_cleanup():
-    ATHENA_OUTPUT_HOME.cleanup()
+    if ATHENA_OUTPUT_HOME:
+        ATHENA_OUTPUT_HOME.cleanup()
     print("Athena cleanup complete")
 
 print("Athena's output directory will be", ATHENA_OUTPUT_DIR)
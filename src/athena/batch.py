@@ -0,0 +1,171 @@
+import sys
+import os
+import argparse
+import csv
+import itertools
+import time
+from collections import namedtuple, Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from athena import workspace
+from athena.lcbbtool import runLCBBTool
+
+# Headless batch runs of the LCBB sequence design tools.  Every combination of
+# input PLY file, tool, scaffold, and edge length is run on a pool of worker
+# processes, each job writing to its own output directory, and the results are
+# collected into a CSV summary.  Successful runs are also indexed in the output
+# directory's workspace index, so they can be reloaded later.  From the src
+# directory, for example:
+#
+#   python -m athena.batch ../sample_inputs/3D sweep/ --tools DAEDALUS2 TALOS --edge-lengths 42 63 84 -j 4
+
+# Fixed tool parameters, matching those used by AthenaWindow
+TOOL_PARAMETERS = { 'PERDIX' : dict(),
+                    'METIS' : dict( p4_edge_sections=3, p5_vertex_design=2 ),
+                    'DAEDALUS2' : dict( p4_edge_sections=1, p5_vertex_design=2 ),
+                    'TALOS' : dict( p4_edge_sections=2, p5_vertex_design=1 ) }
+
+BatchJob = namedtuple( 'BatchJob', 'input_file, tool, scaffold, edge_length, output_dir, tool_parameters' )
+
+SUMMARY_FIELDS = [ 'input_file', 'tool', 'scaffold', 'edge_length', 'status', 'cached', 'error', 'returncode',
+                   'scale_factor', 'min_edge_length', 'bildfiles', 'seconds', 'output_dir' ]
+
+def _scaffoldName( scaffold ):
+    return scaffold if scaffold == 'm13' else Path(scaffold).stem
+
+def _uniqueNames( items, name ):
+    '''
+    Map each of items to name(item), numbering names shared by several items
+    (as name-1, name-2, ...) so that no two items get the same name
+    '''
+    counts = Counter( name(item) for item in items )
+    taken = set( counts )
+    numbers = Counter()
+    names = dict()
+    for item in items:
+        base = name(item)
+        if counts[base] == 1:
+            names[item] = base
+            continue
+        candidate = base
+        while candidate in taken:
+            numbers[base] += 1
+            candidate = '{}-{}'.format( base, numbers[base] )
+        taken.add( candidate )
+        names[item] = candidate
+    return names
+
+def inputFiles( paths ):
+    '''PLY files named by paths, which may be files or directories of them'''
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            yield from sorted( path.glob('*.ply') )
+        else:
+            yield path
+
+def batchJobs( input_files, tools, scaffolds, edge_lengths, output_root, tool_parameters=TOOL_PARAMETERS ):
+    '''
+    A BatchJob for every combination of the given inputs and parameters,
+    ignoring repeats, each with its own output directory
+    '''
+    # Inputs or scaffolds with the same file name, from different directories, are numbered
+    input_files, tools, scaffolds, edge_lengths = [ list( dict.fromkeys( values ) )
+                                                    for values in (input_files, tools, scaffolds, edge_lengths) ]
+    input_names = _uniqueNames( input_files, lambda path: Path(path).stem )
+    scaffold_names = _uniqueNames( scaffolds, _scaffoldName )
+    for input_file, tool, scaffold, edge_length in itertools.product( input_files, tools, scaffolds, edge_lengths ):
+        name = '{}_{}_{}_{}'.format( input_names[input_file], tool, scaffold_names[scaffold], edge_length )
+        yield BatchJob( input_file, tool, scaffold, edge_length, Path(output_root) / name, tool_parameters[tool] )
+
+def runBatchJob( job ):
+    '''Run one BatchJob to completion, returning its row of the summary table'''
+    row = dict( input_file=job.input_file, tool=job.tool, scaffold=job.scaffold,
+                edge_length=job.edge_length, output_dir=job.output_dir )
+    start = time.time()
+    tool_args = dict( p2_input_file=job.input_file, p1_output_dir=job.output_dir,
+                      p3_scaffold=job.scaffold, p7_edge_length=job.edge_length,
+                      **job.tool_parameters )
+    try:
+        result = runLCBBTool( job.tool, **tool_args )
+    except Exception as e:
+        row.update( status='failure', error='{}: {}'.format( type(e).__name__, e ) )
+    else:
+        job.output_dir.parent.mkdir( parents=True, exist_ok=True )
+        job.output_dir.with_suffix('.log').write_text( result.stdout )
+        row.update( status='success' if result.returncode == 0 else 'failure',
+                    cached=result.cached,
+                    error=result.toolinfo.get('error', ''),
+                    returncode=result.returncode,
+                    scale_factor=result.toolinfo.get('scale_factor', ''),
+                    min_edge_length=result.toolinfo.get('edge_length', ''),
+                    bildfiles=len(result.bildfiles) if result.bildfiles else 0 )
+        if result.returncode == 0:
+            row['record'] = workspace.runRecord( job.tool, tool_args, result, time.time() - start )
+    row['seconds'] = round( time.time() - start, 2 )
+    return row
+
+def runBatch( jobs, num_workers=None, progress=print, workspace_dir=None ):
+    '''
+    Run BatchJobs concurrently, returning their summary rows in job order.
+    Successful runs are recorded in the index of workspace_dir, if given.
+    '''
+    jobs = list(jobs)
+    rows = [None] * len(jobs)
+    with ProcessPoolExecutor( max_workers=num_workers ) as pool:
+        futures = { pool.submit( runBatchJob, job ) : idx for idx, job in enumerate(jobs) }
+        for done, future in enumerate( as_completed( futures ), 1 ):
+            idx = futures[future]
+            rows[idx] = future.result()
+            record = rows[idx].pop( 'record', None )
+            if record and workspace_dir:
+                workspace.recordRun( workspace_dir, record )
+            progress( '[{}/{}] {}: {} ({}s)'.format( done, len(jobs), jobs[idx].output_dir.name,
+                                                     rows[idx]['status'], rows[idx]['seconds'] ) )
+    return rows
+
+def writeSummary( rows, csv_path ):
+    with open( csv_path, 'w', newline='' ) as csv_file:
+        writer = csv.DictWriter( csv_file, fieldnames=SUMMARY_FIELDS )
+        writer.writeheader()
+        writer.writerows( rows )
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description='Run LCBB sequence design tools over many inputs and parameters' )
+    parser.add_argument( 'inputs', nargs='+', help='PLY files, or directories of them' )
+    parser.add_argument( 'output_dir', help='directory to hold one output directory per job, and the summary' )
+    parser.add_argument( '--tools', nargs='+', choices=sorted(TOOL_PARAMETERS), default=['DAEDALUS2'] )
+    parser.add_argument( '--scaffolds', nargs='+', default=['m13'], help="'m13' or scaffold sequence files" )
+    parser.add_argument( '--edge-lengths', nargs='+', type=int, default=[42] )
+    parser.add_argument( '--talos-edge-sections', type=int, choices=[2,3], default=2,
+                         help='2 for inner or 3 for middle 6HB edges' )
+    parser.add_argument( '--talos-vertex-design', type=int, choices=[1,2], default=1,
+                         help='1 for flat or 2 for mitered vertices' )
+    parser.add_argument( '-j', '--jobs', type=int, default=os.cpu_count(), help='number of worker processes' )
+    parser.add_argument( '--summary', help='CSV summary path; defaults to summary.csv in output_dir' )
+    args = parser.parse_args( argv )
+
+    tool_parameters = dict( TOOL_PARAMETERS )
+    tool_parameters['TALOS'] = dict( p4_edge_sections=args.talos_edge_sections,
+                                     p5_vertex_design=args.talos_vertex_design )
+    output_root = Path( args.output_dir ).resolve()
+    output_root.mkdir( parents=True, exist_ok=True )
+    input_files = [ p.resolve() for p in inputFiles( args.inputs ) ]
+    scaffolds = [ s if s == 'm13' else str(Path(s).resolve()) for s in args.scaffolds ]
+    jobs = list( batchJobs( input_files, args.tools, scaffolds, args.edge_lengths, output_root, tool_parameters ) )
+    # Jobs sharing an output directory would overwrite each other's outputs
+    clashes = [ str(path) for path, count in Counter( job.output_dir for job in jobs ).items() if count > 1 ]
+    if clashes:
+        parser.error( 'jobs would share output directories: {}'.format( ', '.join( clashes ) ) )
+    print( 'Running {} jobs on {} workers'.format( len(jobs), args.jobs ) )
+
+    rows = runBatch( jobs, args.jobs, workspace_dir=output_root )
+    summary_path = Path( args.summary ) if args.summary else output_root / 'summary.csv'
+    writeSummary( rows, summary_path )
+    failures = sum( 1 for row in rows if row['status'] != 'success' )
+    print( '{} of {} jobs succeeded; summary written to {}'.format( len(rows) - failures, len(rows), summary_path ) )
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -1,8 +1,14 @@
+import re
+import itertools
+import contextlib
 from pathlib import Path
 from collections import namedtuple
 
+import numpy as np
+
 from athena import colorTable
 
+from PySide2.QtCore import QObject, Signal
 from PySide2.QtGui import QColor, QVector3D as vec3d
 from PySide2.Qt3DCore import Qt3DCore
 from PySide2.Qt3DExtras import Qt3DExtras
@@ -15,37 +21,201 @@ Cylinder = namedtuple ( 'Cylinder', 'color, x1, y1, z1, x2, y2, z2, r' )
 # There are no cones in the input file, but we include a cone type for parity with cylinders
 Cone = namedtuple('Cone', 'color, x1, y1, z1, x2, y2, z2, r' )
 # We'll give defaults for r1, r2, and rho, which are optional in a file.
-# This isn't perfect because the default for r2 should be r1*4.  Parser
-# code should watch for the case where r1 is given and r2 is not, and update
-# the r2 value appropriately. FIXME
+# The default for r2 should be r1*4; the parser watches for the case where
+# r1 is given and r2 is not.
 Arrow = namedtuple ( 'Arrow', 'color, x1, y1, z1, x2, y2, z2, r1, r2, rho', defaults=[0.1,0.4,0.75] )
 
+# Matches every keyword line of a bild file, capturing the keyword and its arguments
+_keyword_line_re = re.compile( r'^[ \t]*\.(\w+)[ \t]*([^\n]*)', re.MULTILINE )
+# Matches every non-blank line that isn't a keyword line
+_other_line_re = re.compile( r'^[ \t]*([^.\s][^\n]*)', re.MULTILINE )
+
+# Bytes of text parsed at a time by parseBildFile
+BILD_BLOCK_SIZE = 1 << 24
+# Bytes of text in each chunk of a streamed bild file; smaller, so the first chunks show up quickly
+BILD_STREAM_BLOCK_SIZE = 1 << 22
+
+class PrimitiveColumns:
+    '''
+    Growable float32 columns for all the primitives of one bild type
+
+    data is an (N, k) array of the record type's numeric fields, and
+    color_index is an (N,) array of indices into the owning palette, with
+    -1 meaning no color was set.  Iterating yields record_type tuples.
+    '''
+    def __init__( self, record_type, palette ):
+        self.record_type = record_type
+        self.palette = palette
+        self.width = len(record_type._fields) - 1
+        self._data = [ np.zeros( (0, self.width), dtype=np.float32 ) ]
+        self._color_index = [ np.zeros( 0, dtype=np.int32 ) ]
+
+    def append( self, data, color_index ):
+        self._data.append( np.asarray( data, dtype=np.float32 ).reshape(-1, self.width) )
+        self._color_index.append( np.asarray( color_index, dtype=np.int32 ) )
+
+    @property
+    def data( self ):
+        if len(self._data) > 1:
+            self._data = [ np.concatenate( self._data ) ]
+        return self._data[0]
+
+    @property
+    def color_index( self ):
+        if len(self._color_index) > 1:
+            self._color_index = [ np.concatenate( self._color_index ) ]
+        return self._color_index[0]
+
+    def take( self, count ):
+        '''Remove the first count primitives, returning their data and color indices'''
+        data, color_index = self.data, self.color_index
+        self._data = [ data[count:] ]
+        self._color_index = [ color_index[count:] ]
+        return data[:count], color_index[:count]
+
+    def __len__( self ):
+        return sum( len(x) for x in self._color_index )
+
+    def __iter__( self ):
+        return _iterRecords( self.record_type, self.palette, self.data, self.color_index )
+
+def _iterRecords( record_type, palette, data, color_index ):
+    '''Yield record_type tuples from columnar data, with None for unset colors'''
+    colors = [ palette[i] if i >= 0 else None for i in color_index.tolist() ]
+    for color, row in zip( colors, data.tolist() ):
+        yield record_type( color, *row )
+
 class OutputDecorations:
     def __init__(self, scale_factor ):
         self.colors = dict() # maps normalized bild strings to QColors
+        self.color_indices = dict() # maps normalized bild strings to palette indices
+        self.palette = list() # QColors, indexed by the values of color_indices
         self.current_color = None
-        self.spheres = list()
-        self.cylinders = list()
-        self.arrows = list()
+        self.current_color_index = -1
+        self.spheres = PrimitiveColumns( Sphere, self.palette )
+        self.cylinders = PrimitiveColumns( Cylinder, self.palette )
+        self.arrows = PrimitiveColumns( Arrow, self.palette )
         self.scale_factor = scale_factor
+        self.unknown_keyword_map = dict()
+        self.other_line_list = list()
 
-    def addColor( self, tokens ):
+    def colorIndex( self, tokens ):
+        '''Palette index of a bild color, given as a name or rgb floats, adding it if needed'''
         color_key = ' '.join(tokens)
         if color_key not in self.colors:
             if color_key in colorTable.colors:
                 self.colors[color_key] = QColor( *colorTable.colors[color_key] )
             else:
                 self.colors[color_key] = QColor( *(float(x)*255 for x in tokens) )
-        self.current_color = self.colors[color_key]
+            self.color_indices[color_key] = len(self.palette)
+            self.palette.append( self.colors[color_key] )
+        return self.color_indices[color_key]
+
+    def paletteArray( self ):
+        '''The palette as a (P,3) float32 array of rgb values in [0,1]'''
+        return np.array( [ (c.redF(), c.greenF(), c.blueF()) for c in self.palette ],
+                         dtype=np.float32 ).reshape(-1, 3)
+
+    def colorArray( self, color_index ):
+        '''(N,3) float32 rgb values for an array of palette indices, with unset colors as white'''
+        palette = np.concatenate( [ self.paletteArray(), np.ones( (1,3), dtype=np.float32 ) ] )
+        return palette[ color_index ]
+
+    def addColor( self, tokens ):
+        self.current_color_index = self.colorIndex( tokens )
+        self.current_color = self.palette[ self.current_color_index ]
 
     def addSphere( self, tokens ):
-        self.spheres.append( Sphere( self.current_color, *(float(x)*(self.scale_factor) for x in tokens) ) )
+        self.spheres.append( [float(x)*self.scale_factor for x in tokens], [self.current_color_index] )
 
     def addCylinder( self, tokens ):
-        self.cylinders.append( Cylinder( self.current_color, *(float(x)*(self.scale_factor) for x in tokens) ) )
+        self.cylinders.append( [float(x)*self.scale_factor for x in tokens], [self.current_color_index] )
 
     def addArrow( self, tokens ):
-        self.arrows.append( Arrow( self.current_color, *(float(x)*(self.scale_factor) for x in tokens[:8]), float(tokens[8] ) ) )
+        self.arrows.append( _arrowValues( [tokens], self.scale_factor ), [self.current_color_index] )
+
+    def parseBlock( self, text ):
+        '''
+        Parse a block of complete lines of bild text, appending to this object
+
+        Each primitive type is converted to floats with a single np.fromstring
+        call over all of its lines in the block; lines are only handled one at
+        a time if any of a type's lines has an unexpected number of values.
+        '''
+        lines = _keyword_line_re.findall( text )
+        if lines:
+            keywords = np.array( [ kw for kw, args in lines ] )
+            arguments = [ args for kw, args in lines ]
+            self._parseKeywordLines( keywords, arguments )
+        # Only look for comments and other non-keyword lines if there are any
+        if text.count( '\n' ) + (not text.endswith( '\n' )) > len(lines):
+            for other in _other_line_re.findall( text ):
+                self.other_line_list.append( other.split() )
+
+    def _parseKeywordLines( self, keywords, arguments ):
+        # Give each line the palette index of the closest preceding color line
+        is_color = (keywords == 'color')
+        color_line_idx = np.flatnonzero( is_color )
+        color_args, color_inverse = np.unique( [ arguments[i] for i in color_line_idx ], return_inverse=True )
+        color_ids = np.array( [ self.colorIndex( args.split() ) for args in color_args.tolist() ],
+                              dtype=np.int32 )[ color_inverse ]
+        line_colors = np.concatenate( ( [self.current_color_index], color_ids ) ).astype( np.int32 )
+        last_color = np.searchsorted( color_line_idx, np.arange( len(keywords) ), side='right' )
+        line_colors = line_colors[ last_color ]
+        if len(color_ids):
+            self.current_color_index = int(color_ids[-1])
+            self.current_color = self.palette[ self.current_color_index ]
+
+        handled = is_color
+        for keyword, columns in ( ('sphere', self.spheres), ('cylinder', self.cylinders), ('arrow', self.arrows) ):
+            mask = (keywords == keyword)
+            count = np.count_nonzero( mask )
+            handled = handled | mask
+            if count == 0:
+                continue
+            args = list( itertools.compress( arguments, mask ) )
+            # End each line with a nan, so lines of the wrong length show up as
+            # misplaced nans even when the total number of values is right
+            values = np.fromstring( ' nan '.join( args ) + ' nan', dtype=np.float64, sep=' ' )
+            if( values.size == count * (columns.width + 1) and
+                np.isnan( values ).sum() == count and np.isnan( values[columns.width::columns.width + 1] ).all() ):
+                values = values.reshape( count, columns.width + 1 )[:,:columns.width]
+                if keyword == 'arrow':
+                    values[:,:8] *= self.scale_factor
+                else:
+                    values *= self.scale_factor
+            elif keyword == 'arrow':
+                values = _arrowValues( [ a.split() for a in args ], self.scale_factor )
+            else:
+                rows = [ a.split()[:columns.width] for a in args ]
+                for a, row in zip( args, rows ):
+                    if len(row) < columns.width:
+                        raise ValueError( 'Too few values in bild line: .{} {}'.format( keyword, a ) )
+                values = [ [ float(x)*self.scale_factor for x in row ] for row in rows ]
+            columns.append( values, line_colors[ mask ] )
+
+        for keyword in keywords[ ~handled ].tolist():
+            keyword = '.' + keyword
+            self.unknown_keyword_map[keyword] = self.unknown_keyword_map.get(keyword, 0) + 1
+
+    def isEmpty( self ):
+        return not ( self.spheres or self.cylinders or self.arrows )
+
+    def primitiveCounts( self ):
+        return len(self.spheres), len(self.cylinders), len(self.arrows)
+
+    def split( self, counts ):
+        '''
+        Move the first (spheres, cylinders, arrows) counts of primitives into a
+        new OutputDecorations, which shares this one's palette
+        '''
+        head = OutputDecorations( self.scale_factor )
+        head.colors, head.color_indices, head.palette = self.colors, self.color_indices, self.palette
+        for kind, count in zip( ('spheres', 'cylinders', 'arrows'), counts ):
+            columns = getattr( head, kind )
+            columns.palette = self.palette
+            columns.append( *getattr( self, kind ).take( count ) )
+        return head
 
     def debugSummary( self ):
         pattern =  'parsed BILD: {0} unique colors, {1} spheres, {2} cylinders, {3} arrows' +\
@@ -55,55 +225,140 @@ class OutputDecorations:
                                self.unknown_keyword_map, len(self.other_line_list) )
 
 
-    def cylindersFromArrows( self ):
-        for arrow in self.arrows:
-            xyz1 = vec3d( arrow.x1, arrow.y1, arrow.z1)
-            axis = vec3d( arrow.x2, arrow.y2, arrow.z2 ) - xyz1
-            axis *= arrow.rho
-            xyz2 = xyz1 + axis
-            yield Cylinder(arrow.color, xyz1.x(), xyz1.y(), xyz1.z(), xyz2.x(), xyz2.y(), xyz2.z(), arrow.r1 )
-
-    def conesFromArrows( self ):
-        for arrow in self.arrows:
-            xyz1 = vec3d( arrow.x1, arrow.y1, arrow.z1)
-            end = vec3d( arrow.x2, arrow.y2, arrow.z2)
-            axis = xyz1 - end
-            axis *= 1.0 - arrow.rho
-            base = end + axis
-            yield Cone( arrow.color, base.x(), base.y(), base.z(), end.x(), end.y(), end.z(), arrow.r2 )
-
-    def allVertices( self ):
-        for s in self.spheres:
-            yield (s.x, s.y, s.z)
-        for c in self.cylinders:
-            yield (c.x1, c.y1, c.z1)
-            yield (c.x2, c.y2, c.z2)
-        for c in self.arrows:
-            yield (c.x1, c.y1, c.z1)
-            yield (c.x2, c.y2, c.z2)
+    def arrowCylinders( self ):
+        '''The bodies of all arrows, as (N,7) cylinder columns and their palette indices'''
+        arrows = self.arrows.data
+        start, end = arrows[:,0:3], arrows[:,3:6]
+        body_end = start + (end - start) * arrows[:,8:9]
+        return np.hstack( [ start, body_end, arrows[:,6:7] ] ), self.arrows.color_index
+
+    def arrowCones( self ):
+        '''The heads of all arrows, as (N,7) cone columns and their palette indices'''
+        arrows = self.arrows.data
+        start, end = arrows[:,0:3], arrows[:,3:6]
+        base = end + (start - end) * (1.0 - arrows[:,8:9])
+        return np.hstack( [ base, end, arrows[:,7:8] ] ), self.arrows.color_index
+
+    def vertexArray( self ):
+        '''All sphere centers and cylinder and arrow endpoints, as an (N,3) array'''
+        return np.concatenate( [ self.spheres.data[:,0:3],
+                                 self.cylinders.data[:,0:3],
+                                 self.cylinders.data[:,3:6],
+                                 self.arrows.data[:,0:3],
+                                 self.arrows.data[:,3:6] ] )
 
+def _arrowValues( token_lists, scale_factor ):
+    '''Arrow rows from per-line token lists, filling in the optional r1, r2, and rho'''
+    defaults = Arrow._field_defaults
+    rows = list()
+    for tokens in token_lists:
+        values = [ float(x) for x in tokens[:9] ]
+        r1 = values[6] if len(values) > 6 else defaults['r1']
+        r2 = values[7] if len(values) > 7 else ( r1 * 4 if len(values) > 6 else defaults['r2'] )
+        rho = values[8] if len(values) > 8 else defaults['rho']
+        rows.append( [ x*scale_factor for x in values[:6] ] + [ r1*scale_factor, r2*scale_factor, rho ] )
+    return np.array( rows, dtype=np.float64 ).reshape(-1, 9)
+
+def iterBildBlocks( bild, block_size=BILD_BLOCK_SIZE ):
+    '''Yield blocks of roughly block_size characters of complete lines from an open text file'''
+    remainder = ''
+    while True:
+        text = bild.read( block_size )
+        if not text:
+            break
+        text = remainder + text
+        cut = text.rfind( '\n' ) + 1
+        if cut == 0:
+            remainder = text
+            continue
+        remainder = text[cut:]
+        yield text[:cut]
+    if remainder:
+        yield remainder
 
 def parseBildFile( filename, scale_factor = 1.0 ):
     results = OutputDecorations(scale_factor)
     with open(filename,'r') as bild:
-        unknown_keyword_map = dict()
-        other_line_list = list()
-        for line in bild:
-            tokens = line.split()
-            token0 = tokens[0]
-            if( token0 == '.arrow' ):
-                results.addArrow( tokens[1:] )
-            elif( token0 == '.color' ):
-                results.addColor( tokens[1:] )
-            elif token0 == '.cylinder':
-                results.addCylinder( tokens[1:] )
-            elif token0 == '.sphere':
-                results.addSphere( tokens[1:] )
-            elif( tokens[0].startswith('.')):
-                v = unknown_keyword_map.get(tokens[0],0)
-                unknown_keyword_map[tokens[0]] = v + 1
-            else:
-                other_line_list.append(tokens)
-        results.unknown_keyword_map = unknown_keyword_map
-        results.other_line_list = other_line_list
+        for block in iterBildBlocks( bild ):
+            results.parseBlock( block )
     return results
+
+def iterBildFile( filename, scale_factor = 1.0, block_size = BILD_STREAM_BLOCK_SIZE ):
+    '''Parse a bild file incrementally, yielding an OutputDecorations for each chunk of it'''
+    with open(filename,'r') as bild:
+        for block in iterBildBlocks( bild, block_size ):
+            chunk = OutputDecorations(scale_factor)
+            chunk.parseBlock( block )
+            if not chunk.isEmpty():
+                yield chunk
+
+def iterBildVariants( filenames, scale_factor = 1.0, block_size = BILD_STREAM_BLOCK_SIZE ):
+    '''
+    Parse color variants of a bild file incrementally and in step, yielding a
+    list of OutputDecorations, one per file, for each chunk of them
+
+    The OutputDecorations of a chunk have equal numbers of each primitive, so
+    for variants that draw the same primitives in different colors, they match
+    (see sameGeometry).
+    '''
+    with contextlib.ExitStack() as stack:
+        blocks = [ iterBildBlocks( stack.enter_context( open(filename,'r') ), block_size ) for filename in filenames ]
+        pending = [ OutputDecorations(scale_factor) for filename in filenames ]
+        exhausted = [ False ] * len(filenames)
+        while not all( exhausted ):
+            for idx, variant_blocks in enumerate( blocks ):
+                block = None if exhausted[idx] else next( variant_blocks, None )
+                if block is None:
+                    exhausted[idx] = True
+                else:
+                    pending[idx].parseBlock( block )
+            if all( exhausted ):
+                # Whatever is left, matching or not
+                chunks = [ p.split( p.primitiveCounts() ) for p in pending ]
+            else:
+                counts = np.min( [ p.primitiveCounts() for p in pending ], axis=0 )
+                chunks = [ p.split( counts ) for p in pending ]
+            if not all( chunk.isEmpty() for chunk in chunks ):
+                yield chunks
+
+def sameGeometry( variants ):
+    '''True if OutputDecorations draw the same primitives, whatever their colors'''
+    first = variants[0]
+    return all( np.array_equal( getattr( first, kind ).data, getattr( variant, kind ).data )
+                for variant in variants[1:] for kind in ('spheres', 'cylinders', 'arrows') )
+
+class BildStreamWorker( QObject ):
+    '''
+    Parses a list of bild files chunk by chunk, meant to run on a worker QThread
+
+    chunkParsed is emitted with (worker, index of the file in paths, chunk) for
+    every chunk, in file order.  finished is emitted with the worker once all
+    files are parsed or the worker has been cancelled.  An entry of paths may
+    also be a tuple of color variants of one file, parsed together by
+    iterBildVariants, whose chunks are lists of OutputDecorations.
+    '''
+    chunkParsed = Signal( object, int, object )
+    finished = Signal( object )
+
+    def __init__( self, paths, scale_factor = 1.0, block_size = BILD_STREAM_BLOCK_SIZE ):
+        super().__init__()
+        self.paths = list(paths)
+        self.scale_factor = scale_factor
+        self.block_size = block_size
+        self._cancelled = False
+
+    def cancel( self ):
+        '''Stop after the chunk currently being parsed; safe to call from any thread'''
+        self._cancelled = True
+
+    def run( self ):
+        for idx, path in enumerate( self.paths ):
+            if isinstance( path, tuple ):
+                chunks = iterBildVariants( path, self.scale_factor, self.block_size )
+            else:
+                chunks = iterBildFile( path, self.scale_factor, self.block_size )
+            for chunk in chunks:
+                if self._cancelled: break
+                self.chunkParsed.emit( self, idx, chunk )
+            if self._cancelled: break
+        self.finished.emit( self )
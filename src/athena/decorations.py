@@ -1,91 +1,596 @@
+import itertools
+
 import numpy as np
 
-from PySide2.QtGui import QColor, QVector3D as vec3d
+from PySide2.QtGui import QColor, QVector3D as vec3d, QVector4D
 from PySide2.QtCore import QByteArray, Qt
 from PySide2.Qt3DCore import Qt3DCore
 from PySide2.Qt3DRender import Qt3DRender
 
-from athena.bildparser import Sphere, Cylinder, Arrow
 from athena import geom
 
 # QEntities for ray-traced output objects (spheres, cylinders, and cones),
 # and for any other small decorations drawn by Qt3D.
 
-class SphereDecorations(Qt3DCore.QEntity):
-
-    def __init__(self, parent, bildfile, transform=None):
+def _endpointVertices( data, colors, dtype, tip_radius=None ):
+    '''
+    Interleaved (2N,4+C) vertex rows for N cylinder-like primitives
+
+    data holds x1, y1, z1, x2, y2, z2, r for each primitive and colors its C
+    color columns.  Each primitive gets one vertex per endpoint; the second
+    endpoint's radius is tip_radius if given.
+    '''
+    vertex_nparr = np.empty([2*len(data),4+colors.shape[1]],dtype=dtype)
+    vertex_nparr[0::2,0:3] = data[:,0:3]
+    vertex_nparr[1::2,0:3] = data[:,3:6]
+    vertex_nparr[0::2,3] = data[:,6]
+    vertex_nparr[1::2,3] = data[:,6] if tip_radius is None else tip_radius
+    vertex_nparr[0::2,4:] = colors
+    vertex_nparr[1::2,4:] = colors
+    return vertex_nparr
+
+# A palette of decoration colors, shared by every decoration material as a
+# uniform array, so that vertices need only hold a palette index.  A palette slot
+# holds one color for each color variant of a group of decorations, like the
+# multi-color and two-color variants of a routing model; the shaders see the
+# colors of each group's chosen variant, so switching variants re-uploads the
+# palette instead of needing a second set of geometry.  Decorations that are
+# not part of a group use group None, with a single variant.
+#
+# The palette is a uniform array rather than a texture, since it is small, and
+# Qt3D textures need their data supplied through a texture image generator.
+# Colors are never approximated: a decoration set whose colors don't all fit
+# in the free slots is drawn with RGBA8 vertex colors instead.
+
+# Number of palette slots; the shaders' palette arrays take 4 uniform components
+# per slot, and OpenGL 3.3 only guarantees 1024 for all vertex shader uniforms
+PALETTE_SIZE = 128
+
+class DecorationPalette:
+    '''
+    The shared palette of decoration colors, with a QParameter holding its
+    current colors for the imposter materials
+    '''
+    def __init__( self, size=PALETTE_SIZE ):
+        self.size = size
+        self.slots = dict() # maps (group, variant colors as RGB8 bytes) to slots
+        self.slot_colors = list() # (V,3) float32 variant colors of each slot
+        self.slot_groups = list()
+        self.free_slots = list() # released slots, reused before new ones
+        self.variants = dict() # maps groups to their chosen variant
+        self.overflowed = False # whether a decoration set has been refused since the last clear
+        self.parameter = Qt3DRender.QParameter()
+        self.parameter.setName( 'palette' )
+        self._upload()
+
+    def _shownColor( self, slot ):
+        colors = self.slot_colors[slot]
+        return colors[ min( self.variants.get( self.slot_groups[slot], 0 ), len(colors) - 1 ) ]
+
+    def _upload( self ):
+        # Unused slots are white, like unset bild colors
+        colors = [ self._shownColor( slot ) for slot in range( len(self.slot_colors) ) ]
+        colors += [ (1.0, 1.0, 1.0) ] * ( self.size - len(colors) )
+        self.parameter.setValue( [ QVector4D( *[ float(c) for c in rgb ], 1.0 ) for rgb in colors ] )
+
+    def slotIndices( self, variant_colors, group=None ):
+        '''
+        uint16 palette slots for the (N,V,3) rgb colors of N primitives in each of
+        the V variants of group, adding slots for colors not seen before, or None
+        if the new colors don't fit in the free slots
+        '''
+        rgb8 = np.rint( np.clip( variant_colors, 0, 1 ) * 255 ).astype( np.uint8 ).reshape( len(variant_colors), -1 )
+        keys, inverse = np.unique( rgb8, axis=0, return_inverse=True )
+        keys = [ (group, key.tobytes()) for key in keys ]
+        new_keys = [ key for key in keys if key not in self.slots ]
+        if len(self.slot_colors) - len(self.free_slots) + len(new_keys) > self.size:
+            if not self.overflowed:
+                print( 'Warning: more than {} decoration colors; drawing some decorations with vertex colors'
+                       .format( self.size ) )
+                self.overflowed = True
+            return None
+        for key in new_keys:
+            colors = np.frombuffer( key[1], dtype=np.uint8 ).reshape(-1, 3).astype( np.float32 ) / 255
+            if( self.free_slots ):
+                slot = self.free_slots.pop()
+                self.slot_colors[slot] = colors
+                self.slot_groups[slot] = group
+            else:
+                slot = len(self.slot_colors)
+                self.slot_colors.append( colors )
+                self.slot_groups.append( group )
+            self.slots[key] = slot
+        if( new_keys ):
+            self._upload()
+        return np.array( [ self.slots[key] for key in keys ], dtype=np.uint16 )[ inverse.reshape(-1) ]
+
+    def variantColors( self, slots, variant ):
+        '''(N,3) rgb colors of the given variant for N palette slots'''
+        return np.array( [ colors[ min( variant, len(colors) - 1 ) ] for colors in self.slot_colors ],
+                         dtype=np.float32 ).reshape(-1, 3)[ slots ]
+
+    def releaseGroup( self, group ):
+        '''Free the slots of group, for reuse by other decorations'''
+        released = [ key for key in self.slots if key[0] == group ]
+        for key in released:
+            slot = self.slots.pop( key )
+            self.slot_colors[slot] = np.ones( (1, 3), dtype=np.float32 )
+            self.slot_groups[slot] = None
+            self.free_slots.append( slot )
+        if( released ):
+            self._upload()
+
+    def setVariant( self, group, variant ):
+        '''Show the colors of the given variant for the decorations of group'''
+        if self.variants.get( group, 0 ) != variant:
+            self.variants[group] = variant
+            self._upload()
+
+    def clear( self ):
+        '''Free every slot, keeping each group's chosen variant'''
+        self.slots.clear()
+        self.slot_colors = list()
+        self.slot_groups = list()
+        self.free_slots = list()
+        self.overflowed = False
+        self._upload()
+
+# Level-of-detail (LOD) support for large sphere sets, such as atomic models.
+# Besides the full set, SphereDecorations can draw a few decimated levels, made
+# by clustering the spheres into a spatial grid and drawing one sphere per grid
+# cell, which covers every sphere in its cell.  Each level doubles the cell
+# size of the one before.  The viewer picks the coarsest level whose cells
+# would appear no wider than LOD_CELL_PIXELS on screen, from the camera state.
+# Only the level on screen is kept besides the full set, so a decimated level
+# costs memory only while it is shown.
+
+# Sphere sets smaller than this are always drawn in full
+LOD_MIN_SPHERES = 50000
+# Stop adding levels when one would have fewer spheres than this
+LOD_MIN_LEVEL_SPHERES = 1000
+LOD_MAX_LEVELS = 6
+# Largest on-screen size of a decimated level's grid cells, in pixels
+LOD_CELL_PIXELS = 2.0
+
+def decimateSpheres( vertex_nparr, cell_size, origin, weights=None ):
+    '''
+    Cluster (N,4+C) sphere vertex rows (x, y, z, radius, colors) into a grid of
+    the given cell size and origin, returning one row per occupied cell, and
+    the total weight of each cell's members (by default, their number)
+
+    Each cell's sphere is centered on the weighted mean of its members, colored
+    like one of them, and large enough to cover all of them.
+    '''
+    xyz = vertex_nparr[:,0:3].astype(np.float64)
+    cells = np.floor( (xyz - origin) / cell_size ).astype(np.int64)
+    cells -= cells.min(axis=0)
+    keys = np.ravel_multi_index( cells.T, tuple( cells.max(axis=0) + 1 ) )
+
+    # Sort the spheres by cell, and find where each cell's run starts
+    order = np.argsort( keys )
+    keys = keys[order]
+    new_cell = np.empty( len(keys), dtype=bool )
+    new_cell[0] = True
+    new_cell[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero( new_cell )
+    cell_of = np.cumsum( new_cell ) - 1
+
+    xyz = xyz[order]
+    weights = np.ones( len(xyz) ) if weights is None else weights[order]
+    totals = np.add.reduceat( weights, starts )
+    centers = np.add.reduceat( xyz * weights[:,np.newaxis], starts ) / totals[:,np.newaxis]
+    reach = np.linalg.norm( xyz - centers[cell_of], axis=1 ) + vertex_nparr[order,3]
+
+    decimated = np.empty( (len(starts), vertex_nparr.shape[1]), dtype=vertex_nparr.dtype )
+    decimated[:,0:3] = centers
+    decimated[:,3] = np.maximum.reduceat( reach, starts )
+    decimated[:,4:] = vertex_nparr[order[starts],4:]
+    return decimated, totals
+
+def sphereLevels( vertex_nparr ):
+    '''
+    The decimated LOD levels for (N,4+C) sphere vertex rows, as a list of
+    (cell_size, vertex rows) pairs from finest to coarsest
+    '''
+    levels = list()
+    if len(vertex_nparr) < LOD_MIN_SPHERES:
+        return levels
+    # The finest grid is about as fine as the spheres themselves
+    cell_size = 2 * float( np.median( vertex_nparr[:,3] ) )
+    if cell_size <= 0:
+        return levels
+    # The grids all share an origin, so each cell of a level is the union of
+    # cells of the level before, and can be built from that level's spheres
+    origin = vertex_nparr[:,0:3].min(axis=0)
+    previous, weights = vertex_nparr, None
+    while len(levels) < LOD_MAX_LEVELS:
+        decimated, totals = decimateSpheres( previous, cell_size, origin, weights )
+        if len(decimated) < LOD_MIN_LEVEL_SPHERES:
+            break
+        # Skip grids too fine to merge many spheres
+        if len(decimated) < 0.75 * len(previous):
+            levels.append( (cell_size, decimated) )
+            previous, weights = decimated, totals
+        cell_size *= 2
+    return levels
+
+# Spatial chunking.  Decorations are split by an octree over their primitives'
+# bounding box, with an entity per octree node and each leaf chunk drawn by its
+# own geometry, so the frustum culling in AthenaFrameGraph can skip off-screen
+# chunks (and whole off-screen subtrees) when zoomed into part of a large
+# model.  Chunks can also be hidden or recolored one at a time.
+#
+# Qt3D computes each chunk's bounding volume from its vertex positions, which
+# leaves out the imposter radii, so every chunk ends with a few zero-radius
+# vertices on the corners of its radius-padded bounding box.  These draw
+# nothing.
+
+# Octree nodes with more primitives than this are split
+CHUNK_MAX_PRIMITIVES = 4096
+CHUNK_MAX_DEPTH = 8
+
+def _octree( centers, indices, lo, hi, max_items, depth ):
+    if( len(indices) <= max_items or depth == 0 ):
+        return indices
+    mid = (lo + hi) / 2
+    octant = ( centers[indices] >= mid ) @ np.array([1,2,4])
+    order = np.argsort( octant, kind='stable' )
+    bounds = np.cumsum( np.bincount( octant, minlength=8 ) )[:-1]
+    children = list()
+    for idx, members in enumerate( np.split( indices[order], bounds ) ):
+        if len(members) == 0:
+            continue
+        upper = np.array( [idx & 1, idx & 2, idx & 4] ) > 0
+        children.append( _octree( centers, members, np.where( upper, mid, lo ), np.where( upper, hi, mid ),
+                                  max_items, depth - 1 ) )
+    return children
+
+def octreeChunks( centers, max_items=CHUNK_MAX_PRIMITIVES, max_depth=CHUNK_MAX_DEPTH ):
+    '''
+    Split the rows of an (N,3) array of primitive centers by an octree over their
+    bounding box, returning its root node.  Leaf nodes are arrays of row
+    indices, and other nodes are lists of child nodes.
+    '''
+    return _octree( centers, np.arange(len(centers)), centers.min(axis=0), centers.max(axis=0),
+                    max_items, max_depth )
+
+class DecorationChunk(Qt3DCore.QEntity):
+    '''
+    One leaf of a ChunkedDecorations octree, drawing its vertex rows with its
+    own geometry
+    '''
+    def __init__(self, parent, vertex_nparr, decorations):
         super().__init__(parent)
-        spherelist = bildfile.spheres
-        num_spheres = len(spherelist)
-
-        if num_spheres == 0: return
-
-        total_vertices = num_spheres
-        vertex_basetype = geom.basetypes.Float
-        if( total_vertices < 30000 ):
-            index_basetype = geom.basetypes.UnsignedShort
-        else:
-            index_basetype = geom.basetypes.UnsignedInt
-
-        vertex_nparr = np.zeros([total_vertices,7],dtype=geom.basetype_numpy_codes[vertex_basetype])
-
-        for idx, (color, x, y, z, r) in enumerate(spherelist):
-            if color is None: color = QColor('white')
-            vertex_nparr[idx,:] = x, y, z, r, color.redF(), color.greenF(), color.blueF()
-
-        if( transform ):
-            vertex_nparr[:,0:3] = transform(vertex_nparr[:,0:3])
-            # Transform radii by the equivalent scaling factor (assume it's equal in all dimensions)
-            scale = transform(np.ones((1,3)))[0,0]
-            vertex_nparr[:,3] *= scale
+        self.decorations = decorations
+        pad = float( vertex_nparr[:,3].max() )
+        self.lo = vertex_nparr[:,0:3].min(axis=0) - pad
+        self.hi = vertex_nparr[:,0:3].max(axis=0) + pad
+        # Corners in opposite pairs, so each Lines primitive has length
+        corners = np.array( list( itertools.product( *zip( self.lo, self.hi ) ) ) )[[0,7,1,6,2,5,3,4]]
 
         self.geometry = Qt3DRender.QGeometry(self)
+        self.renderer = Qt3DRender.QGeometryRenderer(self)
+        self._buildGeometry( vertex_nparr, corners, decorations )
+        self.renderer.setGeometry(self.geometry)
 
-        position_attrname = Qt3DRender.QAttribute.defaultPositionAttributeName()
-        radius_attrname = 'sphereRadius'
-        color_attrname = Qt3DRender.QAttribute.defaultColorAttributeName()
+        self.addComponent(self.renderer)
+        if( decorations.material ):
+            self.addComponent( decorations.material )
+
+    def _buildGeometry( self, vertex_nparr, corners, decorations ):
+        self.count = len(vertex_nparr)
+        vertices = np.zeros( [self.count + len(corners), vertex_nparr.shape[1]], dtype=vertex_nparr.dtype )
+        vertices[:self.count] = vertex_nparr
+        vertices[self.count:,0:3] = corners
+
+        if( decorations.compact ):
+            vertices = compactVertices( vertices, decorations.radius_attrname )
+            self.vtx_attrs = geom.buildStructuredAttrs( self, vertices )
+        else:
+            position_attrname = Qt3DRender.QAttribute.defaultPositionAttributeName()
+            color_attrname = Qt3DRender.QAttribute.defaultColorAttributeName()
 
-        attrspecs = [geom.AttrSpec(position_attrname, column=0, numcols=3),
-                     geom.AttrSpec(radius_attrname, column=3, numcols=1),
-                     geom.AttrSpec(color_attrname, column=4, numcols=3)]
+            attrspecs = [geom.AttrSpec(position_attrname, column=0, numcols=3),
+                         geom.AttrSpec(decorations.radius_attrname, column=3, numcols=1),
+                         geom.AttrSpec(color_attrname, column=4, numcols=3)]
 
-        self.vtx_attrs = geom.buildVertexAttrs( self, vertex_nparr, attrspecs )
+            self.vtx_attrs = geom.buildVertexAttrs( self, vertices, attrspecs )
         for va in self.vtx_attrs:
             self.geometry.addAttribute(va)
 
-        # Create qt3d index buffer
-        index_nparr = np.arange(len(vertex_nparr),dtype=geom.basetype_numpy_codes[index_basetype])
-        self.indexAttr = geom.buildIndexAttr( self, index_nparr )
-        self.geometry.addAttribute(self.indexAttr)
-
-        self.renderer = Qt3DRender.QGeometryRenderer(parent)
-        self.renderer.setGeometry(self.geometry)
-        self.renderer.setPrimitiveType(Qt3DRender.QGeometryRenderer.Points)
-
-        self.addComponent(self.renderer)
+        # Vertices are drawn in order, so there is no index buffer
+        self.renderer.setPrimitiveType(decorations.primitive_type)
+        self.renderer.setVertexCount(len(vertices))
+        # The QBuffer keeps the only host copy of the vertices
+        self.vertex_layout = ( vertices.dtype, vertices.shape[1:] )
+        self.nbytes = vertices.nbytes
+
+    def setColor( self, rgb ):
+        '''Recolor every primitive in this chunk'''
+        vertices = geom.bufferArray( self.vtx_attrs[0].buffer(), *self.vertex_layout )
+        if( vertices.dtype.names and 'paletteIndex' in vertices.dtype.names ):
+            vertices['paletteIndex'][:self.count] = self.decorations.paletteSlot( rgb )
+        elif( vertices.dtype.names ):
+            vertices['vertexColor'][:self.count] = geom.packRGBA8( np.atleast_2d( rgb ) )
+        else:
+            vertices[:self.count,4:7] = rgb
+        self.vtx_attrs[0].buffer().setData( geom.arrayToQByteArray( vertices ) )
+
+    def vertexRows( self ):
+        '''
+        The (x, y, z, radius, colors) vertex rows this chunk was built from,
+        read back from its buffer, with any recoloring
+        '''
+        vertices = geom.bufferArray( self.vtx_attrs[0].buffer(), *self.vertex_layout )[:self.count]
+        if( not vertices.dtype.names ):
+            return vertices
+        position_attrname, color_attrname, radius_attrname = vertices.dtype.names
+        palette = color_attrname == 'paletteIndex'
+        rows = np.empty( [self.count, 5 if palette else 7], dtype=np.float32 )
+        rows[:,0:3] = vertices[position_attrname]
+        rows[:,3] = vertices[radius_attrname]
+        if( palette ):
+            rows[:,4] = vertices[color_attrname]
+        else:
+            rows[:,4:7] = geom.unpackRGBA8( vertices[color_attrname] )
+        return rows
+
+    def memoryUsage( self ):
+        '''Bytes of vertex data held by this chunk, on the GPU and again on the host'''
+        return self.nbytes
+
+# Compact vertex formats.  By default decoration vertices are seven float32s
+# (28 bytes).  Compact vertices keep float32 positions, but store the radius as
+# a half float, and the color as a uint16 DecorationPalette slot (16 bytes), or
+# for decorations whose colors don't fit in the palette, as RGBA8 packed into a
+# uint32 with red in the lowest byte (20 bytes, with padding to keep attributes
+# 4-byte aligned).  The imposter vertex shaders look the colors up when
+# PALETTE_SIZE is defined, and unpack them when COMPACT_VERTICES is.  Half
+# floats carry about three significant digits, plenty for radii.
+
+def compactVertexDtype( radius_attrname, palette=False ):
+    position_attrname = Qt3DRender.QAttribute.defaultPositionAttributeName()
+    if( palette ):
+        return np.dtype( { 'names' : [ position_attrname, 'paletteIndex', radius_attrname ],
+                           'formats' : [ (np.float32, 3), np.uint16, np.float16 ],
+                           'offsets' : [ 0, 12, 14 ],
+                           'itemsize' : 16 } )
+    return np.dtype( { 'names' : [ position_attrname, Qt3DRender.QAttribute.defaultColorAttributeName(),
+                                   radius_attrname ],
+                       'formats' : [ (np.float32, 3), np.uint32, np.float16 ],
+                       'offsets' : [ 0, 12, 16 ],
+                       'itemsize' : 20 } )
+
+def compactVertices( vertex_nparr, radius_attrname ):
+    '''
+    Compact vertices for (N,7) vertex rows (x, y, z, radius, r, g, b), or (N,5)
+    rows with palette slots
+    '''
+    palette = vertex_nparr.shape[1] == 5
+    dtype = compactVertexDtype( radius_attrname, palette )
+    vertices = np.zeros( len(vertex_nparr), dtype=dtype )
+    vertices[dtype.names[0]] = vertex_nparr[:,0:3]
+    if( palette ):
+        vertices[dtype.names[1]] = vertex_nparr[:,4]
+    else:
+        vertices[dtype.names[1]] = geom.packRGBA8( vertex_nparr[:,4:7] )
+    vertices[dtype.names[2]] = vertex_nparr[:,3]
+    return vertices
+
+# Instanced drawing of cylinder-like decorations.  Rather than two full vertices
+# per primitive for a geometry shader to expand, each primitive is one instance
+# of a static 14-vertex triangle strip around a unit box, with a 32-byte row of
+# per-instance attributes (INSTANCE_DTYPE) that the vertex shader uses to place
+# the box around it; see shaders/cylinder_instanced.vert.  The instance color
+# is a palette slot, or without a palette, RGBA8 packed by geom.packRGBA8.
+
+# Box corners visited by the triangle strip, as (right, up, out) flags, in the
+# order used by the imposter geometry shaders
+BOX_STRIP_CORNERS = np.array( [ [0, 1, 1], [1, 1, 1], [0, 0, 1], [1, 0, 1], [1, 0, 0], [1, 1, 1], [1, 1, 0],
+                                [0, 1, 1], [0, 1, 0], [0, 0, 1], [0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0] ],
+                              dtype=np.float32 )
+
+INSTANCE_DTYPE = np.dtype( [ ('instanceBase', np.float32, 3), ('instanceEnd', np.float32, 3),
+                             ('radius', np.float32), ('instanceColor', np.uint32) ] )
+
+def instanceArray( vertex_nparr ):
+    '''
+    Per-instance rows of INSTANCE_DTYPE for (2N,7) endpoint vertex rows, or
+    (2N,5) rows with palette slots
+    '''
+    instances = np.empty( len(vertex_nparr) // 2, dtype=INSTANCE_DTYPE )
+    instances['instanceBase'] = vertex_nparr[0::2,0:3]
+    instances['instanceEnd'] = vertex_nparr[1::2,0:3]
+    instances['radius'] = vertex_nparr[0::2,3]
+    if vertex_nparr.shape[1] == 5:
+        instances['instanceColor'] = vertex_nparr[0::2,4]
+    else:
+        instances['instanceColor'] = geom.packRGBA8( vertex_nparr[0::2,4:7] )
+    return instances
+
+class InstancedDecorationChunk(DecorationChunk):
+    '''
+    A DecorationChunk of cylinder-like primitives, each drawn as an instance of
+    one box
+    '''
+    def _buildGeometry( self, vertex_nparr, corners, decorations ):
+        instances = instanceArray( vertex_nparr )
+        self.count = len(instances)
+
+        self.inst_attrs = geom.buildStructuredAttrs( self, instances, divisor=1 )
+        for ia in self.inst_attrs:
+            self.geometry.addAttribute(ia)
+
+        # The box's vertex attributes.  The position attribute is not read by
+        # the shaders; it holds the chunk's corners, for Qt3D's bounding volume.
+        box = np.empty( [len(BOX_STRIP_CORNERS), 6], dtype=np.float32 )
+        box[:,0:3] = BOX_STRIP_CORNERS
+        box[:,3:6] = np.resize( corners, (len(BOX_STRIP_CORNERS), 3) )
+        attrspecs = [geom.AttrSpec('boxCorner', column=0, numcols=3),
+                     geom.AttrSpec(Qt3DRender.QAttribute.defaultPositionAttributeName(), column=3, numcols=3)]
+        for va in geom.buildVertexAttrs( self, box, attrspecs ):
+            self.geometry.addAttribute(va)
 
-class CylinderDecorations(Qt3DCore.QEntity):
+        self.renderer.setPrimitiveType(Qt3DRender.QGeometryRenderer.TriangleStrip)
+        self.renderer.setVertexCount(len(BOX_STRIP_CORNERS))
+        self.renderer.setInstanceCount(self.count)
+        self.nbytes = instances.nbytes + box.nbytes
 
-    def __init__(self, parent, bildfile, transform=None):
+    def setColor( self, rgb ):
+        '''Recolor every primitive in this chunk'''
+        instances = geom.bufferArray( self.inst_attrs[0].buffer(), INSTANCE_DTYPE )
+        if( self.decorations.palette ):
+            instances['instanceColor'] = self.decorations.paletteSlot( rgb )
+        else:
+            instances['instanceColor'] = geom.packRGBA8( np.atleast_2d( rgb ) )
+        self.inst_attrs[0].buffer().setData( geom.arrayToQByteArray( instances ) )
+
+    def vertexRows( self ):
+        '''The (x, y, z, radius, colors) endpoint rows of this chunk's instances'''
+        instances = geom.bufferArray( self.inst_attrs[0].buffer(), INSTANCE_DTYPE )
+        palette = self.decorations.palette is not None
+        rows = np.empty( [2 * self.count, 5 if palette else 7], dtype=np.float32 )
+        rows[0::2,0:3] = instances['instanceBase']
+        rows[1::2,0:3] = instances['instanceEnd']
+        rows[:,3] = np.repeat( instances['radius'], 2 )
+        if( palette ):
+            rows[:,4] = np.repeat( instances['instanceColor'], 2 )
+        else:
+            rows[:,4:7] = np.repeat( geom.unpackRGBA8( instances['instanceColor'] ), 2, axis=0 )
+        return rows
+
+class ChunkedDecorations(Qt3DCore.QEntity):
+    '''
+    Base class for imposter decorations, drawn from vertex rows of
+    (x, y, z, radius, r, g, b) split into octree chunks
+
+    Cylinder-like decorations, with two vertices per primitive, may be drawn
+    instanced instead (see InstancedDecorationChunk), and other vertices may
+    be stored compactly (see compactVertices).  Given a DecorationPalette with
+    room for their colors, vertex rows are (x, y, z, radius, palette slot)
+    instead; otherwise palette is left as None.  Either way they need a
+    material with the matching shaders.
+
+    Subclasses take a bild file and optionally variants, more bild files with
+    the same primitives in other colors.  The variants' colors go into the
+    palette, in a group named by the parent entity; without room in the
+    palette, only the first bild file's colors are drawn.  variantCopy()
+    splits palette decorations back into one set per variant.
+    '''
+    # Overridden in subclasses
+    radius_attrname = 'radius'
+    vertices_per_primitive = 2
+    primitive_type = Qt3DRender.QGeometryRenderer.Lines
+
+    def __init__(self, parent, instanced=False, compact=False, palette=None, group=None):
         super().__init__(parent)
-        # Draw the arrow bodies as cylinders too
-        cylinderlist = bildfile.cylinders + list( bildfile.cylindersFromArrows() )
-        num_cylinders = len(cylinderlist)
+        self.compact = compact
+        self.palette = palette
+        self.group = group
+        self.variant_count = 1
+        self.material = None
+        self.chunks = list()
+        self.detail_chunks = list() # the chunks drawing every primitive
+        self.chunk_class = InstancedDecorationChunk if instanced else DecorationChunk
+
+    def _colorColumns( self, bildfiles, color_index ):
+        '''
+        Vertex color columns for primitives with the palette indices
+        color_index(bildfile) in each of bildfiles: a palette slot for their
+        colors in all of them, or rgb from the first one
+        '''
+        variant_colors = np.stack( [ bildfile.colorArray( color_index( bildfile ) ) for bildfile in bildfiles ], axis=1 )
+        if self.palette is not None:
+            slots = self.palette.slotIndices( variant_colors, self.group )
+            if slots is not None:
+                self.variant_count = len(bildfiles)
+                return slots[:,np.newaxis]
+            self.palette = None
+        return variant_colors[:,0]
+
+    def paletteSlot( self, rgb ):
+        '''The palette slot for one rgb color, in every variant'''
+        slots = self.palette.slotIndices( np.broadcast_to( rgb, (1, self.variant_count, 3) ), self.group )
+        if slots is None:
+            raise ValueError( 'No room in the decoration palette for color {}'.format( tuple(rgb) ) )
+        return slots[0]
+
+    def _buildChunks( self, parent, vertex_nparr ):
+        '''Add the octree entities for vertex_nparr under parent entity, returning the new chunks'''
+        k = self.vertices_per_primitive
+        primitives = vertex_nparr.reshape( -1, k, vertex_nparr.shape[1] )
+        first = len(self.chunks)
+
+        def build( entity, node ):
+            if isinstance( node, list ):
+                node_entity = Qt3DCore.QEntity( entity )
+                for child in node:
+                    build( node_entity, child )
+            else:
+                self.chunks.append( self.chunk_class( entity, primitives[node].reshape( -1, vertex_nparr.shape[1] ), self ) )
+
+        build( parent, octreeChunks( primitives[:,:,0:3].mean(axis=1) ) )
+        return self.chunks[first:]
+
+    def _setVertices( self, vertex_nparr ):
+        '''Build the chunks for (x, y, z, radius, colors) vertex rows, already transformed'''
+        self.detail_chunks = self._buildChunks( self, vertex_nparr )
+
+    def vertexRows( self ):
+        '''The vertex rows of every primitive, read back from the chunks'''
+        return np.concatenate( [ chunk.vertexRows() for chunk in self.detail_chunks ] )
+
+    def variantCopy( self, parent, variant ):
+        '''
+        A copy of these palette decorations under parent, drawn with the rgb
+        colors of one of their variants instead of palette slots
+        '''
+        copy = type(self).__new__( type(self) )
+        ChunkedDecorations.__init__( copy, parent, self.chunk_class is InstancedDecorationChunk, self.compact )
+        if( self.detail_chunks ):
+            rows = self.vertexRows()
+            vertex_nparr = np.empty( [len(rows), 7], dtype=np.float32 )
+            vertex_nparr[:,0:4] = rows[:,0:4]
+            vertex_nparr[:,4:7] = self.palette.variantColors( rows[:,4].astype(np.intp), variant )
+            copy._setVertices( vertex_nparr )
+        return copy
+
+    def setMaterial( self, material ):
+        self.material = material
+        for chunk in self.chunks:
+            chunk.addComponent( material )
+
+    def memoryUsage( self ):
+        '''Bytes of vertex data held by all chunks, on the GPU and again on the host'''
+        return sum( chunk.memoryUsage() for chunk in self.chunks )
+
+    def chunksInBox( self, lo, hi ):
+        '''The chunks whose bounding boxes overlap the box from lo to hi'''
+        return [ chunk for chunk in self.chunks if np.all( chunk.lo <= hi ) and np.all( chunk.hi >= lo ) ]
+
+class SphereDecorations(ChunkedDecorations):
+
+    radius_attrname = 'sphereRadius'
+    vertices_per_primitive = 1
+    primitive_type = Qt3DRender.QGeometryRenderer.Points
+    levels = ()
+    level = 0
+    coarse_entity = None
+
+    def __init__(self, parent, bildfile, transform=None, compact=False, palette=None, variants=()):
+        super().__init__(parent, compact=compact, palette=palette, group=parent if variants else None)
+        spheres = bildfile.spheres
+        num_spheres = len(spheres)
 
-        if num_cylinders == 0: return
+        if num_spheres == 0: return
 
-        total_vertices = 2 * num_cylinders
+        total_vertices = num_spheres
         vertex_basetype = geom.basetypes.Float
-        if( total_vertices < 30000 ):
-            index_basetype = geom.basetypes.UnsignedShort
-        else:
-            index_basetype = geom.basetypes.UnsignedInt
 
-        vertex_nparr = np.zeros([total_vertices,7],dtype=geom.basetype_numpy_codes[vertex_basetype])
-        for idx, (color, x1, y1, z1, x2, y2, z2, r) in enumerate(cylinderlist):
-            if color is None: color = QColor('white')
-            vertex_nparr[2*idx,:] = x1, y1, z1, r, color.redF(), color.greenF(), color.blueF()
-            vertex_nparr[2*idx+1,:] = x2, y2, z2, r, color.redF(), color.greenF(), color.blueF()
+        colors = self._colorColumns( [bildfile, *variants], lambda b: b.spheres.color_index )
+        vertex_nparr = np.empty([total_vertices,4+colors.shape[1]],dtype=geom.basetype_numpy_codes[vertex_basetype])
+        vertex_nparr[:,0:4] = spheres.data
+        vertex_nparr[:,4:] = colors
 
         if( transform ):
             vertex_nparr[:,0:3] = transform(vertex_nparr[:,0:3])
@@ -93,82 +598,85 @@ class CylinderDecorations(Qt3DCore.QEntity):
             scale = transform(np.ones((1,3)))[0,0]
             vertex_nparr[:,3] *= scale
 
-        self.geometry = Qt3DRender.QGeometry(self)
-
-        position_attrname = Qt3DRender.QAttribute.defaultPositionAttributeName()
-        radius_attrname = 'radius'
-        color_attrname = Qt3DRender.QAttribute.defaultColorAttributeName()
-
-        attrspecs = [geom.AttrSpec(position_attrname, column=0, numcols=3),
-                     geom.AttrSpec(radius_attrname, column=3, numcols=1),
-                     geom.AttrSpec(color_attrname, column=4, numcols=3)]
+        self._setVertices( vertex_nparr )
+
+    def _setVertices( self, vertex_nparr ):
+        self.detail_entity = Qt3DCore.QEntity( self )
+        self.detail_chunks = self._buildChunks( self.detail_entity, vertex_nparr )
+        # The cell size of each level of detail, with the full set first.  Only
+        # the cell sizes are kept; a decimated level is built when it is first
+        # shown, from the vertices read back from the full set, and dropped
+        # again when another level is shown.
+        self.levels = [0.0] + [ cell_size for cell_size, _ in sphereLevels( self.vertexRows() ) ]
+
+    def _showLevel( self, level ):
+        if( self.coarse_entity ):
+            self.coarse_entity.deleteLater()
+            self.coarse_entity = None
+            self.chunks = list( self.detail_chunks )
+        if( level ):
+            _, level_nparr = sphereLevels( self.vertexRows() )[level - 1]
+            self.coarse_entity = Qt3DCore.QEntity( self )
+            self._buildChunks( self.coarse_entity, level_nparr )
+        self.detail_entity.setEnabled( level == 0 )
+        self.level = level
+
+    def setPixelSize( self, pixel_size ):
+        '''
+        Draw the coarsest level of detail whose grid cells are at most
+        LOD_CELL_PIXELS wide, given the size of a screen pixel in world units
+        '''
+        level = 0
+        for idx, cell_size in enumerate( self.levels ):
+            if cell_size <= LOD_CELL_PIXELS * pixel_size:
+                level = idx
+        if( level != self.level ):
+            self._showLevel( level )
+
+class CylinderDecorations(ChunkedDecorations):
+
+    def __init__(self, parent, bildfile, transform=None, instanced=False, compact=False, palette=None, variants=()):
+        super().__init__(parent, instanced, compact, palette, parent if variants else None)
+        # Draw the arrow bodies as cylinders too
+        arrow_data, _ = bildfile.arrowCylinders()
+        cylinder_data = np.concatenate( [ bildfile.cylinders.data, arrow_data ] )
+        num_cylinders = len(cylinder_data)
 
-        self.vtx_attrs = geom.buildVertexAttrs( self, vertex_nparr, attrspecs )
-        for va in self.vtx_attrs:
-            self.geometry.addAttribute(va)
+        if num_cylinders == 0: return
 
-        # Create qt3d index buffer
-        index_nparr = np.arange(len(vertex_nparr),dtype=geom.basetype_numpy_codes[index_basetype])
-        self.indexAttr = geom.buildIndexAttr( self, index_nparr )
-        self.geometry.addAttribute(self.indexAttr)
+        cylinder_colors = self._colorColumns( [bildfile, *variants],
+                                              lambda b: np.concatenate( [ b.cylinders.color_index, b.arrows.color_index ] ) )
+        vertex_basetype = geom.basetypes.Float
+        vertex_nparr = _endpointVertices( cylinder_data, cylinder_colors, geom.basetype_numpy_codes[vertex_basetype] )
 
-        self.renderer = Qt3DRender.QGeometryRenderer(parent)
-        self.renderer.setGeometry(self.geometry)
-        self.renderer.setPrimitiveType(Qt3DRender.QGeometryRenderer.Lines)
+        if( transform ):
+            vertex_nparr[:,0:3] = transform(vertex_nparr[:,0:3])
+            # Transform radii by the equivalent scaling factor (assume it's equal in all dimensions)
+            scale = transform(np.ones((1,3)))[0,0]
+            vertex_nparr[:,3] *= scale
 
-        self.addComponent(self.renderer)
+        self._setVertices( vertex_nparr )
 
-class ConeDecorations(Qt3DCore.QEntity):
+class ConeDecorations(ChunkedDecorations):
 
-    def __init__(self, parent, bildfile, transform=None):
-        super().__init__(parent)
-        conelist = list( bildfile.conesFromArrows() )
-        num_cones = len(conelist)
+    def __init__(self, parent, bildfile, transform=None, instanced=False, compact=False, palette=None, variants=()):
+        super().__init__(parent, instanced, compact, palette, parent if variants else None)
+        cone_data, _ = bildfile.arrowCones()
+        num_cones = len(cone_data)
 
         if num_cones == 0: return
 
-        total_vertices = 2 * num_cones
+        cone_colors = self._colorColumns( [bildfile, *variants], lambda b: b.arrows.color_index )
         vertex_basetype = geom.basetypes.Float
-        if( total_vertices < 30000 ):
-            index_basetype = geom.basetypes.UnsignedShort
-        else:
-            index_basetype = geom.basetypes.UnsignedInt
-
-        vertex_nparr = np.zeros([total_vertices,7],dtype=geom.basetype_numpy_codes[vertex_basetype])
-        for idx, (color, x1, y1, z1, x2, y2, z2, r) in enumerate(conelist):
-            if color is None: color = QColor('white')
-            vertex_nparr[2*idx,:] = x1, y1, z1, r, color.redF(), color.greenF(), color.blueF()
-            vertex_nparr[2*idx+1,:] = x2, y2, z2, 0, color.redF(), color.greenF(), color.blueF()
+        vertex_nparr = _endpointVertices( cone_data, cone_colors,
+                                          geom.basetype_numpy_codes[vertex_basetype], tip_radius=0 )
 
         if( transform ):
             vertex_nparr[:,0:3] = transform(vertex_nparr[:,0:3])
             scale = transform(np.ones((1,3)))[0,0]
             vertex_nparr[:,3] *= scale
 
-        self.geometry = Qt3DRender.QGeometry(self)
-
-        position_attrname = Qt3DRender.QAttribute.defaultPositionAttributeName()
-        radius_attrname = 'radius'
-        color_attrname = Qt3DRender.QAttribute.defaultColorAttributeName()
-
-        attrspecs = [geom.AttrSpec(position_attrname, column=0, numcols=3),
-                     geom.AttrSpec(radius_attrname, column=3, numcols=1),
-                     geom.AttrSpec(color_attrname, column=4, numcols=3)]
-
-        self.vtx_attrs = geom.buildVertexAttrs( self, vertex_nparr, attrspecs )
-        for va in self.vtx_attrs:
-            self.geometry.addAttribute(va)
-
-        # Create qt3d index buffer
-        index_nparr = np.arange(len(vertex_nparr),dtype=geom.basetype_numpy_codes[index_basetype])
-        self.indexAttr = geom.buildIndexAttr( self, index_nparr )
-        self.geometry.addAttribute(self.indexAttr)
-
-        self.renderer = Qt3DRender.QGeometryRenderer(parent)
-        self.renderer.setGeometry(self.geometry)
-        self.renderer.setPrimitiveType(Qt3DRender.QGeometryRenderer.Lines)
-
-        self.addComponent(self.renderer)
+        self._setVertices( vertex_nparr )
 
 class LineDecoration(Qt3DCore.QEntity):
 
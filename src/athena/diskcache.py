@@ -0,0 +1,91 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+
+# A small persistent cache used to keep expensive results (triangulated meshes,
+# tool outputs) between Athena sessions.
+#
+# Each cache entry is a directory named by its key.  Entries are written to a
+# temporary directory first and renamed into place, so a directory that exists
+# under its key is always complete.  Directory modification times record when
+# an entry was last used, and the least-recently-used entries are deleted
+# whenever the cache grows beyond its size limit.
+
+def hashFile( filepath, chunk_size = 1 << 20 ):
+    '''Return the hex sha1 digest of a file's contents'''
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter( lambda: f.read(chunk_size), b'' ):
+            digest.update( chunk )
+    return digest.hexdigest()
+
+def _entrySize( entry ):
+    return sum( f.stat().st_size for f in entry.rglob('*') if f.is_file() )
+
+class DiskCache:
+    '''
+    A size-bounded directory of cache entries with least-recently-used eviction
+    '''
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+
+    def _entries(self):
+        if not self.root.is_dir(): return []
+        return [ p for p in self.root.iterdir() if p.is_dir() and not p.name.startswith('.') ]
+
+    def get( self, key ):
+        '''
+        Return the directory of the entry for key, or None if there is none.
+        A successful lookup marks the entry as most recently used.
+        '''
+        entry = self.root / key
+        if not entry.is_dir():
+            return None
+        try:
+            os.utime( entry )
+        except OSError:
+            pass
+        return entry
+
+    def put( self, key, populate ):
+        '''
+        Create the entry for key by calling populate(directory), which
+        should write the entry's files into the given directory.
+        Returns the directory of the new entry.
+        '''
+        self.root.mkdir( parents=True, exist_ok=True )
+        staging = Path( tempfile.mkdtemp( prefix='.'+key, dir=self.root ) )
+        try:
+            populate( staging )
+            entry = self.root / key
+            try:
+                staging.rename( entry )
+            except OSError:
+                # Another Athena process has already stored this entry
+                if not entry.is_dir(): raise
+        finally:
+            if staging.exists():
+                shutil.rmtree( staging, ignore_errors=True )
+        self.evict( keep=entry )
+        return entry
+
+    def evict( self, keep=None ):
+        '''Delete least-recently-used entries until the cache fits within max_bytes'''
+        entries = [ (e.stat().st_mtime, _entrySize(e), e) for e in self._entries() ]
+        entries.sort( key=lambda x: x[0] )
+        total = sum( size for _, size, _ in entries )
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree( entry, ignore_errors=True )
+            total -= size
+
+    def clear( self ):
+        for entry in self._entries():
+            shutil.rmtree( entry, ignore_errors=True )
@@ -1,4 +1,3 @@
-import struct
 import itertools
 from collections import namedtuple
 
@@ -47,21 +46,69 @@ def rotateAround( v1, v2, angle ):
 
 AttrSpec = namedtuple('AttrSpec', 'name, column, numcols')
 
+def uploadBasetype( array ):
+    '''
+    Check that a numpy array can be handed to Qt3D as-is, and return its Qt3D base type
+
+    Raises TypeError for dtypes Qt3D has no base type for, and ValueError
+    for arrays that are not C-contiguous.
+    '''
+    basetype = basetype_numpy_codes_reverse.get( array.dtype.type )
+    if basetype is None:
+        raise TypeError( 'No Qt3D vertex base type for numpy dtype {}'.format(array.dtype) )
+    if not array.flags.c_contiguous:
+        raise ValueError( 'Arrays uploaded to Qt3D must be C-contiguous' )
+    return basetype
+
+def arrayToQByteArray( array ):
+    '''
+    Copy a C-contiguous numpy array into a new QByteArray
+
+    The array's memory is copied directly into storage owned by the QByteArray,
+    without first building an intermediate python bytes object (as
+    array.tobytes() would).  Structured arrays are copied whole, for
+    buildStructuredAttrs.
+    '''
+    if array.dtype.names is None:
+        uploadBasetype( array )
+    elif not array.flags.c_contiguous:
+        raise ValueError( 'Arrays uploaded to Qt3D must be C-contiguous' )
+    byte_array = QByteArray()
+    byte_array.resize( array.nbytes )
+    # QByteArray exposes its storage through the python buffer protocol (checked
+    # with PySide2 5.12.3, the pinned version)
+    try:
+        view = memoryview( byte_array )
+    except TypeError:
+        view = None
+    if view is None or view.readonly:
+        _warnByteArrayCopy()
+        return QByteArray( array.tobytes() )
+    dest = np.frombuffer( view, dtype=np.uint8 )
+    dest[:] = array.reshape(-1).view(np.uint8)
+    return byte_array
+
+_warned_byte_array_copy = False
+
+def _warnByteArrayCopy():
+    global _warned_byte_array_copy
+    if not _warned_byte_array_copy:
+        print( 'Warning: this PySide2 has no writable QByteArray buffer; vertex data will be copied twice on upload' )
+        _warned_byte_array_copy = True
+
 def buildVertexAttrs(parent, array, attrspecs ):
 
     # Measure the input array
     rows = len(array)
     columns = len(array[0])
-    basetype = basetype_numpy_codes_reverse[array.dtype.type]
+    basetype = uploadBasetype( array )
     basetype_width = basetype_widths[ basetype ]
     row_width = columns * basetype_width
     #print(columns, rows, basetype, basetype_width, row_width)
 
     # Convert input to a qt buffer
-    rawstring = array.tobytes()
-    byte_array = QByteArray(rawstring)
     qbuffer = Qt3DRender.QBuffer(parent)
-    qbuffer.setData(byte_array)
+    qbuffer.setData( arrayToQByteArray(array) )
 
     attrs = list()
     for asp in attrspecs:
@@ -77,17 +124,58 @@ def buildVertexAttrs(parent, array, attrspecs ):
         attrs.append(attr)
     return attrs
 
+def buildStructuredAttrs( parent, array, divisor=0 ):
+    '''
+    Vertex attributes sharing one interleaved buffer, one for each field of a
+    structured numpy array and named after it
+
+    Unlike buildVertexAttrs, fields may have different base types.  A nonzero
+    divisor makes the attributes per-instance, advancing once every divisor
+    instances.
+    '''
+    qbuffer = Qt3DRender.QBuffer(parent)
+    qbuffer.setData( arrayToQByteArray(array) )
+
+    attrs = list()
+    for name in array.dtype.names:
+        field, offset = array.dtype.fields[name][0:2]
+        basetype = basetype_numpy_codes_reverse.get( field.base.type )
+        if basetype is None:
+            raise TypeError( 'No Qt3D vertex base type for field {} of dtype {}'.format(name, field) )
+        attr = Qt3DRender.QAttribute( parent )
+        attr.setName( name )
+        attr.setVertexBaseType( basetype )
+        attr.setVertexSize( int( np.prod( field.shape ) ) )
+        attr.setAttributeType(Qt3DRender.QAttribute.VertexAttribute)
+        attr.setBuffer(qbuffer)
+        attr.setByteStride(array.dtype.itemsize)
+        attr.setByteOffset(offset)
+        attr.setCount(len(array))
+        attr.setDivisor(divisor)
+        attrs.append(attr)
+    return attrs
+
+def packRGBA8( colors, alpha=1.0 ):
+    '''
+    Pack an (N,3) array of rgb colors in [0,1] into uint32 RGBA8 values, with
+    red in the lowest byte
+    '''
+    rgb = np.rint( np.clip( colors, 0, 1 ) * 255 ).astype( np.uint32 )
+    a = np.uint32( round( alpha * 255 ) )
+    return rgb[:,0] | (rgb[:,1] << 8) | (rgb[:,2] << 16) | (a << 24)
+
+def unpackRGBA8( packed ):
+    '''(N,3) float32 rgb colors from the uint32 RGBA8 values of packRGBA8'''
+    packed = np.asarray( packed, dtype=np.uint32 )
+    return np.stack( [ (packed >> shift) & 0xff for shift in (0, 8, 16) ], axis=1 ).astype( np.float32 ) / 255
+
 
 def buildIndexAttr(parent, array):
 
-    basetype = basetype_numpy_codes_reverse[array.dtype.type]
-    basetype_width = basetype_widths[ basetype ]
+    basetype = uploadBasetype( array )
 
-    basetype_width = array.itemsize
-    rawstring = array.tobytes()
-    byte_array = QByteArray(rawstring)
     qbuffer = Qt3DRender.QBuffer(parent)
-    qbuffer.setData(byte_array)
+    qbuffer.setData( arrayToQByteArray(array) )
 
     attr = Qt3DRender.QAttribute(parent)
     attr.setVertexBaseType(basetype)
@@ -98,25 +186,40 @@ def buildIndexAttr(parent, array):
     return attr
 
 
-def iterAttr( att ):
-    '''Iterator over a Qt3DRender.QAttribute'''
-    basetype = att.vertexBaseType()
-    width = basetype_widths[ basetype ]
-    struct_code = basetype_struct_codes[ basetype ]
-    att_data = att.buffer().data().data()
-    byteOffset = att.byteOffset()
-    byteStride = att.byteStride()
-    count = att.count()
-    vertex_size = att.vertexSize()
-    #print( width, struct_code, byteOffset, byteStride, vertex_size, count )
+def attributeArray( att ):
+    '''
+    A read-only (count, vertex_size) numpy view over a Qt3DRender.QAttribute
+
+    Honors the attribute's byte offset and stride, so interleaved buffers are
+    viewed in place rather than unpacked value by value.
+    '''
+    dtype = np.dtype( basetype_numpy_codes[ att.vertexBaseType() ] )
     # Support index attributes, which report zero stride and size
-    if byteStride == 0:
-        byteStride = width
-    if vertex_size == 0:
-        vertex_size = 1
-    for i in range (byteOffset, byteOffset + byteStride * count, byteStride ):
-        datum = struct.unpack( struct_code*vertex_size, bytes(att_data[i:i+(width*vertex_size)]) )
-        yield datum
+    vertex_size = att.vertexSize() or 1
+    stride = att.byteStride() or dtype.itemsize * vertex_size
+    byte_array = att.buffer().data()
+    try:
+        raw = np.frombuffer( memoryview( byte_array ), dtype=np.uint8 )
+    except TypeError:
+        raw = np.frombuffer( byte_array.data(), dtype=np.uint8 )
+    view = np.ndarray( shape=(att.count(), vertex_size), dtype=dtype, buffer=raw,
+                       offset=att.byteOffset(), strides=(stride, dtype.itemsize) )
+    view.flags.writeable = False
+    return view
+
+def bufferArray( qbuffer, dtype, row_shape=() ):
+    '''A writable copy of the data in a Qt3DRender.QBuffer, as rows of the given dtype and shape'''
+    byte_array = qbuffer.data()
+    try:
+        raw = np.frombuffer( memoryview( byte_array ), dtype=np.uint8 )
+    except TypeError:
+        raw = np.frombuffer( byte_array.data(), dtype=np.uint8 )
+    return raw.view( dtype ).reshape( (-1,) + tuple(row_shape) ).copy()
+
+def iterAttr( att ):
+    '''Iterator over a Qt3DRender.QAttribute, yielding a tuple per vertex'''
+    for datum in attributeArray( att ).tolist():
+        yield tuple( datum )
 
 def grouper(i, n):
     '''from the itertools recipe list: yield n-sized lists of items from iterator i'''
@@ -140,42 +243,47 @@ def dumpGeometry( geom, dumpf=print ):
         basetype = att.vertexBaseType()
         dumpf('{type} "{name}" '.format( type=str(att_type).split('AttributeType.')[-1], name=att.name()), end='' )
         dumpf( 'with base type {basetype}'.format(basetype = str(basetype).split('BaseType.')[-1]) )
-        width = basetype_widths[ basetype ]
-        code = basetype_struct_codes[ basetype ]
+        data = attributeArray( att )
 
         if( att_type == Qt3DRender.QAttribute.AttributeType.VertexAttribute ):
-            for vtx in iterAttr( att ):
-                dumpf(vtx)
+            for vtx in data.tolist():
+                dumpf(tuple(vtx))
         elif att_type == Qt3DRender.QAttribute.AttributeType.IndexAttribute :
             count = att.count()
             num_tris = int(count / 3)
             dumpf( num_tris, "triangles" )
-            for tri in grouper(iterAttr(att), 3):
-                dumpf(tri)
+            for tri in data[:num_tris*3].reshape(-1, 3).tolist():
+                dumpf(tuple(tri))
+
 class AABB:
     '''
     An axis-aligned bounding box around the given geometry
+
+    The geometry may be an (N,3) numpy array of points, something like
+    bildparser.OutputDecorations, or a Qt3D geometry with a position attribute.
     '''
     def __init__(self, geom):
-        if hasattr(geom, 'allVertices'):
+        if isinstance(geom, np.ndarray):
+            xyz = geom
+        elif hasattr(geom, 'vertexArray'):
             # Something lke bildparser.OutputDecorations
-            it = geom.allVertices()
+            xyz = geom.vertexArray()
         else:
             # assume it's a qt3d geometry
-            vertices = getQAttribute( geom, att_name = Qt3DRender.QAttribute.defaultPositionAttributeName() )
-            it = iterAttr(vertices)
-        v0 = next(it)
-        self.min = vec3d( v0[0], v0[1], v0[2])
-        self.max = vec3d( self.min  )
-        for v in it:
-            self.min.setX( min( self.min.x(), v[0] ) )
-            self.min.setY( min( self.min.y(), v[1] ) )
-            self.min.setZ( min( self.min.z(), v[2] ) )
-            self.max.setX( max( self.max.x(), v[0] ) )
-            self.max.setY( max( self.max.y(), v[1] ) )
-            self.max.setZ( max( self.max.z(), v[2] ) )
+            xyz = attributeArray( getQAttribute( geom, att_name = Qt3DRender.QAttribute.defaultPositionAttributeName() ) )
+        xyz = xyz[:,0:3]
+        self.min = vec3d( *( float(x) for x in np.min( xyz, axis=0 ) ) )
+        self.max = vec3d( *( float(x) for x in np.max( xyz, axis=0 ) ) )
         self.center = (self.min+self.max) / 2.0
 
+    def copy(self):
+        '''A new AABB with its own min, max, and center vectors'''
+        ret = AABB.__new__(AABB)
+        ret.min = vec3d( self.min )
+        ret.max = vec3d( self.max )
+        ret.center = vec3d( self.center )
+        return ret
+
     def iterCorners(self, cons = vec3d):
         '''
         Iterator over the eight corners of the AABB.
@@ -0,0 +1,309 @@
+import sys
+import os
+import os.path
+import codecs
+import hashlib
+import inspect
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from PySide2.QtCore import QProcess, QTimer, Signal
+
+from athena import diskcache, ATHENA_DIR, ATHENA_OUTPUT_HOME, ATHENA_CACHE_DIR
+
+# Support for running the LCBB sequence design tools (PERDIX, TALOS, DAEDALUS2,
+# and METIS), either to completion with runLCBBTool or in the background with
+# an LCBBToolProcess.  Both produce a subprocess.CompletedProcess-like result,
+# with extra toolinfo, bildfiles, cndofile, output_dir, and cached attributes.
+
+# Successful tool runs are cached on disk, keyed by the contents of the tool
+# binary, input file, and scaffold file, along with all other parameters, so
+# that repeating a run just copies its outputs back into place.  The cache size
+# can be set in megabytes with the ATHENA_TOOL_CACHE_MB environment variable.
+# Bump TOOL_CACHE_FORMAT whenever the layout of cache entries changes.
+TOOL_CACHE_FORMAT = 1
+TOOL_CACHE_MAX_BYTES = int( os.environ.get('ATHENA_TOOL_CACHE_MB', 2048) ) * 1024 * 1024
+
+tool_cache = diskcache.DiskCache( ATHENA_CACHE_DIR / 'tools', TOOL_CACHE_MAX_BYTES )
+
+def parseLCBBToolOutput( output ):
+    # Find and parse the scaling factor from text with a format like this:
+    # 2.7. Find the scale factor to adjust polyhedra size
+    #   * The minumum edge length     : 42
+    #   * Scale factor to adjust size : .196
+    # Also hunt for any show-stopping error message
+    result = dict()
+    iter_out = iter(output.split('\n'))
+    for line in iter_out:
+        if line.strip().startswith('2.7.'):
+            line27a = next(iter_out)
+            line27b = next(iter_out)
+            result['edge_length'] = float( line27a.split(':')[1].strip() )
+            result['scale_factor'] = float( line27b.split(':')[1].strip() )
+        if line.strip().startswith('+=== error'):
+            errline = next(iter_out).strip().strip('|').strip()
+            print("found error", errline)
+            result['error'] = errline
+    return result
+
+def lcbbToolPath( toolname ):
+    '''Path to the executable for an LCBB tool on this platform'''
+    tooldir = toolname
+    if platform.system() ==  'Windows':
+        tool = '{}.exe'.format(toolname)
+    elif platform.system() == 'Darwin':
+        tool = toolname
+    else:
+        print("WARNING: unknown platform '{}' for LCBB tool!".format(platform.system()), file=sys.stderr)
+        tool = toolname
+    wd = os.path.join( ATHENA_DIR, 'tools', tooldir )
+    return os.path.join( wd, tool )
+
+_input_copy_dir = None
+
+def _inputCopyDir():
+    '''
+    The directory for temporary copies of read-only input files: the temporary
+    output dir, which athena_cleanup() removes, or without one (with a
+    persistent workspace), a temporary directory removed at exit
+    '''
+    global _input_copy_dir
+    if ATHENA_OUTPUT_HOME:
+        return ATHENA_OUTPUT_HOME.name
+    if _input_copy_dir is None:
+        _input_copy_dir = tempfile.TemporaryDirectory( prefix='AthenaInputs' )
+    return _input_copy_dir.name
+
+def lcbbToolCall( toolname, p2_input_file, p1_output_dir=Path('athena_tmp_output'),
+                  p3_scaffold='m13', p4_edge_sections=1, p5_vertex_design=1, p6_edge_number=0,
+                  p7_edge_length=42, p8_mesh_spacing=0.0, p9_runmode='s' ):
+    '''The command line, as a list of strings, that runs an LCBB tool with the given parameters'''
+    toolpath = lcbbToolPath( toolname )
+
+    # Tools have problems reading files on read-only partitions, so workaround that.
+    # This occurs commonly under OSX app translocation
+    if hasattr(os, 'statvfs'): # There's no statvfs on Windows
+        in_file_stat = os.statvfs( p2_input_file )
+        if( bool(in_file_stat.f_flag & os.ST_RDONLY ) ):
+            print("Input file is on a read-only filesystem; making temporary copy elsewhere")
+            filestem, fileext = os.path.splitext( os.path.basename( p2_input_file ) )
+            newfile, newfilename = tempfile.mkstemp( suffix=fileext, prefix=filestem, dir=_inputCopyDir() )
+            # mkstemp returns an open file; close it and then copy to its path.
+            os.close(newfile)
+            shutil.copy( p2_input_file, newfilename )
+            p2_input_file = newfilename
+
+    tool_call = [toolpath, p1_output_dir, p2_input_file, p3_scaffold, p4_edge_sections,
+                           p5_vertex_design, p6_edge_number, p7_edge_length, p8_mesh_spacing, p9_runmode]
+    return [str(x) for x in tool_call]
+
+def _findOutputs( result, p1_output_dir ):
+    result.bildfiles = None
+    result.cndofile = None
+    if result.returncode == 0:
+        result.bildfiles = list( p1_output_dir.glob('*.bild') )
+        result.cndofile = next( p1_output_dir.glob('*.cndo') )
+        result.output_dir = p1_output_dir
+    return result
+
+def collectLCBBToolResults( result, p1_output_dir ):
+    '''Fill in the Athena-specific attributes of a finished tool's result'''
+    result.toolinfo= parseLCBBToolOutput( result.stdout )
+    if 'error' in result.toolinfo:
+        # Tool indicated error; override return code
+        result.returncode = 257
+    result.cached = False
+    return _findOutputs( result, p1_output_dir )
+
+_tool_hashes = dict() # maps (path, size, mtime) of tool binaries to their hashes
+
+def _hashTool( toolpath ):
+    stat = os.stat( toolpath )
+    memo_key = (toolpath, stat.st_size, stat.st_mtime)
+    if memo_key not in _tool_hashes:
+        _tool_hashes[memo_key] = diskcache.hashFile( toolpath )
+    return _tool_hashes[memo_key]
+
+def toolCacheKey( toolname, p2_input_file, p1_output_dir=None, **tool_args ):
+    '''
+    The tool cache key for a run of an LCBB tool with the given parameters.
+    Raises OSError if the tool, input, or scaffold file can't be read.
+    '''
+    call = inspect.signature( lcbbToolCall ).bind( toolname, p2_input_file, p1_output_dir, **tool_args )
+    call.apply_defaults()
+    params = dict( call.arguments )
+    del params['p1_output_dir']
+    # Tools name their outputs after the input file, so its name matters as well as its contents
+    params['p2_input_file'] = [ os.path.basename( p2_input_file ), diskcache.hashFile( p2_input_file ) ]
+    if os.path.isfile( str(params['p3_scaffold']) ):
+        params['p3_scaffold'] = diskcache.hashFile( params['p3_scaffold'] )
+    params['tool'] = _hashTool( lcbbToolPath( toolname ) )
+    params['format'] = TOOL_CACHE_FORMAT
+    key_text = json.dumps( params, sort_keys=True, default=str )
+    return hashlib.sha1( key_text.encode('utf8') ).hexdigest()
+
+def restoreToolResult( key, tool_call, p1_output_dir, cache=tool_cache ):
+    '''
+    Copy a cached run's outputs into p1_output_dir and return its result,
+    or return None if the run isn't cached
+    '''
+    entry = cache.get( key )
+    if entry is None:
+        return None
+    stdout = (entry / 'stdout.txt').read_text( encoding='utf8' )
+    result = subprocess.CompletedProcess( tool_call, 0, stdout )
+    result.toolinfo = json.loads( (entry / 'toolinfo.json').read_text() )
+    result.cached = True
+    # Copy into a staging directory beside p1_output_dir, and only replace any
+    # existing outputs once the copy is complete
+    p1_output_dir = Path( p1_output_dir )
+    p1_output_dir.parent.mkdir( parents=True, exist_ok=True )
+    staging = Path( tempfile.mkdtemp( prefix=p1_output_dir.name + '.restoring.', dir=p1_output_dir.parent ) )
+    try:
+        shutil.copytree( entry / 'output', staging / 'output' )
+        if p1_output_dir.exists():
+            shutil.rmtree( p1_output_dir )
+        os.replace( staging / 'output', p1_output_dir )
+    finally:
+        shutil.rmtree( staging, ignore_errors=True )
+    return _findOutputs( result, p1_output_dir )
+
+def storeToolResult( key, result, cache=tool_cache ):
+    '''Cache a tool's result, if it was successful'''
+    if result.returncode != 0:
+        return
+    def populate( entry ):
+        shutil.copytree( result.output_dir, entry / 'output' )
+        (entry / 'stdout.txt').write_text( result.stdout, encoding='utf8' )
+        (entry / 'toolinfo.json').write_text( json.dumps( result.toolinfo ) )
+    try:
+        cache.put( key, populate )
+    except OSError as e:
+        print("Could not cache tool results in {}: {}".format( result.output_dir, e ))
+
+def _cacheKeyOrNone( toolname, p2_input_file, **tool_args ):
+    try:
+        return toolCacheKey( toolname, p2_input_file, **tool_args )
+    except OSError as e:
+        print("Could not compute tool cache key: {}".format( e ))
+        return None
+
+def _restoreOrNone( key, tool_call, p1_output_dir ):
+    try:
+        return restoreToolResult( key, tool_call, p1_output_dir )
+    except (OSError, ValueError, StopIteration) as e:
+        print("Could not restore cached tool results: {}".format( e ))
+        return None
+
+def runLCBBTool( toolname, p2_input_file, p1_output_dir=Path('athena_tmp_output'),
+                 p3_scaffold='m13', p4_edge_sections=1, p5_vertex_design=1, p6_edge_number=0,
+                 p7_edge_length=42, p8_mesh_spacing=0.0, p9_runmode='s', *, use_cache=True ):
+    '''Run an LCBB tool to completion, or restore its outputs from the tool cache'''
+    tool_args = dict( p3_scaffold=p3_scaffold, p4_edge_sections=p4_edge_sections, p5_vertex_design=p5_vertex_design,
+                      p6_edge_number=p6_edge_number, p7_edge_length=p7_edge_length,
+                      p8_mesh_spacing=p8_mesh_spacing, p9_runmode=p9_runmode )
+    tool_call_strs = lcbbToolCall( toolname, p2_input_file, p1_output_dir, **tool_args )
+    key = _cacheKeyOrNone( toolname, p2_input_file, **tool_args ) if use_cache else None
+    if key:
+        result = _restoreOrNone( key, tool_call_strs, p1_output_dir )
+        if result:
+            print('Restored {} results from cache'.format(toolname))
+            return result
+    print('Calling {} as follows'.format(toolname), tool_call_strs)
+    result = subprocess.run(tool_call_strs, text=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+    result = collectLCBBToolResults( result, p1_output_dir )
+    if key:
+        storeToolResult( key, result )
+    return result
+
+class LCBBToolProcess( QProcess ):
+    '''
+    Runs an LCBB tool in the background
+
+    output is emitted with each batch of complete lines the tool writes, and
+    done is emitted with the result once the tool exits, fails to start, or
+    is cancelled.
+    '''
+    output = Signal( str )
+    done = Signal( object )
+
+    def __init__( self, parent, toolname, p2_input_file, p1_output_dir=Path('athena_tmp_output'), *, use_cache=True,
+                  **tool_args ):
+        super().__init__(parent)
+        self.toolname = toolname
+        self.tool_args = dict( tool_args, p1_output_dir=p1_output_dir, p2_input_file=p2_input_file )
+        self.start_time = None
+        self.output_dir = p1_output_dir
+        self.tool_call = lcbbToolCall( toolname, p2_input_file, p1_output_dir, **tool_args )
+        self.cache_key = _cacheKeyOrNone( toolname, p2_input_file, **tool_args ) if use_cache else None
+        self.cancelled = False
+        self._stdout = list()
+        self._partial_line = ''
+        self._decoder = codecs.getincrementaldecoder('utf-8')( errors='replace' )
+        self.setProcessChannelMode( QProcess.MergedChannels )
+        self.readyReadStandardOutput.connect( self._readOutput )
+        self.finished.connect( self._finished )
+        self.errorOccurred.connect( self._error )
+
+    def start( self ):
+        self.start_time = time.time()
+        if self.cache_key:
+            result = _restoreOrNone( self.cache_key, self.tool_call, self.output_dir )
+            if result:
+                # Report on the next pass of the event loop, as a real run would
+                QTimer.singleShot( 0, lambda: self._restored( result ) )
+                return
+        print('Calling {} as follows'.format(self.toolname), self.tool_call)
+        super().start( self.tool_call[0], self.tool_call[1:] )
+
+    def _restored( self, result ):
+        self.output.emit( result.stdout )
+        self.done.emit( result )
+
+    def cancel( self ):
+        '''Kill the tool; done will still be emitted, with a failed result'''
+        if self.state() != QProcess.NotRunning:
+            self.cancelled = True
+            self.kill()
+
+    def _readOutput( self ):
+        text = self._decoder.decode( bytes( self.readAllStandardOutput() ) )
+        self._stdout.append( text )
+        lines = ( self._partial_line + text ).split('\n')
+        self._partial_line = lines.pop()
+        if lines:
+            self.output.emit( '\n'.join(lines) )
+
+    def _result( self, returncode ):
+        stdout = ''.join( self._stdout ) + self._decoder.decode( b'', final=True )
+        result = subprocess.CompletedProcess( self.tool_call, returncode, stdout )
+        return collectLCBBToolResults( result, self.output_dir )
+
+    def _finished( self, exit_code, exit_status ):
+        self._readOutput()
+        if self._partial_line:
+            self.output.emit( self._partial_line )
+            self._partial_line = ''
+        if self.cancelled:
+            result = self._result( -1 )
+            result.toolinfo['error'] = 'cancelled'
+        elif exit_status == QProcess.CrashExit:
+            result = self._result( -1 )
+            result.toolinfo['error'] = 'tool crashed'
+        else:
+            result = self._result( exit_code )
+            if self.cache_key:
+                storeToolResult( self.cache_key, result )
+        self.done.emit( result )
+
+    def _error( self, error ):
+        # Other errors are followed by finished(), but a tool that never started is not
+        if error == QProcess.FailedToStart:
+            result = self._result( -1 )
+            result.toolinfo['error'] = 'could not start {}'.format( self.tool_call[0] )
+            self.done.emit( result )
@@ -6,16 +6,19 @@ import os.path
 import platform
 import shutil
 import tempfile
+import time
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 
 from PySide2.QtUiTools import QUiLoader
-from PySide2.QtWidgets import QMainWindow, QApplication, QLabel, QPushButton, QStatusBar, QFileDialog, QWidget, QSizePolicy, QColorDialog, QStackedWidget, QTreeWidget, QTreeWidgetItem, QHeaderView, QActionGroup, QButtonGroup, QMessageBox, QToolBox
+from PySide2.QtWidgets import QMainWindow, QApplication, QLabel, QPushButton, QStatusBar, QFileDialog, QWidget, QSizePolicy, QColorDialog, QStackedWidget, QTreeWidget, QTreeWidgetItem, QHeaderView, QActionGroup, QButtonGroup, QMessageBox, QToolBox, QMenu
 from PySide2.QtGui import QKeySequence, QPixmap, QIcon, QColor
-from PySide2.QtCore import QFile, Qt, Signal
+from PySide2.QtCore import QFile, Qt, Signal, QThread, QEventLoop
 import PySide2.QtXml #Temporary pyinstaller workaround
 
-from athena import bildparser, viewer, screenshot, geom, ATHENA_DIR, ATHENA_OUTPUT_DIR, ATHENA_SRC_DIR, logwindow, __version__
+from athena import bildparser, viewer, screenshot, geom, lcbbtool, workspace, ATHENA_DIR, ATHENA_OUTPUT_DIR, ATHENA_SRC_DIR, logwindow, __version__
+from athena.lcbbtool import parseLCBBToolOutput, runLCBBTool
 from pdbgen import pdbgen
 
 # Support widgets for AthenaWindow
@@ -92,6 +95,17 @@ class FileSelectionTreeWidget( QTreeWidget ):
         if( force_select ):
             self.setCurrentItem( item )
 
+    def selectFile( self, filepath ):
+        '''Select the item for filepath, adding it as a user file if it isn't listed'''
+        filepath = filepath.resolve()
+        for heading_idx in range( self.topLevelItemCount() ):
+            heading = self.topLevelItem( heading_idx )
+            for idx in range( heading.childCount() ):
+                if heading.child( idx ).data( 0, Qt.UserRole ) == filepath:
+                    self.setCurrentItem( heading.child( idx ) )
+                    return
+        self.addUserFile( filepath, force_select=True )
+
     newFileSelected = Signal( Path )
 
     def handleSelect( self, current_item, previous_item ):
@@ -182,71 +196,6 @@ class UiLoader(QUiLoader):
         finally:
             ui_file.close()
 
-def parseLCBBToolOutput( output ):
-    # Find and parse the scaling factor from text with a format like this: 
-    # 2.7. Find the scale factor to adjust polyhedra size
-    #   * The minumum edge length     : 42
-    #   * Scale factor to adjust size : .196
-    # Also hunt for any show-stopping error message
-    result = dict()
-    iter_out = iter(output.split('\n'))
-    for line in iter_out:
-        if line.strip().startswith('2.7.'):
-            line27a = next(iter_out)
-            line27b = next(iter_out)
-            result['edge_length'] = float( line27a.split(':')[1].strip() )
-            result['scale_factor'] = float( line27b.split(':')[1].strip() )
-        if line.strip().startswith('+=== error'):
-            errline = next(iter_out).strip().strip('|').strip()
-            print("found error", errline)
-            result['error'] = errline
-    return result
-
-
-def runLCBBTool( toolname, p2_input_file, p1_output_dir=Path('athena_tmp_output'),
-                 p3_scaffold='m13', p4_edge_sections=1, p5_vertex_design=1, p6_edge_number=0,
-                 p7_edge_length=42, p8_mesh_spacing=0.0, p9_runmode='s' ):
-    tooldir = toolname
-    if platform.system() ==  'Windows':
-        tool = '{}.exe'.format(toolname)
-    elif platform.system() == 'Darwin':
-        tool = toolname
-    else:
-        print("WARNING: unknown platform '{}' for LCBB tool!".format(platform.system()), file=sys.stderr)
-        tool = toolname
-
-    # Tools have problems reading files on read-only partitions, so workaround that.
-    # This occurs commonly under OSX app translocation
-    if hasattr(os, 'statvfs'): # There's no statvfs on Windows
-        in_file_stat = os.statvfs( p2_input_file )
-        if( bool(in_file_stat.f_flag & os.ST_RDONLY ) ):
-            print("Input file is on a read-only filesystem; making temporary copy elsewhere")
-            filestem, fileext = os.path.splitext( os.path.basename( p2_input_file ) )
-            newfile, newfilename = tempfile.mkstemp( suffix=fileext, prefix=filestem, dir=ATHENA_OUTPUT_DIR)
-            # mkstemp returns an open file; close it and then copy to its path.
-            os.close(newfile)
-            shutil.copy( p2_input_file, newfilename )
-            # Ok to leave new file undeleted because athena_cleanup() will remove ATHENA_OUTPUT_DIR.
-            p2_input_file = newfilename
-
-    wd = os.path.join( ATHENA_DIR, 'tools', tooldir )
-    toolpath = os.path.join( wd, tool )
-    tool_call = [toolpath, p1_output_dir, p2_input_file, p3_scaffold, p4_edge_sections,
-                           p5_vertex_design, p6_edge_number, p7_edge_length, p8_mesh_spacing, p9_runmode]
-    tool_call_strs = [str(x) for x in tool_call]
-
-    print('Calling {} as follows'.format(tool), tool_call_strs)
-    result = subprocess.run(tool_call_strs, text=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-    result.toolinfo= parseLCBBToolOutput( result.stdout )
-    if 'error' in result.toolinfo:
-        # Tool indicated error; override return code
-        result.returncode = 257
-    if result.returncode == 0:
-        result.bildfiles = list( p1_output_dir.glob('*.bild') )
-        result.cndofile = next( p1_output_dir.glob('*.cndo') )
-        result.output_dir = p1_output_dir
-    return result
-
 class AthenaWindow(QMainWindow):
     default_ui_path = os.path.join( ATHENA_DIR, 'ui', 'AthenaMainWindow.ui' )
     def __init__( self, ui_filepath=default_ui_path ):
@@ -257,6 +206,9 @@ class AthenaWindow(QMainWindow):
         self.centralWidget().setAttribute(Qt.WA_AcceptTouchEvents, False)
         #self.centralWidget().setAttribute(Qt.WA_TransparentForMouseEvents, True)
         self.toolresults = None
+        self.bildWorker = None
+        self.bildThread = None
+        self.toolProcess = None
 
         self.statusMsg = QLabel("Ready.")
         self.statusBar().addWidget(self.statusMsg)
@@ -296,6 +248,7 @@ class AthenaWindow(QMainWindow):
         self.setupToolDefaults()
         self.enable2DControls()
 
+        self.toolRunButtonText = self.toolRunButton.text()
         self.toolRunButton.clicked.connect(self.runTool)
         self.saveButton.clicked.connect(self.saveOutput)
 
@@ -307,6 +260,11 @@ class AthenaWindow(QMainWindow):
         self.actionResetViewerOptions.triggered.connect( self.resetDisplayOptions )
         self.actionResetCamera.triggered.connect( self.geomView.resetCamera )
 
+        self.pastRunsMenu = QMenu( 'Past Runs', self )
+        self.menuAthena.insertMenu( self.actionScreenshot, self.pastRunsMenu )
+        self.menuAthena.insertSeparator( self.actionScreenshot )
+        self.pastRunsMenu.aboutToShow.connect( self.populatePastRunsMenu )
+
 
         # action groups cannot be set up in Qt Designer, so do that here
         self.resultsActionGroup = QActionGroup(self)
@@ -523,6 +481,7 @@ class AthenaWindow(QMainWindow):
         self.logWindow.appendText( text )
 
     def newMesh( self, meshFile ):
+        self.stopBildStream()
         if( meshFile ):
             self.log( 'Loading '+str(meshFile) )
             mesh_3d = self.geomView.reloadGeom( meshFile )
@@ -534,38 +493,105 @@ class AthenaWindow(QMainWindow):
         self.toolresults = None
         self.updateStatus('Ready.', log=False)
 
-    def newOutputs( self, toolresults ):
+    def newOutputs( self, toolresults, stream=True ):
+        '''
+        Display the bild files produced by a tool run
+
+        With stream set, the files are parsed chunk by chunk on a worker thread
+        and each chunk is drawn as soon as it arrives, cylinder model first.
+        '''
         if toolresults is None or toolresults.bildfiles is None: return
         scale_factor = toolresults.toolinfo['scale_factor']
+        self.stopBildStream()
         self.geomView.clearDecorations()
         for path in toolresults.bildfiles:
             if path.match('*target_geometry.bild'):
                 base_bild = bildparser.parseBildFile( path, scale_factor )
                 base_aabb = geom.AABB( base_bild )
-        for path in toolresults.bildfiles:
-            if path.match('*_cylinder_model.bild'):
-                self.geomView.setCylDisplay( bildparser.parseBildFile( path ), base_aabb )
-            elif path.match('*_atomic_model_multi.bild'):
-                self.geomView.setAtomDisplay( bildparser.parseBildFile( path ), base_aabb, 0 )
-            elif path.match('*_atomic_model_two.bild'):
-                self.geomView.setAtomDisplay( bildparser.parseBildFile( path ), base_aabb, 1 )
-            elif path.match('*_routing_multi.bild'):
-                self.geomView.setRoutDisplay( bildparser.parseBildFile( path ), base_aabb, 0 )
-            elif path.match('*_routing_two.bild'):
-                self.geomView.setRoutDisplay( bildparser.parseBildFile( path ), base_aabb, 1 )
+        displays = self._bildDisplays( toolresults.bildfiles )
+        if stream:
+            self.bildAABB = base_aabb
+            self.bildDisplays = [ display for path, display in displays ]
+            self.bildThread = QThread(self)
+            self.bildWorker = bildparser.BildStreamWorker( [ path for path, display in displays ] )
+            self.bildWorker.moveToThread( self.bildThread )
+            self.bildThread.started.connect( self.bildWorker.run )
+            self.bildWorker.chunkParsed.connect( self.showBildChunk )
+            self.bildWorker.finished.connect( self.bildStreamFinished )
+            self.bildThread.start()
+        else:
+            for path, display in displays:
+                if isinstance( path, tuple ):
+                    display( [ bildparser.parseBildFile( p ) for p in path ], base_aabb )
+                else:
+                    display( bildparser.parseBildFile( path ), base_aabb )
         self.toggleOutputControls(True)
         self.toolresults = toolresults
         # Request a redraw to avoid a bug where disabled entities might be visible at first
         self.geomView.requestUpdate()
 
+    def _bildDisplays( self, bildfiles ):
+        '''
+        (path, viewer display function) pairs for bild output files, in display order
+
+        When both color variants of a model are present, their paths are paired
+        in a tuple, to be parsed and displayed together.
+        '''
+        displays = [ (path, self.geomView.setCylDisplay) for path in bildfiles if path.match('*_cylinder_model.bild') ]
+        for model, display, display_variants in [ ('routing', self.geomView.setRoutDisplay, self.geomView.setRoutDisplays),
+                                                  ('atomic_model', self.geomView.setAtomDisplay, self.geomView.setAtomDisplays) ]:
+            variant_paths = [ [ path for path in bildfiles if path.match( '*_{}_{}.bild'.format( model, variant ) ) ]
+                              for variant in ('multi', 'two') ]
+            if all( len(paths) == 1 for paths in variant_paths ):
+                displays.append( (tuple( paths[0] for paths in variant_paths ), display_variants) )
+            else:
+                displays += [ (path, partial( display, variant=idx ))
+                              for idx, paths in enumerate( variant_paths ) for path in paths ]
+        return displays
+
+    def showBildChunk( self, worker, index, chunk ):
+        # Ignore chunks still queued from a stream that has since been stopped
+        if worker is not self.bildWorker: return
+        self.bildDisplays[index]( chunk, self.bildAABB )
+        self.geomView.requestUpdate()
+
+    def bildStreamFinished( self, worker ):
+        if worker is self.bildWorker:
+            self.stopBildStream()
+
+    def stopBildStream( self ):
+        '''Cancel any bild files still being streamed, and wait for the worker thread to exit'''
+        if self.bildWorker is None: return
+        self.bildWorker.cancel()
+        self.bildThread.quit()
+        self.bildThread.wait()
+        self.bildWorker.deleteLater()
+        self.bildThread.deleteLater()
+        self.bildWorker = None
+        self.bildThread = None
+
+    def closeEvent( self, event ):
+        self.stopBildStream()
+        if( self.toolProcess ):
+            self.toolProcess.cancel()
+            self.toolProcess.waitForFinished()
+        super().closeEvent( event )
+
+
     def generatePDB( self ):
         if( self.toolresults and self.toolresults.cndofile ):
             cndofile = self.toolresults.cndofile
             dirstr = str(cndofile.parent.resolve()) + os.path.sep
-            pdbgen.pdbgen( cndofile.stem, 'B', 'DNA', dirstr, dirstr, logwindow.WriteWrapper(self.logWindow) )
+            pdbgen.pdbgen( cndofile.stem, 'B', 'DNA', dirstr, dirstr, logwindow.WriteWrapper(self.logWindow),
+                           verbosity=pdbgen.VERBOSITY_QUIET, progress=self.showPDBProgress )
         else:
             print("ERROR: No current pdb file")
 
+    def showPDBProgress( self, stage, fraction ):
+        self.updateStatus( 'Generating PDB: {} ({:.0%})'.format( stage, fraction ), log=False )
+        # pdbgen runs on this thread, so repaint the status bar now
+        QApplication.processEvents( QEventLoop.ExcludeUserInputEvents )
+
     def saveOutput( self ):
         if( self.toolresults ):
             container_dir = QFileDialog.getExistingDirectory(self, "Save Location" )
@@ -591,6 +617,10 @@ class AthenaWindow(QMainWindow):
         return infile_path, outfile_dir_path
 
     def runTool( self ):
+        # While a tool is running, the run button cancels it instead
+        if( self.toolProcess ):
+            self.toolProcess.cancel()
+            return
         tool_chooser = self.toolControls.currentWidget()
         if tool_chooser == self.tools_2D:
             toolkey = (0, self.toolBox_2D.currentIndex() )
@@ -603,65 +633,108 @@ class AthenaWindow(QMainWindow):
 
     def _humanReadableReturnValue( self, process ):
         if process.returncode == 0:
-            human_retval = 'success'
+            human_retval = 'success (from cache)' if process.cached else 'success'
         else:
             msg = process.toolinfo.get('error', process.returncode)
             human_retval = 'failure ({})'.format(msg)
         return human_retval
 
 
+    def startLCBBTool( self, toolname, label, **tool_args ):
+        '''Start running an LCBB tool in the background, and display its outputs when done'''
+        self.updateStatus('Running {}...'.format(label))
+        self.toolProcess = lcbbtool.LCBBToolProcess( self, toolname, **tool_args )
+        self.toolProcess.output.connect( self.log )
+        self.toolProcess.output.connect( partial( self._showToolProgress, label ) )
+        self.toolProcess.done.connect( partial( self.toolFinished, label, tool_args['p2_input_file'] ) )
+        self.toolRunButton.setText( 'Cancel' )
+        self.toolProcess.start()
+
+    def _showToolProgress( self, label, text ):
+        lines = [ line.strip() for line in text.split('\n') if line.strip() ]
+        if lines:
+            self.updateStatus( 'Running {}: {}'.format( label, lines[-1] ), log=False )
+
+    def toolFinished( self, label, infile_path, process ):
+        tool_process = self.toolProcess
+        tool_process.deleteLater()
+        self.toolProcess = None
+        if process.returncode == 0:
+            record = workspace.runRecord( tool_process.toolname, tool_process.tool_args, process,
+                                          time.time() - tool_process.start_time )
+            try:
+                workspace.recordRun( ATHENA_OUTPUT_DIR, record )
+            except OSError as e:
+                print("Could not record run in workspace: {}".format( e ))
+        self.toolRunButton.setText( self.toolRunButtonText )
+        self.updateStatus('{} returned {}.'.format(label, self._humanReadableReturnValue(process)))
+        # Don't show outputs on top of a different mesh than the one they were designed for
+        if( str(getattr(self.geomView, 'meshFilepath', None)) == str(infile_path) ):
+            self.newOutputs(process)
+        elif process.returncode == 0:
+            self.log( 'Not displaying {} outputs for {}, which is no longer loaded'.format( label, infile_path ) )
+
+    # Number of the most recent runs listed in the Past Runs menu
+    PAST_RUNS_SHOWN = 25
+
+    def populatePastRunsMenu( self ):
+        self.pastRunsMenu.clear()
+        runs = workspace.pastRuns( ATHENA_OUTPUT_DIR )[ -self.PAST_RUNS_SHOWN: ]
+        if not runs:
+            self.pastRunsMenu.addAction( 'No runs in {}'.format( ATHENA_OUTPUT_DIR ) ).setEnabled( False )
+        for record in reversed( runs ):
+            text = '{} {} on {} ({} bp)'.format( record['time'].replace( 'T', ' ' ), record['tool'],
+                                                 Path( record['input_file'] ).name,
+                                                 record['parameters'].get( 'p7_edge_length', '?' ) )
+            action = self.pastRunsMenu.addAction( text )
+            action.triggered.connect( partial( self.loadPastRun, record ) )
+
+    def loadPastRun( self, record ):
+        '''Show the mesh and outputs of a run from the workspace index, without re-running its tool'''
+        input_file = Path( record['input_file'] )
+        if not input_file.is_file():
+            self.updateStatus( 'Cannot reload run: input {} no longer exists'.format( input_file ) )
+            return
+        self.geometryList.selectFile( input_file )
+        self.newOutputs( workspace.resultFromRecord( record ) )
+        self.updateStatus( 'Loaded {} results from {}'.format( record['tool'], record['output_dir'] ) )
+
     def runPERDIX( self ):
-        self.updateStatus('Running PERDIX...')
         infile_path, outfile_dir_path = self._toolFilenames( 'PERDIX' )
-        process = runLCBBTool ('PERDIX',
-                               p1_output_dir=outfile_dir_path,
-                               p2_input_file=infile_path,
-                               p3_scaffold=self.scaffoldBox.currentData(),
-                               p7_edge_length=self.perdixEdgeLengthSpinner.value())
-        self.log( process.stdout )
-        self.updateStatus('PERDIX returned {}.'.format(self._humanReadableReturnValue(process)))
-        self.newOutputs(process)
+        self.startLCBBTool('PERDIX', 'PERDIX',
+                           p1_output_dir=outfile_dir_path,
+                           p2_input_file=infile_path,
+                           p3_scaffold=self.scaffoldBox.currentData(),
+                           p7_edge_length=self.perdixEdgeLengthSpinner.value())
 
     def runTALOS( self ):
-        self.updateStatus('Running TALOS...')
         infile_path, outfile_dir_path = self._toolFilenames( 'TALOS' )
-        process = runLCBBTool('TALOS',
-                              p1_output_dir=outfile_dir_path,
-                              p2_input_file=infile_path,
-                              p3_scaffold=self.scaffoldBox.currentData(),
-                              p4_edge_sections=self.talosEdgeSectionBox.currentIndex()+2,
-                              p5_vertex_design=self.talosVertexDesignBox.currentIndex()+1,
-                              p7_edge_length=self.talosEdgeLengthSpinner.value())
-        self.log( process.stdout )
-        self.updateStatus('TALOS returned {}.'.format(self._humanReadableReturnValue(process)))
-        self.newOutputs(process)
+        self.startLCBBTool('TALOS', 'TALOS',
+                           p1_output_dir=outfile_dir_path,
+                           p2_input_file=infile_path,
+                           p3_scaffold=self.scaffoldBox.currentData(),
+                           p4_edge_sections=self.talosEdgeSectionBox.currentIndex()+2,
+                           p5_vertex_design=self.talosVertexDesignBox.currentIndex()+1,
+                           p7_edge_length=self.talosEdgeLengthSpinner.value())
 
     def runDAEDALUS2( self ):
-        self.updateStatus('Running DAEDALUS...')
         infile_path, outfile_dir_path = self._toolFilenames( 'DAEDALUS2' )
-        process = runLCBBTool('DAEDALUS2',
-                              p1_output_dir=outfile_dir_path,
-                              p2_input_file=infile_path,
-                              p3_scaffold=self.scaffoldBox.currentData(),
-                              p4_edge_sections=1, p5_vertex_design=2,
-                              p7_edge_length=self.daedalusEdgeLengthSpinner.value())
-        self.log( process.stdout )
-        self.updateStatus('DAEDALUS returned {}.'.format(self._humanReadableReturnValue(process)))
-        self.newOutputs(process)
+        self.startLCBBTool('DAEDALUS2', 'DAEDALUS',
+                           p1_output_dir=outfile_dir_path,
+                           p2_input_file=infile_path,
+                           p3_scaffold=self.scaffoldBox.currentData(),
+                           p4_edge_sections=1, p5_vertex_design=2,
+                           p7_edge_length=self.daedalusEdgeLengthSpinner.value())
 
 
     def runMETIS( self ):
-        self.updateStatus('Running METIS...')
         infile_path, outfile_dir_path = self._toolFilenames( 'METIS' )
-        process = runLCBBTool ('METIS',
-                               p1_output_dir=outfile_dir_path,
-                               p2_input_file=infile_path,
-                               p3_scaffold=self.scaffoldBox.currentData(),
-                               p4_edge_sections=3, p5_vertex_design=2,
-                               p7_edge_length=self.metisEdgeLengthSpinner.value())
-        self.log( process.stdout )
-        self.updateStatus('METIS returned {}.'.format(self._humanReadableReturnValue(process)))
-        self.newOutputs(process)
+        self.startLCBBTool('METIS', 'METIS',
+                           p1_output_dir=outfile_dir_path,
+                           p2_input_file=infile_path,
+                           p3_scaffold=self.scaffoldBox.currentData(),
+                           p4_edge_sections=3, p5_vertex_design=2,
+                           p7_edge_length=self.metisEdgeLengthSpinner.value())
 
     toolMap = { (0, 0): runPERDIX,
                 (0, 1): runMETIS,
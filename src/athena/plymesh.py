@@ -1,4 +1,6 @@
 from pathlib import Path
+from collections import namedtuple
+import json
 import struct
 import itertools
 
@@ -8,11 +10,11 @@ from PySide2.Qt3DCore import Qt3DCore
 from PySide2.Qt3DRender import Qt3DRender
 from PySide2.Qt3DExtras import Qt3DExtras
 
-from plyfile import PlyData, PlyElement
+from plyfile import PlyData, PlyElement, PlyElementParseError
 import numpy as np
 from numpy.lib.recfunctions import repack_fields
 
-from athena import geom
+from athena import geom, diskcache, ATHENA_CACHE_DIR
 from earcut import earcut
 
 def tri_norm(a,b,c):
@@ -39,118 +41,265 @@ def sharedEdges(poly, vtx):
         elif vtx == b:
             yield a
 
+# Each vertex in the mesh has nine coordinates:
+# The xyz coordinates of the vertex itself, and
+# the xyz coordinates of the two points adjacent to that
+# vertex in the wireframe mesh.  (The vertex shader refers to these
+# as wing1Vtx and wing2Vtx).  For a triangular face, a vertex's
+# two wing vertices are simply the other two vertices of the triangle,
+# so each triangle (A, B, C) becomes the three rows [A B C], [B A C], [C A B].
+_tri_wing_order = np.array( [[0, 1, 2], [1, 0, 2], [2, 0, 1]] )
+
+def plyVertexArray(plydata):
+    '''
+    Gather the xyz coordinates of a ply file's vertices into a contiguous (N,3) float32 array,
+    ignoring any other per-vertex values
+    '''
+    ply_vertices = plydata['vertex'].data
+    xyz = np.empty( (len(ply_vertices), 3), dtype=np.float32 )
+    for col, field in enumerate('xyz'):
+        xyz[:,col] = ply_vertices[field]
+    return xyz
+
+def polygonWings(polys):
+    '''
+    For each position in a polygon, return the indices of the two vertices that
+    share a polygon edge with it, in the order given by sharedEdges().
+
+    polys may be a single polygon or an (F,k) stack of polygons with k vertices each.
+    '''
+    polys = np.asarray(polys)
+    following = np.roll( polys, -1, axis=-1 )
+    preceding = np.roll( polys, 1, axis=-1 )
+    wing1 = preceding.copy()
+    wing2 = following.copy()
+    # edgeIter() visits the first vertex's outgoing edge before its incoming one
+    wing1[...,0], wing2[...,0] = following[...,0], preceding[...,0]
+    return wing1, wing2
+
+def convexPolygons(xy_coords):
+    '''
+    Given an (F,k,2) stack of planar polygons, return a boolean array marking
+    the strictly convex ones.
+
+    A polygon is strictly convex when every corner turns the same way and the
+    turns add up to a single full revolution (which rules out star polygons).
+    '''
+    edges = np.roll( xy_coords, -1, axis=1 ) - xy_coords
+    next_edges = np.roll( edges, -1, axis=1 )
+    cross = edges[...,0] * next_edges[...,1] - edges[...,1] * next_edges[...,0]
+    dot = np.einsum( 'fki,fki->fk', edges, next_edges )
+    scale = np.linalg.norm( edges, axis=2 ) * np.linalg.norm( next_edges, axis=2 )
+    eps = 1e-9 * scale
+    same_turn = np.all( cross > eps, axis=1 ) | np.all( cross < -eps, axis=1 )
+    turning = np.sum( np.arctan2( cross, dot ), axis=1 )
+    return same_turn & np.isclose( np.abs(turning), 2 * np.pi )
+
+def earcutPolygon(xy_coords, poly_geom, poly_normal):
+    '''
+    Triangulate a single planar polygon with the earcut library.
+
+    Returns an (M,3) array of positions within the polygon, wound to match
+    poly_normal.
+    '''
+    flattened = earcut.flatten([xy_coords,[]])
+    new_tris = np.array( earcut.earcut(flattened['vertices'],None,flattened['dimensions']), dtype=np.intp ).reshape(-1, 3)
+
+    # Now we have the new triangles from earcut.
+    # Check the first one's normal; if it doesn't match the polygon normal,
+    # then we'll assume the 2D projection reversed our triangle windings.
+    geom_tri0 = poly_geom.take(new_tris[0], axis=0)
+    tri0_norm = tri_norm(*(geom_tri0[x,:] for x in range(3)))
+    normcheck = np.dot(tri0_norm, poly_normal)
+    if( not np.isclose(normcheck, 1.0, rtol=1e-1) ):
+        new_tris = new_tris[:,[0, 2, 1]]
+    return new_tris
+
+def triangulatePolygons(poly_geom):
+    '''
+    Triangulate an (F,k,3) stack of polygons that all have k vertices.
+
+    Convex polygons are split into triangle fans directly; only non-convex
+    polygons are sent to earcut.  Returns (face_idx, tris), where row i of
+    the (M,3) array tris holds positions within polygon face_idx[i].
+    '''
+    num_faces, k = poly_geom.shape[:2]
+
+    # Compute the normal of each polygon from its first three verts;
+    # we'll need this later to determine winding direction for
+    # earcut-triangulated faces
+    a, b, c = poly_geom[:,0,:], poly_geom[:,1,:], poly_geom[:,2,:]
+    poly_normals = np.cross( a-b, a-c )
+    poly_normals /= np.linalg.norm( poly_normals, axis=1, keepdims=True )
+
+    # Geometric centroid of each polygon
+    G = np.average( poly_geom, axis=1 )
+    offset_geom = poly_geom - G[:,np.newaxis,:]
+    # Singular value decomposition: we want to map the 3D coordinates
+    # to a 2D subspace that can be fed into a 2D triangulation algorithm.
+    # For this we only need the last return value, and numpy computes it for
+    # the whole stack of polygons at once.
+    _, _, vh = np.linalg.svd(offset_geom)
+    xy_coords = np.einsum( 'fkj,fij->fki', offset_geom, vh[:,:2,:] )
+
+    convex = convexPolygons( xy_coords )
+
+    # A fan from the first vertex keeps the polygon's own winding.
+    fan = np.stack( [np.zeros(k-2, dtype=np.intp), np.arange(1, k-1), np.arange(2, k)], axis=1 )
+    convex_faces = np.flatnonzero( convex )
+    face_chunks = [ np.repeat( convex_faces, k-2 ) ]
+    tri_chunks = [ np.tile( fan, (len(convex_faces), 1) ) ]
+
+    for f in np.flatnonzero( ~convex ):
+        new_tris = earcutPolygon( xy_coords[f], poly_geom[f], poly_normals[f] )
+        face_chunks.append( np.full( len(new_tris), f, dtype=np.intp ) )
+        tri_chunks.append( new_tris )
+
+    return np.concatenate( face_chunks ), np.concatenate( tri_chunks )
+
+# plyfile parses list properties row by row, which dominates the load time of
+# large meshes.  Binary files whose faces are all triangles can instead be
+# memory-mapped in one go, when plyfile is told every face list has length 3;
+# it rejects the file if that turns out to be false, and we parse it normally.
+def readPly(filepath):
+    '''Parse a ply file, taking plyfile's fast path for all-triangle binary meshes'''
+    with open( filepath, 'rb' ) as f:
+        try:
+            return PlyData.read( f, known_list_len={'face': {'vertex_indices': 3}} )
+        except PlyElementParseError:
+            f.seek( 0 )
+            return PlyData.read( f )
+
+def _faceRows(faces):
+    '''Stack same-sized ply face lists into a 2D array of vertex indices'''
+    return faces if faces.ndim == 2 else np.vstack( faces )
+
+# The finished GPU-ready arrays for a PlyMesh, plus its 2D/3D flag
+MeshBuffers = namedtuple( 'MeshBuffers', 'vertices, indices, dimensions' )
+
+def buildMeshBuffers(plydata):
+    '''
+    Build the vertex and index arrays for a PlyMesh from parsed ply data.
+
+    Returns (vertex_nparr, index_nparr, dimensions), where vertex_nparr has
+    nine float32 columns per vertex (position, wing1Vtx, wing2Vtx), index_nparr
+    lists three vertex rows per triangle, and dimensions is 2 for meshes that lie
+    flat in the XY plane or 3 otherwise.
+    '''
+    xyz = plyVertexArray(plydata)
+    ply_faces = plydata['face'].data['vertex_indices']
+
+    dimensions = 2 if np.all( 0 == xyz[:,2] ) else 3
+
+    if ply_faces.ndim == 2:
+        # Fixed-length face lists, as returned by readPly()'s fast path
+        face_sizes = np.full( len(ply_faces), ply_faces.shape[1], dtype=np.intp )
+    else:
+        face_sizes = np.fromiter( (len(poly) for poly in ply_faces), dtype=np.intp, count=len(ply_faces) )
+    is_tri = face_sizes == 3
+
+    # Triangular faces are by far the common case, so they are expanded all at once
+    # with fancy indexing.
+    if np.any(is_tri):
+        tris = _faceRows( ply_faces[is_tri] ).astype(np.intp)
+    else:
+        tris = np.zeros( (0, 3), dtype=np.intp )
+    vertex_chunks = [ xyz[ tris[:, _tri_wing_order] ].reshape(-1, 9) ]
+
+    # For non-triangular faces, we generate triangles grouped by polygon size,
+    # and store each vertex with its adjacent edge vertices as its wing value.
+    # This assumes that all triangle vertices fall on the boundary of a polygon
+    # face, which holds for triangle fans and for triangulations produced
+    # by the earcut library.
+    for k in np.unique( face_sizes[~is_tri] ):
+        polys = _faceRows( ply_faces[face_sizes == k] ).astype(np.intp)
+        # Every polygon must have k distinct external edges
+        sorted_edges = np.sort( np.stack( [polys, np.roll(polys, -1, axis=1)], axis=2 ), axis=2 )
+        edge_keys = np.sort( sorted_edges[...,0] * (len(xyz) + 1) + sorted_edges[...,1], axis=1 )
+        assert( np.all( edge_keys[:,1:] != edge_keys[:,:-1] ) )
+
+        face_idx, new_tris = triangulatePolygons( xyz[polys].astype(np.float64) )
+        wing1, wing2 = polygonWings(polys)
+        corner_faces = np.repeat( face_idx, 3 )
+        corners = new_tris.reshape(-1)
+        rows = np.stack( [polys[corner_faces, corners],
+                          wing1[corner_faces, corners],
+                          wing2[corner_faces, corners]], axis=1 )
+        vertex_chunks.append( xyz[rows].reshape(-1, 9) )
+
+    vertex_nparr = np.concatenate( vertex_chunks )
+
+    vertex_basetype = geom.basetypes.Float
+    if( len(vertex_nparr) < 30000 ):
+        index_basetype = geom.basetypes.UnsignedShort
+    else:
+        index_basetype = geom.basetypes.UnsignedInt
+
+    vertex_nparr = np.ascontiguousarray( vertex_nparr, dtype=geom.basetype_numpy_codes[vertex_basetype] )
+    index_nparr = np.arange( len(vertex_nparr), dtype=geom.basetype_numpy_codes[index_basetype] ).reshape(-1, 3)
+
+    return MeshBuffers( vertex_nparr, index_nparr, dimensions )
+
+# Triangulated mesh buffers are cached on disk, keyed by the content hash of the
+# ply file.  Bump MESH_BUFFER_FORMAT whenever buildMeshBuffers() changes its output,
+# so that stale cache entries are never reused.
+MESH_BUFFER_FORMAT = 1
+MESH_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+mesh_cache = diskcache.DiskCache( ATHENA_CACHE_DIR / 'meshes', MESH_CACHE_MAX_BYTES )
+
+def _readCachedBuffers( entry ):
+    meta = json.loads( (entry / 'meta.json').read_text() )
+    # Memory-map the arrays; they are only read once, for upload to the GPU
+    vertices = np.load( entry / 'vertices.npy', mmap_mode='r' )
+    indices = np.load( entry / 'indices.npy', mmap_mode='r' )
+    return MeshBuffers( vertices, indices, meta['dimensions'] )
+
+def _writeCachedBuffers( buffers ):
+    def populate( entry ):
+        np.save( entry / 'vertices.npy', buffers.vertices )
+        np.save( entry / 'indices.npy', buffers.indices )
+        meta = { 'dimensions': buffers.dimensions, 'format': MESH_BUFFER_FORMAT }
+        (entry / 'meta.json').write_text( json.dumps( meta ) )
+    return populate
+
+def loadMeshBuffers( filepath, cache=mesh_cache ):
+    '''
+    Return the MeshBuffers for a ply file, from the on-disk cache if possible.
+
+    Cache problems are never fatal: on any error the buffers are simply
+    rebuilt from the ply file.
+    '''
+    try:
+        key = '{}-v{}'.format( diskcache.hashFile( filepath ), MESH_BUFFER_FORMAT )
+        entry = cache.get( key )
+        if entry:
+            return _readCachedBuffers( entry )
+    except (OSError, ValueError, KeyError) as e:
+        print("Could not read cached mesh for {}: {}".format( filepath, e ))
+        key = None
+
+    buffers = buildMeshBuffers( readPly( filepath ) )
+    if key:
+        try:
+            cache.put( key, _writeCachedBuffers( buffers ) )
+        except OSError as e:
+            print("Could not cache mesh for {}: {}".format( filepath, e ))
+    return buffers
+
 class PlyMesh(Qt3DCore.QEntity):
     '''
     QEntity for the 2D or 3D, wireframe-girt polygonal meshes
     that are the main display object of Athena.
     '''
-    def __init__(self, parent, plydata):
+    def __init__(self, parent, plydata=None, buffers=None):
         super().__init__(parent)
 
-        ply_vertices = plydata['vertex'].data
-        ply_faces = plydata['face'].data['vertex_indices']
-
-        # The ply reader library returns the vertex data in numpy structured arrays,
-        # which wind up being annoying to access manually, so define a convenience
-        # lookup function here.
-        # FIXME A lot of probably-unnecessary copying of numpy data takes place here,
-        # causing loader slowness on very large ply models.
-        def vertex(indices):
-            vertices = np.take(ply_vertices, indices, axis=0)
-            fields = ['x', 'y', 'z'] # Ignore any othe per-vertex values
-            return np.r_[ [v[fields].item() for v in vertices] ]
-
-        flat_xy = np.all( 0 == ply_vertices['z'] )
-        self.dimensions = 2 if flat_xy else 3
-
-        vertices = list()
-        triangles = list()
-
-        def add_vtx(v, a, b):
-            vertices.append( np.hstack( [v , a , b] ) )
-            return len(vertices) - 1
-
-        # Each vertex in the mesh has nine coordinates:
-        # The xyz coordinates of the vertex itself, and
-        # the xyz coordinates of the two points adjacent to that
-        # vertex in the wireframe mesh.  (The vertex shader refers to these
-        # as wing1Vtx and wing2Vtx).  For a triangular face, a vertex's
-        # two wing vertices are simply the other two vertices of the triangle.
-        # add_simple_tri covers this case
-
-        def add_simple_tri( *args ):
-            A, B, C = vertex( args )
-            i = add_vtx(A, B, C)
-            j = add_vtx(B, A, C)
-            k = add_vtx(C, A, B)
-            triangles.append( (i, j, k) )
-
-        # For non-triangular faces, we generate triangles (in the loop below),
-        # and store each vertex with its adjacent edge vertices as its wing value.
-        # This assumes that all triangle vertices fall on the boundary of a polygon
-        # face, which seems to be a valid assumption for triangulations produced
-        # by the earcut library.
-
-        def add_complex_tri( a, b, c, poly ):
-            def add_vertex_with_edges( x ):
-                e1, e2 = tuple( x for x in sharedEdges(poly, x) )
-                return add_vtx( *vertex( (x, e1, e2) ) )
-            i = add_vertex_with_edges( a )
-            j = add_vertex_with_edges( b )
-            k = add_vertex_with_edges( c )
-            triangles.append( (i, j, k) )
-
-        for poly in ply_faces:
-            if len(poly) == 3:
-                add_simple_tri( *poly )
-            else:
-                external_edges = set( edgeIter( poly ) )
-                assert( len(external_edges) == len(poly) )
-                poly_geom = vertex(poly)
-                # Compute the normal of this polygon from the first three verts;
-                # we'll need this later to determine winding direction for the
-                # triangulated faces
-                poly_normal = tri_norm( *(poly_geom[x,:] for x in range(3)) )
-                # Geometric centroid of the polygon
-                G = np.average( poly_geom, axis=0 )
-                offset_geom = poly_geom - G
-                # Singular value decomposition: we want to map the 3D coordinates
-                # to a 2D subspace that can be fed into a 2D triangulation algorithm.
-                # For this we only need the last return value.
-                _, _, vh = np.linalg.svd(offset_geom)
-                vt = vh[:2,:].T
-                xy_coords = np.dot(offset_geom, vt)
-                flattened = earcut.flatten([xy_coords,[]])
-                new_tris = earcut.earcut(flattened['vertices'],None,flattened['dimensions'])
-
-                # Now we have the new triangles from earcut.
-                # Check the first one's normal; if it doesn't match the polygon normal,
-                # then we'll assume the 2D projection reversed our triangle windings.
-                geom_tri0 = poly_geom.take(new_tris[0:3], axis=0)
-                tri0_norm = tri_norm(*(geom_tri0[x,:] for x in range(3)))
-                normcheck = np.dot(tri0_norm, poly_normal)
-                flip = False
-                if( not np.isclose(normcheck, 1.0, rtol=1e-1) ):
-                    flip = True
-
-                # Now add new triangles to the buffers
-                for a,b,c in geom.grouper(new_tris,3):
-                    idx_a = poly[a]
-                    idx_b = poly[b]
-                    idx_c = poly[c]
-                    if( flip ): 
-                        idx_b, idx_c = idx_c, idx_b
-                    add_complex_tri( idx_a, idx_b, idx_c, poly )
-
-        vertex_basetype = geom.basetypes.Float
-        if( len(triangles) < 30000 ):
-            index_basetype = geom.basetypes.UnsignedShort
-        else:
-            index_basetype = geom.basetypes.UnsignedInt
-
-        vertex_nparr = np.array(vertices, dtype = geom.basetype_numpy_codes[vertex_basetype])
-
-        index_nparr = np.array( triangles, dtype=geom.basetype_numpy_codes[index_basetype])
+        if buffers is None:
+            buffers = buildMeshBuffers(plydata)
+        vertex_nparr, index_nparr, self.dimensions = buffers
+        # Every vertex position appears in the first three columns
+        self.aabb = geom.AABB( vertex_nparr[:,0:3] )
 
         self.geometry = Qt3DRender.QGeometry(self)
 
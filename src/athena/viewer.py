@@ -1,4 +1,5 @@
 from pathlib import Path
+import os
 import math
 import numpy as np
 
@@ -10,13 +11,21 @@ from PySide2.Qt3DRender import Qt3DRender
 from PySide2.Qt3DCore import Qt3DCore
 from PySide2.QtQml import QQmlEngine, QQmlComponent
 
-from plyfile import PlyData, PlyElement
-
-from athena import ATHENA_SRC_DIR, plymesh, geom, decorations, screenshot
+from athena import ATHENA_SRC_DIR, plymesh, geom, decorations, bildparser, screenshot
 
 # This file defines the all-important AthenaViewer class, which implements
 # the graphical view.  Several support classes are defined first.
 
+# Cylinders and cones are drawn instanced (see decorations.InstancedDecorationChunk)
+# unless the ATHENA_INSTANCED_DECORATIONS environment variable is 0, which selects
+# the geometry shader path instead, e.g. to compare their frame rates
+INSTANCED_DECORATIONS = os.environ.get('ATHENA_INSTANCED_DECORATIONS', '1') != '0'
+
+# Other decoration vertices are stored compactly (see decorations.compactVertices),
+# and decorations are colored from a shared palette (see decorations.DecorationPalette),
+# unless the ATHENA_COMPACT_DECORATIONS environment variable is 0
+COMPACT_DECORATIONS = os.environ.get('ATHENA_COMPACT_DECORATIONS', '1') != '0'
+
 class CameraController:
 
     @classmethod
@@ -41,12 +50,12 @@ class CameraController:
         self.mesh = mesh
         self.split = split
         if( self.mesh ) : 
-            self.aabb = geom.AABB(self.mesh.geometry)
+            self.aabb = self.mesh.aabb.copy()
             self._setupCamera()
 
     def newMesh( self, mesh ):
         self.mesh = mesh
-        self.aabb = geom.AABB( self.mesh.geometry )
+        self.aabb = self.mesh.aabb.copy()
         self._setupCamera()
         self.reset()
 
@@ -100,6 +109,14 @@ class CameraController:
         # Defined in concrete subclasses
         pass
 
+    def pixelSize(self):
+        '''The width of a screen pixel in world units at the view center'''
+        # Defined in concrete subclasses
+        pass
+
+    def _viewportWidth(self):
+        return self.window.width() / 2 if self.split else self.window.width()
+
     def pan(self, dx, dy):
         delta_x = -dx * self.rightVector
         delta_y = dy * self._currentUp()
@@ -165,6 +182,9 @@ class OrthoCamController(CameraController):
         self._setProjection()
         self._apply()
 
+    def pixelSize(self):
+        return self.bounding_radius * self.margin / self._viewportWidth()
+
 class PerspectiveCamController(CameraController):
 
     def __init__(self, window, camera, geometry, split):
@@ -196,6 +216,11 @@ class PerspectiveCamController(CameraController):
         self._setProjection()
         self._apply()
 
+    def pixelSize(self):
+        distance = ( self.camCenter - self.camLoc ).length()
+        view_height = 2 * distance * math.tan( math.radians( self.fov ) / 2 )
+        return view_height / self.window.height()
+
 
 class OffscreenRenderTarget( Qt3DRender.QRenderTarget ):
     '''
@@ -282,6 +307,8 @@ class AthenaFrameGraph:
         self.noDraw = Qt3DRender.QNoDraw(self.clearBuffers)
 
         # Branch 2: main drawing branches using the Athena camera
+        # Both branches skip entities outside the camera's view frustum, such as the
+        # off-screen chunks of large decorations (see decorations.ChunkedDecorations)
         self.cameraSelector = Qt3DRender.QCameraSelector(self.surfaceSelector)
         self.cameraSelector.setCamera(window.camera())
 
@@ -293,6 +320,7 @@ class AthenaFrameGraph:
         self.solidPassFilter.setName('pass')
         self.solidPassFilter.setValue('solid')
         self.qfilt.addMatch(self.solidPassFilter)
+        self.culling = Qt3DRender.QFrustumCulling(self.qfilt)
 
         # Branch 2B: transparent objects
         self.viewport2 = Qt3DRender.QViewport(self.cameraSelector)
@@ -302,6 +330,7 @@ class AthenaFrameGraph:
         self.transPassFilter.setName('pass')
         self.transPassFilter.setValue('transp')
         self.qfilt2.addMatch(self.transPassFilter)
+        self.culling2 = Qt3DRender.QFrustumCulling(self.qfilt2)
 
         # Branch 3: 2D screen overlays
         self.cameraSelector2 = Qt3DRender.QCameraSelector(self.surfaceSelector)
@@ -490,14 +519,20 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
         return result
 
 
-    def _athenaMaterial( self, qmlfile, vert_shader, frag_shader, geom_shader=None ):
+    def _athenaMaterial( self, qmlfile, vert_shader, frag_shader, geom_shader=None, defines=() ):
         material = self._qmlLoad( qmlfile )
         shader_path = Path(ATHENA_SRC_DIR) / 'shaders'
         vert_shader = shader_path / vert_shader
         frag_shader = shader_path / frag_shader
         if( geom_shader ): geom_shader = shader_path / geom_shader
         def loadShader( s ):
-            return Qt3DRender.QShaderProgram.loadSource( s.as_uri() )
+            code = Qt3DRender.QShaderProgram.loadSource( s.as_uri() )
+            if( defines ):
+                # Preprocessor defines must follow the #version line
+                version, rest = code.data().split( b'\n', 1 )
+                lines = [ version ] + [ '#define {}'.format(d).encode() for d in defines ] + [ rest ]
+                code = QByteArray( b'\n'.join( lines ) )
+            return code
         shader = Qt3DRender.QShaderProgram(material)
         shader.setVertexShaderCode( loadShader( vert_shader ) )
         if( geom_shader): shader.setGeometryShaderCode( loadShader( geom_shader ) )
@@ -521,13 +556,25 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
         material.addParameter( self._athenaViewportParam )
         return material
 
-    def _imposterMaterial(self, flavor):
+    def _imposterMaterial(self, flavor, instanced=False, compact=False, palette=None):
         flavor_str = flavor + '_imposter'
-        material =  self._athenaMaterial( 'imposter.qml', flavor_str + '.vert', 
-                                                          flavor_str + '.frag',
-                                                          flavor_str + '.geom' )
+        if( palette ):
+            defines = ['PALETTE_SIZE {}'.format(palette.size)]
+        else:
+            defines = ['COMPACT_VERTICES'] if compact else []
+        if( instanced ):
+            # The instanced vertex shader does the geometry shader's work,
+            # and its colors are always compact
+            material = self._athenaMaterial( 'imposter.qml', flavor + '_instanced.vert',
+                                                             flavor_str + '.frag', defines=defines )
+        else:
+            material =  self._athenaMaterial( 'imposter.qml', flavor_str + '.vert', 
+                                                              flavor_str + '.frag',
+                                                              flavor_str + '.geom', defines )
 
         material.addParameter( self._projOrthographicParam )
+        if( palette ):
+            material.addParameter( palette.parameter )
         return material
 
     def _overlayMaterial( self ):
@@ -553,9 +600,17 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
         self.lightPositionChanged.connect( self.handleLightPositionChange )
         self.wireEnableChanged.connect( self.handleWireframeRenderChange )
 
-        self.sphere_material = self._imposterMaterial('sphere')
-        self.cylinder_material = self._imposterMaterial('cylinder')
-        self.cone_material = self._imposterMaterial('cone')
+        self.palette = decorations.DecorationPalette() if COMPACT_DECORATIONS else None
+        # Decorations whose colors don't fit in the palette use the vertex color materials
+        self.sphere_material = self._imposterMaterial('sphere', compact=COMPACT_DECORATIONS)
+        self.cylinder_material = self._imposterMaterial('cylinder', INSTANCED_DECORATIONS, COMPACT_DECORATIONS)
+        self.cone_material = self._imposterMaterial('cone', INSTANCED_DECORATIONS, COMPACT_DECORATIONS)
+        self.sphere_palette_material = self.cylinder_palette_material = self.cone_palette_material = None
+        if( self.palette ):
+            self.sphere_palette_material = self._imposterMaterial('sphere', palette=self.palette)
+            self.cylinder_palette_material = self._imposterMaterial('cylinder', INSTANCED_DECORATIONS,
+                                                                    palette=self.palette)
+            self.cone_palette_material = self._imposterMaterial('cone', INSTANCED_DECORATIONS, palette=self.palette)
 
         self.flat_material = self._plyMeshMaterial( 'flat' )
         self.flat_material.addParameter( self._flatColorParam )
@@ -582,6 +637,10 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
         self.rootEntity.addComponent(self.sphere_material)
         self.rootEntity.addComponent(self.cylinder_material)
         self.rootEntity.addComponent(self.cone_material)
+        if( self.palette ):
+            self.rootEntity.addComponent(self.sphere_palette_material)
+            self.rootEntity.addComponent(self.cylinder_palette_material)
+            self.rootEntity.addComponent(self.cone_palette_material)
 
         self.setRootEntity(self.rootEntity)
 
@@ -590,15 +649,21 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
         self.meshEntity = None
 
         class DecorationEntity(Qt3DCore.QEntity):
+            # Decorations may arrive in several chunks, so each kind is a list of entities
             def __init__(self, parent):
                 super().__init__(parent)
-                self.spheres = None
-                self.cylinders = None
-                self.cones = None
+                self.spheres = list()
+                self.cylinders = list()
+                self.cones = list()
+                # For the shared entity of color variants, whether they are drawn separately instead
+                self.variants_separate = False
 
         self.cylModelEntity = DecorationEntity( self.rootEntity )
         self.routModelEntities = [ DecorationEntity( self.rootEntity ) for x in range(2) ]
         self.atomModelEntities = [ DecorationEntity( self.rootEntity ) for x in range(2) ]
+        # Decorations drawn by both color variants at once, recolored through the palette
+        self.routSharedEntity = DecorationEntity( self.rootEntity )
+        self.atomSharedEntity = DecorationEntity( self.rootEntity )
 
         self.lastpos = None
         self.mouseTool = 'rotate'
@@ -673,12 +738,14 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
         self.camControl.split = enabled
         self.camControl.resize()
         self.resizeViewport()
+        self.updateLevelOfDetail()
 
     def resetCamera(self):
         # FIXME camControl.reset() *should* work here, but something is amiss
         # and this is the more reliable method right now.  Ugh.
         camclass = self.camControl.__class__
         self.camControl = camclass( self, self.camera(), self.meshEntity, self.camControl.split )
+        self.updateLevelOfDetail()
 
     def clearAllGeometry( self ):
         if( self.meshEntity ):
@@ -686,24 +753,27 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
             self.meshEntity = None
         self.clearDecorations()
 
+    def _decorationEntities( self ):
+        return [self.cylModelEntity, self.routSharedEntity, self.atomSharedEntity] + \
+               self.routModelEntities + self.atomModelEntities
+
     def clearDecorations( self ):
-        for ent in [self.cylModelEntity] + self.routModelEntities + self.atomModelEntities:
-            if( ent.spheres ):
-                ent.spheres.deleteLater()
-                ent.spheres = None
-            if (ent.cylinders ):
-                ent.cylinders.deleteLater()
-                ent.cylinders = None
-            if (ent.cones ):
-                ent.cones.deleteLater()
-                ent.cones = None
+        for ent in self._decorationEntities():
+            for decoration in ent.spheres + ent.cylinders + ent.cones:
+                decoration.deleteLater()
+            ent.spheres = list()
+            ent.cylinders = list()
+            ent.cones = list()
+            ent.variants_separate = False
+        if( self.palette ):
+            self.palette.clear()
 
     def reloadGeom(self, filepath):
 
         self.meshFilepath = filepath
-        self.plydata = PlyData.read(filepath)
+        mesh_buffers = plymesh.loadMeshBuffers(filepath)
         self.clearAllGeometry()
-        self.meshEntity = plymesh.PlyMesh(self.meshEntityParent, self.plydata)
+        self.meshEntity = plymesh.PlyMesh(self.meshEntityParent, buffers=mesh_buffers)
         mesh_3d = self.meshEntity.dimensions == 3
         self.camControl.newMesh(self.meshEntity)
         if( mesh_3d ):
@@ -717,10 +787,12 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
     def setPerspectiveCam(self):
         self.setProjOrthographic(0.0)
         self.camControl = PerspectiveCamController.createFrom( self.camControl)
+        self.updateLevelOfDetail()
 
     def setOrthoCam(self):
         self.setProjOrthographic(1.0)
         self.camControl = OrthoCamController.createFrom( self.camControl)
+        self.updateLevelOfDetail()
 
     def setRotateTool(self):
         self.mouseTool = 'rotate'
@@ -760,10 +832,13 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
             if( event.buttons() == Qt.LeftButton ):
                 tool = getattr(self.camControl, self.mouseTool)
                 tool( delta.x(), delta.y() )
+                if( self.mouseTool == 'zoom' ):
+                    self.updateLevelOfDetail()
         self.lastpos = event.pos()
 
     def wheelEvent( self, event ):
         self.camControl.zoom( 0, event.angleDelta().y() )
+        self.updateLevelOfDetail()
 
     def _physicalPixelSize( self, size = None ):
         if size is None: size = self.size()
@@ -800,8 +875,17 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
         size = event.size()
         self.resizeViewport( self._physicalPixelSize(size) )
         self.camControl.resize( size )
+        self.updateLevelOfDetail()
 
-    def newDecoration(self, parent, bild_results, decoration_aabb = None):
+    def newDecoration(self, parent, bild_results, decoration_aabb = None, variants = ()):
+        '''
+        Add bild_results to the decorations of parent, alongside any it already
+        has, returning the new decorations
+
+        variants are bild results with the same primitives in other colors, to be
+        chosen between through the palette.
+        '''
+        added = list()
 
         if decoration_aabb is None:
             decoration_aabb = geom.AABB( bild_results )
@@ -810,16 +894,43 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
         T = geom.transformBetween( decoration_aabb, geom_aabb )
 
         if( bild_results.spheres ):
-            parent.spheres = decorations.SphereDecorations(parent, bild_results, T)
-            parent.spheres.addComponent( self.sphere_material )
+            spheres = decorations.SphereDecorations(parent, bild_results, T, COMPACT_DECORATIONS, self.palette, variants)
+            self._setDecorationMaterial( spheres )
+            if( self.camControl.mesh ):
+                spheres.setPixelSize( self.camControl.pixelSize() )
+            parent.spheres.append( spheres )
+            added.append( spheres )
+
+        if( bild_results.cylinders or bild_results.arrows ):
+            cylinders = decorations.CylinderDecorations(parent, bild_results, T, INSTANCED_DECORATIONS,
+                                                       COMPACT_DECORATIONS, self.palette, variants)
+            self._setDecorationMaterial( cylinders )
+            parent.cylinders.append( cylinders )
+            added.append( cylinders )
 
-        if( bild_results.cylinders ):
-            parent.cylinders = decorations.CylinderDecorations(parent, bild_results, T)
-            parent.cylinders.addComponent( self.cylinder_material )
-            
         if( bild_results.arrows ):
-            parent.cones = decorations.ConeDecorations(parent, bild_results, T)
-            parent.cones.addComponent( self.cone_material )
+            cones = decorations.ConeDecorations(parent, bild_results, T, INSTANCED_DECORATIONS,
+                                               COMPACT_DECORATIONS, self.palette, variants)
+            self._setDecorationMaterial( cones )
+            parent.cones.append( cones )
+            added.append( cones )
+        return added
+
+    def updateLevelOfDetail(self):
+        '''Choose the level of detail of every sphere decoration for the current camera'''
+        if( self.camControl.mesh is None ): return
+        pixel_size = self.camControl.pixelSize()
+        for ent in self._decorationEntities():
+            for spheres in ent.spheres:
+                spheres.setPixelSize( pixel_size )
+
+    def decorationMemoryUsage(self):
+        '''Bytes of vertex data held by the sphere, cylinder and cone decorations, by kind'''
+        usage = dict( spheres=0, cylinders=0, cones=0 )
+        for ent in self._decorationEntities():
+            for kind in usage:
+                usage[kind] += sum( decoration.memoryUsage() for decoration in getattr( ent, kind ) )
+        return usage
 
     def setCylDisplay(self, bild_results, map_aabb):
         self.newDecoration( self.cylModelEntity, bild_results, map_aabb )
@@ -830,11 +941,68 @@ class AthenaViewer(Qt3DExtras.Qt3DWindow, metaclass=_metaParameters):
     def setAtomDisplay(self, bild_results, map_aabb, variant):
         self.newDecoration( self.atomModelEntities[variant], bild_results, map_aabb )
 
+    def _setDecorationMaterial(self, decoration):
+        if( isinstance( decoration, decorations.SphereDecorations ) ):
+            materials = (self.sphere_palette_material, self.sphere_material)
+        elif( isinstance( decoration, decorations.ConeDecorations ) ):
+            materials = (self.cone_palette_material, self.cone_material)
+        else:
+            materials = (self.cylinder_palette_material, self.cylinder_material)
+        decoration.setMaterial( materials[0] if decoration.palette else materials[1] )
+
+    def _separateVariants(self, entities, shared):
+        '''Move the decorations of shared into a copy per variant under entities, and free their palette slots'''
+        for kind in ('spheres', 'cylinders', 'cones'):
+            for decoration in getattr( shared, kind ):
+                for variant, entity in enumerate( entities ):
+                    copy = decoration.variantCopy( entity, variant )
+                    self._setDecorationMaterial( copy )
+                    if( kind == 'spheres' and self.camControl.mesh ):
+                        copy.setPixelSize( self.camControl.pixelSize() )
+                    getattr( entity, kind ).append( copy )
+                decoration.deleteLater()
+            setattr( shared, kind, list() )
+        self.palette.releaseGroup( shared )
+        shared.variants_separate = True
+
+    def _newVariantDecorations(self, entities, shared, variant_results, map_aabb):
+        # Variants drawing the same primitives share one set of geometry, for
+        # every chunk of the model, until their colors no longer fit in the palette
+        if( self.palette and not shared.variants_separate ):
+            if( bildparser.sameGeometry( variant_results ) ):
+                added = self.newDecoration( shared, variant_results[0], map_aabb, variant_results[1:] )
+                if( all( decoration.palette for decoration in added ) ):
+                    return
+                # Some of this chunk's colors didn't fit, so discard it and draw
+                # the whole model separately, this chunk included
+                for decoration in added:
+                    for kind in (shared.spheres, shared.cylinders, shared.cones):
+                        if decoration in kind:
+                            kind.remove( decoration )
+                    decoration.deleteLater()
+            self._separateVariants( entities, shared )
+        for entity, bild_results in zip( entities, variant_results ):
+            self.newDecoration( entity, bild_results, map_aabb )
+
+    def setRoutDisplays(self, variant_results, map_aabb):
+        '''Display the bild results of every routing color variant, in variant order'''
+        self._newVariantDecorations( self.routModelEntities, self.routSharedEntity, variant_results, map_aabb )
+
+    def setAtomDisplays(self, variant_results, map_aabb):
+        '''Display the bild results of every atomic model color variant, in variant order'''
+        self._newVariantDecorations( self.atomModelEntities, self.atomSharedEntity, variant_results, map_aabb )
+
     def toggleCylDisplay(self, value):
         self.cylModelEntity.setEnabled( value )
 
+    def _toggleVariant(self, entities, shared, value, variant):
+        entities[variant].setEnabled( value )
+        shared.setEnabled( any( entity.isEnabled() for entity in entities ) )
+        if( value and self.palette ):
+            self.palette.setVariant( shared, variant )
+
     def toggleRoutDisplay(self, value, variant):
-        self.routModelEntities[variant].setEnabled( value )
+        self._toggleVariant( self.routModelEntities, self.routSharedEntity, value, variant )
 
     def toggleAtomDisplay(self, value, variant):
-        self.atomModelEntities[variant].setEnabled( value )
+        self._toggleVariant( self.atomModelEntities, self.atomSharedEntity, value, variant )
@@ -0,0 +1,72 @@
+import json
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+# An index of the tool runs stored in an output workspace, so that past results
+# can be reloaded without re-running the tools.  Each workspace directory has a
+# runs.jsonl file with one JSON record per run, appended as runs finish.
+# Records hold the tool, input file, parameters, timing, parsed toolinfo, and
+# the run's output directory, relative to the workspace where possible.
+#
+# The workspace is ATHENA_OUTPUT_DIR, which only outlives the Athena session if
+# the ATHENA_WORKSPACE environment variable is set; batch runs index their own
+# output directory.
+
+RUN_INDEX_NAME = 'runs.jsonl'
+
+def runRecord( toolname, tool_args, result, seconds ):
+    '''The index record for a finished LCBB tool run'''
+    parameters = { k: v for k, v in tool_args.items() if k not in ('p1_output_dir', 'p2_input_file') }
+    return dict( time = datetime.now().isoformat( timespec='seconds' ),
+                 tool = toolname,
+                 input_file = str( Path( tool_args['p2_input_file'] ).resolve() ),
+                 parameters = parameters,
+                 returncode = result.returncode,
+                 cached = getattr( result, 'cached', False ),
+                 seconds = round( seconds, 2 ),
+                 toolinfo = result.toolinfo,
+                 output_dir = str( tool_args['p1_output_dir'] ) )
+
+def recordRun( workspace, record ):
+    '''Append a run record to the workspace's index'''
+    workspace = Path(workspace)
+    output_dir = Path( record['output_dir'] )
+    if output_dir.is_absolute() and workspace.resolve() in output_dir.resolve().parents:
+        record = dict( record, output_dir = str( output_dir.resolve().relative_to( workspace.resolve() ) ) )
+    with open( workspace / RUN_INDEX_NAME, 'a', encoding='utf8' ) as index:
+        index.write( json.dumps( record, default=str ) + '\n' )
+
+def pastRuns( workspace ):
+    '''
+    Records of the successful runs in a workspace whose outputs still exist,
+    oldest first, with output_dir made absolute
+    '''
+    workspace = Path(workspace)
+    index_path = workspace / RUN_INDEX_NAME
+    if not index_path.is_file():
+        return []
+    runs = list()
+    with open( index_path, encoding='utf8' ) as index:
+        for line in index:
+            try:
+                record = json.loads( line )
+            except ValueError:
+                # Skip a record cut short by a crash
+                continue
+            output_dir = workspace / record['output_dir']
+            if record['returncode'] == 0 and output_dir.is_dir():
+                record['output_dir'] = str( output_dir )
+                runs.append( record )
+    return runs
+
+def resultFromRecord( record ):
+    '''A tool result like runLCBBTool's, rebuilt from a run record without running the tool'''
+    output_dir = Path( record['output_dir'] )
+    result = subprocess.CompletedProcess( record['tool'], record['returncode'], '' )
+    result.toolinfo = record['toolinfo']
+    result.cached = True
+    result.bildfiles = list( output_dir.glob('*.bild') )
+    result.cndofile = next( output_dir.glob('*.cndo'), None )
+    result.output_dir = output_dir
+    return result
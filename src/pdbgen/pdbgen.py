@@ -5,7 +5,9 @@ import numpy as np
 import os
 import sys
 import os.path
-from athena import ATHENA_DIR
+import time
+from collections import namedtuple
+from athena import diskcache, ATHENA_DIR, ATHENA_CACHE_DIR
 
 _na_lib_dir = os.path.join( ATHENA_DIR, 'tools', 'na_library')
 
@@ -17,17 +19,30 @@ Contents
 --------
   I. cndo_to_dnainfo
   II. Reference DNA classes (B-DNA)
-  III. writePDBresidue
+    1. readRefResidues
+    2. refResidues
+  III. PDB writing functions
+    1. pdbAtomFields
+    2. pdbNumber
+    3. writePDBresidue
+    4. atomArray
+    5. cifChainId
+    6. writeMMCIF
   IV. Matrix transformation functions
     1. getTransMat
     2. applyTransMat
     3. translate
     4. eultoaxisangle
     5. axisangletoeul
+    6. getFrameTransMats
+    7. applyTransMats
   V. Large number encoding functions
     1. base36encode
     2. hybrid36encode
-  VI. Main pdbgen function
+  VI. Progress reporting and logging
+    1. stdoutProgress
+    2. ProgressReporter
+  VII. Main pdbgen function
 --------
   
 """
@@ -90,11 +105,92 @@ def cndo_to_dnainfo(filename, inputdir):
     return dnaTop, dNode, triad, id_nt
 
 # II. Reference DNA Structures
+#
+# The reference residues are parsed from the na_library PDB files once per
+# process, into arrays of atom names and float coordinates.  The parsed arrays
+# are also cached on disk, keyed by the content hash of each library file, so
+# that later processes (such as batch runs) can skip the parsing entirely.
+# Bump REF_RESIDUE_FORMAT whenever readRefResidues() changes its output.
+
+# Reference residue: atom names, strand and residue ids, and an (N,3) array
+# of coordinates, as read from a na_library PDB file
+RefResidue = namedtuple('RefResidue', 'atoms, strands, resids, crds')
+
+REF_RESIDUE_FORMAT = 1
+REF_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+ref_cache = diskcache.DiskCache(ATHENA_CACHE_DIR / 'pdbgen', REF_CACHE_MAX_BYTES)
+
+# Parsed reference residues by library file, memoized per process
+_ref_residues = {}
+
+# 1. Function to parse a reference PDB file into a RefResidue per residue type
+#    {atomtype, strand, residue, xcoord, ycoord, zcoord} of each atom
+def readRefResidues(pdbfile):
+
+    rows = {}
+    with open(pdbfile) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 9:
+                continue
+            rows.setdefault(fields[3], []).append(fields)
+
+    residues = {}
+    for restype, resrows in rows.items():
+        resrows = np.array([row[:9] for row in resrows])
+        residues[restype] = RefResidue(resrows[:,2], resrows[:,4],
+                                       resrows[:,5], resrows[:,6:9].astype(float))
+    return residues
+
+# 2. Function to return the memoized reference residues of a library file,
+#    from the on-disk cache if possible when use_cache is set.  Cache problems
+#    are never fatal: the library file is simply parsed again.
+def refResidues(pdbfile, use_cache=True):
+
+    if pdbfile in _ref_residues:
+        return _ref_residues[pdbfile]
+
+    key = None
+    residues = None
+    if use_cache:
+        try:
+            key = '{}-v{}'.format(diskcache.hashFile(pdbfile), REF_RESIDUE_FORMAT)
+            entry = ref_cache.get(key)
+            if entry:
+                residues = {}
+                for npzfile in entry.glob('*.npz'):
+                    with np.load(npzfile) as arrays:
+                        residues[npzfile.stem] = RefResidue(
+                            *(arrays[field] for field in RefResidue._fields))
+        except (OSError, ValueError, KeyError) as e:
+            print('Could not read cached reference residues for {}: {}'.format(pdbfile, e))
+            key = None
+            residues = None
+
+    if residues is None:
+        residues = readRefResidues(pdbfile)
+        if key:
+            def populate(entry):
+                for restype, residue in residues.items():
+                    np.savez(entry / (restype + '.npz'), **residue._asdict())
+            try:
+                ref_cache.put(key, populate)
+            except OSError as e:
+                print('Could not cache reference residues for {}: {}'.format(pdbfile, e))
+
+    # The residues are shared by every pdbgen run in this process
+    for residue in residues.values():
+        for array in residue:
+            array.flags.writeable = False
+    _ref_residues[pdbfile] = residues
+    return residues
+
 # Class for reference B-DNA structure 
 
 class BDNA(object):
 
-    def __init__(self):
+    def __init__(self, use_cache=True):
 
         """
         This class will parse the reference B-DNA files and return a 
@@ -103,228 +199,102 @@ class BDNA(object):
 
         Parameters
         ----------
-        none
+        use_cache --> whether to use the on-disk cache of parsed residues
 
         Returns
         -------
         bdna:
             Structure that describes the PDB geometry of a reference 
             B-DNA assembly using the 3DNA convention.
-            Substructures:
-            AAA.scaf = adenine scaffold information
-            AAA.stap = adenine staple information
-            CCC.scaf = cytosine scaffold information
-            CCC.stap = cytosine staple information
-            GGG.scaf = guanine scaffold information
-            GGG.stap = guanine staple information
-            TTT.scaf = thymine scaffold information
-            TTT.stap = thymine staple information
-
-        Will load the reference files AAA.pdb, CCC.pdb, GGG.pdb, and TTT.pdb
-        sequentially to acquire the necessary structural information.
+            Substructures, each a RefResidue:
+            Ascaf, Astap = adenine scaffold and staple information
+            Cscaf, Cstap = cytosine scaffold and staple information
+            Gscaf, Gstap = guanine scaffold and staple information
+            Tscaf, Tstap = thymine scaffold and staple information
+
+        Will load the reference files bdna_ath.pdb, bdna_cgh.pdb, 
+        bdna_gch.pdb, and bdna_tah.pdb to acquire the necessary structural 
+        information.  Each file is only parsed once per process.
         """
 
+        self.use_cache = use_cache
+
         # Run the basepairs
         self.AAA()
         self.CCC()
         self.GGG()
         self.TTT()
 
-    def AAA(self):
+    def refPair(self, libfile, scafres, stapres):
+
+        residues = refResidues(os.path.join(_na_lib_dir, libfile), self.use_cache)
+        return residues[scafres], residues[stapres]
 
-        AAAtemp = np.loadtxt( os.path.join(_na_lib_dir, 'bdna_ath.pdb'), dtype=object)
-
-        AAAlen = len(AAAtemp)
-
-        # Calculate atoms in scaffold and staple strands
-        scafatoms = 0
-        stapatoms = 0
-
-        for i in range(AAAlen):
-            if AAAtemp[i,3] == 'ADE':
-                scafatoms += 1
-            elif AAAtemp[i,3] == 'THY':
-                stapatoms += 1
-
-        # Now transfer important PDB structural information to the refdna.bdna
-        # object.
-
-        # Initialize scaffold and staple structures
-        self.Ascaf = np.zeros((scafatoms, 6), dtype=object)
-        self.Tstap = np.zeros((stapatoms, 6), dtype=object)
-
-        # Now transfer PDB structure line by line
-        ss = 0
-        aa = 0
-        for i in range(AAAlen):
-
-            # {atomtype, strand, residue, xcoord, ycoord, zcoord, atom}
-            if AAAtemp[i,3] == 'ADE':
-                self.Ascaf[ss,0] = AAAtemp[i,2]
-                self.Ascaf[ss,1] = AAAtemp[i,4] 
-                self.Ascaf[ss,2] = AAAtemp[i,5] 
-                self.Ascaf[ss,3] = float(AAAtemp[i,6])
-                self.Ascaf[ss,4] = float(AAAtemp[i,7])
-                self.Ascaf[ss,5] = float(AAAtemp[i,8])
-                ss += 1
-            elif AAAtemp[i,3] == 'THY':
-                self.Tstap[aa,0] = AAAtemp[i,2]
-                self.Tstap[aa,1] = AAAtemp[i,4]
-                self.Tstap[aa,2] = AAAtemp[i,5]
-                self.Tstap[aa,3] = float(AAAtemp[i,6])
-                self.Tstap[aa,4] = float(AAAtemp[i,7])
-                self.Tstap[aa,5] = float(AAAtemp[i,8])
-                aa += 1
+    def AAA(self):
 
+        self.Ascaf, self.Tstap = self.refPair('bdna_ath.pdb', 'ADE', 'THY')
         return self.Ascaf, self.Tstap
-    
-    def CCC(self):
 
-        CCCtemp = np.loadtxt(os.path.join(_na_lib_dir, 'bdna_cgh.pdb'), dtype=object)
-
-        CCClen = len(CCCtemp)
-
-        # Calculate atoms in scaffold and staple strands
-        scafatoms = 0
-        stapatoms = 0
-
-        for i in range(CCClen):
-            if CCCtemp[i,3] == 'CYT':
-                scafatoms += 1
-            elif CCCtemp[i,3] == 'GUA':
-                stapatoms += 1
-
-        # Initialize scaffold and staple structures
-        self.Cscaf = np.zeros((scafatoms, 6), dtype=object)
-        self.Gstap = np.zeros((stapatoms, 6), dtype=object)
-
-        # Now transfer PDB structure line by line
-        ss = 0
-        aa = 0
-
-        # Now transfer important PDB structural information to the refdna.bdna
-        # object.
-
-        # Now transfer PDB structure line by line
-        for i in range(CCClen):
-
-            # {atomtype, strand, residue, xcoord, ycoord, zcoord, atom}
-            if CCCtemp[i,3] == 'CYT':
-                self.Cscaf[ss,0] = CCCtemp[i,2]
-                self.Cscaf[ss,1] = CCCtemp[i,4]
-                self.Cscaf[ss,2] = CCCtemp[i,5]
-                self.Cscaf[ss,3] = float(CCCtemp[i,6])
-                self.Cscaf[ss,4] = float(CCCtemp[i,7])
-                self.Cscaf[ss,5] = float(CCCtemp[i,8])
-                ss += 1
-            elif CCCtemp[i,3] == 'GUA':
-                self.Gstap[aa,0] = CCCtemp[i,2]
-                self.Gstap[aa,1] = CCCtemp[i,4]
-                self.Gstap[aa,2] = CCCtemp[i,5]
-                self.Gstap[aa,3] = float(CCCtemp[i,6])
-                self.Gstap[aa,4] = float(CCCtemp[i,7])
-                self.Gstap[aa,5] = float(CCCtemp[i,8])
-                aa += 1
+    def CCC(self):
 
+        self.Cscaf, self.Gstap = self.refPair('bdna_cgh.pdb', 'CYT', 'GUA')
         return self.Cscaf, self.Gstap
 
     def GGG(self):
 
-        GGGtemp = np.loadtxt(os.path.join(_na_lib_dir, 'bdna_gch.pdb'), dtype=object)
-
-        GGGlen = len(GGGtemp)
-
-        # Calculate atoms in scaffold and staple strands
-        scafatoms = 0
-        stapatoms = 0
-
-        for i in range(GGGlen):
-            if GGGtemp[i,3] == 'GUA':
-                scafatoms += 1
-            elif GGGtemp[i,3] == 'CYT':
-                stapatoms += 1
-
-        # Initialize scaffold and staple structures
-        self.Gscaf = np.zeros((scafatoms, 6), dtype=object)
-        self.Cstap = np.zeros((stapatoms, 6), dtype=object)
-
-        # Now transfer PDB structure line by line
-        ss = 0
-        aa = 0
-
-        for i in range(GGGlen):
-
-            # {atomtype, strand, residue, xcoord, ycoord, zcoord, atom}
-            if GGGtemp[i,3] == 'GUA':
-                self.Gscaf[ss,0] = GGGtemp[i,2]
-                self.Gscaf[ss,1] = GGGtemp[i,4]
-                self.Gscaf[ss,2] = GGGtemp[i,5]
-                self.Gscaf[ss,3] = float(GGGtemp[i,6])
-                self.Gscaf[ss,4] = float(GGGtemp[i,7])
-                self.Gscaf[ss,5] = float(GGGtemp[i,8])
-                ss += 1
-            elif GGGtemp[i,3] == 'CYT':
-                self.Cstap[aa,0] = GGGtemp[i,2]
-                self.Cstap[aa,1] = GGGtemp[i,4]
-                self.Cstap[aa,2] = GGGtemp[i,5]
-                self.Cstap[aa,3] = float(GGGtemp[i,6])
-                self.Cstap[aa,4] = float(GGGtemp[i,7])
-                self.Cstap[aa,5] = float(GGGtemp[i,8])
-                aa += 1
-
+        self.Gscaf, self.Cstap = self.refPair('bdna_gch.pdb', 'GUA', 'CYT')
         return self.Gscaf, self.Cstap
 
     def TTT(self):
 
-        TTTtemp = np.loadtxt(os.path.join(_na_lib_dir, 'bdna_tah.pdb'), dtype=object)
-
-        TTTlen = len(TTTtemp)
-
-        # Calculate atoms in scaffold and staple strands
-        scafatoms = 0
-        stapatoms = 0
-
-        for i in range(TTTlen):
-            if TTTtemp[i,3] == 'THY':
-                scafatoms += 1
-            elif TTTtemp[i,3] == 'ADE':
-                stapatoms += 1
-
-        # Initialize scaffold and staple structures
-        self.Tscaf = np.zeros((scafatoms, 6), dtype=object)
-        self.Astap = np.zeros((stapatoms, 6), dtype=object)
-
-        # Now transfer PDB structure line by line
-        ss = 0
-        aa = 0
-
-        # Now transfer PDB structure line by line
-        for i in range(TTTlen):
-
-            # {atomtype, strand, residue, xcoord, ycoord, zcoord, atom}
-            if TTTtemp[i,3] == 'THY':
-                self.Tscaf[ss,0] = TTTtemp[i,2]
-                self.Tscaf[ss,1] = TTTtemp[i,4]
-                self.Tscaf[ss,2] = TTTtemp[i,5]
-                self.Tscaf[ss,3] = float(TTTtemp[i,6])
-                self.Tscaf[ss,4] = float(TTTtemp[i,7])
-                self.Tscaf[ss,5] = float(TTTtemp[i,8])
-                ss += 1
-            elif TTTtemp[i,3] == 'ADE':
-                self.Astap[aa,0] = TTTtemp[i,2]
-                self.Astap[aa,1] = TTTtemp[i,4]
-                self.Astap[aa,2] = TTTtemp[i,5]
-                self.Astap[aa,3] = float(TTTtemp[i,6])
-                self.Astap[aa,4] = float(TTTtemp[i,7])
-                self.Astap[aa,5] = float(TTTtemp[i,8])
-                aa += 1
-
+        self.Tscaf, self.Astap = self.refPair('bdna_tah.pdb', 'THY', 'ADE')
         return self.Tscaf, self.Astap
 
 
 # III. Functions for writing a PDB file atom-by-atom
 # Requires current chain, resnum, restype
-
+#
+# Each residue is formatted for all three PDB variants in one pass over its
+# atoms, and written to each file as a single block.  The coordinate, atom
+# name, and element columns are shared by all three variants, so they are
+# only formatted once.  Please see official PDB file format documentation for
+# more information www.wwpdb.org/documentation/file-format
+
+# Size of the write buffers for the PDB output files
+PDB_BUFFER_SIZE = 1 << 20
+
+# Atom name (cols 13 - 16) and element symbol (cols 77 - 78) fields by atom
+_pdbAtomFields = {}
+
+# 1. Function to format the atom name and element fields of an atom.
+#    The atom name's alignment depends on the size of its string.
+def pdbAtomFields(atom):
+
+    atom = str(atom)
+    if atom not in _pdbAtomFields:
+        if len(atom) == 1:
+            fields = ' ' + atom + '  ', atom
+        elif len(atom) == 2:
+            fields = ' ' + atom + ' ', atom[0]
+        elif len(atom) == 3:
+            fields = ' ' + atom, atom[0]
+        else:
+            fields = '{0:>4s}'.format(atom[:4]), atom[1]
+        _pdbAtomFields[atom] = (fields[0], '{0:>2s}'.format(fields[1]))
+    return _pdbAtomFields[atom]
+
+# 2. Function to format a serial or residue number field, in hybrid36
+#    notation if it does not fit the field
+def pdbNumber(number, digits):
+
+    if number < 10 ** digits:
+        return '{0:>{1}d}'.format(int(number), digits)
+    return '{0:>{1}s}'.format(str(hybrid36encode(number, digits)), digits)
+
+# 3. Function to write one residue to all three PDB files:
+#    1. Single-model PDB with alphanumeric chains, not built if numchains > 63
+#    2. Multi-model PDB with chains = 'A'
+#    3. Single-model PDB with chains = 'A' and iterative segid
 def writePDBresidue(filename, chain, chainnum, resnum, atomnum, mmatomnum,
                     segatomnum, restype, refatoms, basecrds, numchains, fid,
                     outputdir, fpdb, fmm, fseg):
@@ -334,232 +304,134 @@ def writePDBresidue(filename, chain, chainnum, resnum, atomnum, mmatomnum,
         fid.write('...Error: Base coord data is inconsistent. Aborting...\n')
     else:
         pass
-    
-    # This function will append coordinates to a PDB file residue by residue
-    # 1. Single-model PDB with alphanumeric chains
-
-    # Do not build this model if numchains > 63
-    if numchains <= 63:
 
-        #f = open(outputdir + filename + '.pdb', 'a')
+    numatoms = len(refatoms)
+    restype = '{0:>3s}'.format(str(restype))
+    # Data type: Residue name: Cols 18 - 20, Chain identifier: Col 22 <-- 
+    # Insert extra column 21, Residue sequence number: Cols 23 - 26, then 
+    # four blank spaces
+    pdbres = ' ' + restype + '{0:>2s}'.format(str(chain)) + \
+             pdbNumber(resnum, 4) + '    '
+    # The multi-model and segid variants always use chain 'A'
+    mmres = ' ' + restype + ' A' + pdbNumber(resnum, 4) + '    '
+    # Data type: Occupancy: Cols 55 - 60 (6.2), Temperature factor: 
+    # Cols 61 - 66 (6.2), then blank spaces, a SEGID for the segid variant
+    # (a NAMD hack that allows for a "large" number of segments or chains),
+    # and the Element symbol: Cols 77 - 78
+    pdbocc = '  1.00  0.00          '
+    segocc = '  1.00  0.00      ' + '{0:>4d}'.format(chainnum+1)
+
+    pdblines = []
+    mmlines = []
+    seglines = []
+    for i in range(numatoms):
+        name, element = pdbAtomFields(refatoms[i])
+        # Data type: X, Y, Z coordinates: Cols 31 - 54 (8.3)
+        xyz = '{0:>8.3f}{1:>8.3f}{2:>8.3f}'.format(float(basecrds[i,0]),
+                                                  float(basecrds[i,1]),
+                                                  float(basecrds[i,2]))
+        # Data type: Record Name: Cols 1 - 6, Atom serial number: Cols 7 - 11,
+        # then one blank space
+        if numchains <= 63:
+            pdblines.append('ATOM  ' + pdbNumber(atomnum + i, 5) + ' ' + 
+                            name + pdbres + xyz + pdbocc + element + '  \n')
+        mmlines.append('ATOM  ' + pdbNumber(mmatomnum + i, 5) + ' ' + 
+                       name + mmres + xyz + pdbocc + element + '  \n')
+        seglines.append('ATOM  ' + pdbNumber(segatomnum + i, 5) + ' ' + 
+                        name + mmres + xyz + segocc + element + '  \n')
 
+    if numchains <= 63:
         fid.write('...Chain ' + str(chain) + ', Residue ' + str(resnum) + \
                   ' printing coordinates...\n')
-
-        element = ' '
-        # Please see official PDB file format documentation for more 
-        # information www.wwpdb.org/documentation/file-format
-        #
-        for i in range(len(refatoms)):
-            # Data type: Record Name: Cols 1 - 6
-            fpdb.write('{0:<6s}'.format('ATOM'))
-            # Data type: Atom serial number: Cols 7 - 11
-            if atomnum < 100000:
-                fpdb.write('{0:>5d}'.format(int(atomnum)))
-            else:
-                hybatomnum = hybrid36encode(atomnum,5)
-                fpdb.write('{0:>5s}'.format(str(hybatomnum)))
-                #f.write('*****')
-            fpdb.write(' ') # <-- One blank space
-            # Data type: Atom name: Cols 13 - 16
-            # This one is complicated and depends on size of string
-            if len(str(refatoms[i])) == 1:
-                fpdb.write(' ' + '{0:>1s}'.format(str(refatoms[i])) + '  ')
-                element = str(refatoms[i])
-            elif len(str(refatoms[i])) == 2:
-                fpdb.write(' ' + '{0:>2s}'.format(str(refatoms[i])) + ' ')
-                element = str(refatoms[i])[0]
-            elif len(str(refatoms[i])) == 3:
-                fpdb.write(' ' + '{0:>3s}'.format(str(refatoms[i])))
-                element = str(refatoms[i])[0]
-            elif len(str(refatoms[i])) == 4:
-                fpdb.write('{0:>4s}'.format(str(refatoms[i])))
-                element = str(refatoms[i])[1]
-            # Data type: Alternate location indicator: Col 17 
-            # <-- This is typically empty
-            fpdb.write(' ')
-            # Data type: Residue name: Cols 18 - 20
-            fpdb.write('{0:>3s}'.format(str(restype)))
-            # Data type: Chain identifier: Col 22 <-- Insert extra column 21
-            fpdb.write('{0:>2s}'.format(str(chain)))
-            # Data type: Residue sequence number: Cols 23 - 26
-            if resnum < 10000:
-                fpdb.write('{0:>4d}'.format(int(resnum)))
-            else:
-                hybresnum = hybrid36encode(resnum,4)
-                fpdb.write('{0:>4s}'.format(str(hybresnum)))
-                #f.write('****')
-            fpdb.write('    ') # <-- Four blank spaces
-            # Data type: X coordinates: Cols 31 - 38 (8.3)
-            fpdb.write('{0:>8.3f}'.format(float(basecrds[i,0])))
-            # Data type: Y coordinates: Cols 39 - 46 (8.3)
-            fpdb.write('{0:>8.3f}'.format(float(basecrds[i,1])))
-            # Data type: Z coordinates: Cols 47 - 54 (8.3)
-            fpdb.write('{0:>8.3f}'.format(float(basecrds[i,2])))
-            # Data type: Occupancy: Cols 55 - 60 (6.2)
-            fpdb.write('{0:>6.2f}'.format(float(1.0)))
-            # Data type: Temperature factor: Cols 61 - 66 (6.2)
-            fpdb.write('{0:>6.2f}'.format(float(0.0)))
-            fpdb.write('          ') # <-- Ten blank spaces
-            # Data type: Element symbol: Cols 77 - 78
-            fpdb.write('{0:>2s}'.format(str(element)))
-            # Data type: Charge: Cols 79 - 80 <-- Currently leaving this blank
-            fpdb.write('  \n') # <-- Move to next line
-
-            # Iterate atom number
-            atomnum += 1
-    else:
-        pass
-
-    # 2. Multi-model PDB with chains = 'A'
-    #f = open(outputdir + filename + '-multimodel.pdb', 'a')
+        fpdb.write(''.join(pdblines))
+        atomnum += numatoms
 
     fid.write('...Model ' + str(chainnum + 1) + ', Residue ' + str(resnum) + \
               ' printing coordinates...\n')
-
-    element = ' '
-    # Please see official PDB file format documentation for more information
-    # www.wwpdb.org/documentation/file-format
-    #
-    for i in range(len(refatoms)):
-        # Data type: Record Name: Cols 1 - 6
-        fmm.write('{0:<6s}'.format('ATOM'))
-        # Data type: Atom serial number: Cols 7 - 11
-        if mmatomnum < 100000:
-            fmm.write('{0:>5d}'.format(int(mmatomnum)))
-        else:
-            mmhybatomnum = hybrid36encode(mmatomnum,5)
-            fmm.write('{0:>5s}'.format(str(mmhybatomnum)))
-            #f.write('*****')
-        fmm.write(' ') # <-- One blank space
-        # Data type: Atom name: Cols 13 - 16
-        # This one is complicated and depends on size of string
-        if len(str(refatoms[i])) == 1:
-            fmm.write(' ' + '{0:>1s}'.format(str(refatoms[i])) + '  ')
-            element = str(refatoms[i])
-        elif len(str(refatoms[i])) == 2:
-            fmm.write(' ' + '{0:>2s}'.format(str(refatoms[i])) + ' ')
-            element = str(refatoms[i])[0]
-        elif len(str(refatoms[i])) == 3:
-            fmm.write(' ' + '{0:>3s}'.format(str(refatoms[i])))
-            element = str(refatoms[i])[0]
-        elif len(str(refatoms[i])) == 4:
-            fmm.write('{0:>4s}'.format(str(refatoms[i])))
-            element = str(refatoms[i])[1]
-        # Data type: Alternate location indicator: Col 17 
-        # <-- This is typically empty
-        fmm.write(' ')
-        # Data type: Residue name: Cols 18 - 20
-        fmm.write('{0:>3s}'.format(str(restype)))
-        # Data type: Chain identifier: Col 22 <-- Insert extra column 21
-        # For multi-model PDB, this is always 'A'
-        fmm.write('{0:>2s}'.format(str('A')))
-        # Data type: Residue sequence number: Cols 23 - 26
-        if resnum < 10000:
-            fmm.write('{0:>4d}'.format(int(resnum)))
-        else:
-            hybresnum = hybrid36encode(resnum,4)
-            fmm.write('{0:>4s}'.format(str(hybresnum)))
-            #f.write('****')
-        fmm.write('    ') # <-- Four blank spaces
-        # Data type: X coordinates: Cols 31 - 38 (8.3)
-        fmm.write('{0:>8.3f}'.format(float(basecrds[i,0])))
-        # Data type: Y coordinates: Cols 39 - 46 (8.3)
-        fmm.write('{0:>8.3f}'.format(float(basecrds[i,1])))
-        # Data type: Z coordinates: Cols 47 - 54 (8.3)
-        fmm.write('{0:>8.3f}'.format(float(basecrds[i,2])))
-        # Data type: Occupancy: Cols 55 - 60 (6.2)
-        fmm.write('{0:>6.2f}'.format(float(1.0)))
-        # Data type: Temperature factor: Cols 61 - 66 (6.2)
-        fmm.write('{0:>6.2f}'.format(float(0.0)))
-        fmm.write('          ') # <-- Ten blank spaces
-        # Data type: Element symbol: Cols 77 - 78
-        fmm.write('{0:>2s}'.format(str(element)))
-        # Data type: Charge: Cols 79 - 80 <-- Currently leaving this blank
-        fmm.write('  \n') # <-- Move to next line
-
-        # Iterate atom number
-        mmatomnum += 1
-
-    #fmm.close()
-
-    # 3. Single-model PDB with chains = 'A' and iterative segid
-    #f = open(outputdir + filename + '-chseg.pdb', 'a')
+    fmm.write(''.join(mmlines))
+    mmatomnum += numatoms
 
     fid.write('...Segment ' + str(chainnum + 1) + ', Residue ' + \
               str(resnum) + ' printing coordinates...\n')
-
-    element = ' '
-    # Please see official PDB file format documentation for more information
-    # www.wwpdb.org/documentation/file-format
-    #
-    for i in range(len(refatoms)):
-        # Data type: Record Name: Cols 1 - 6
-        fseg.write('{0:<6s}'.format('ATOM'))
-        # Data type: Atom serial number: Cols 7 - 11
-        if segatomnum < 100000:
-            fseg.write('{0:>5d}'.format(int(segatomnum)))
-        else:
-            hybatomnum = hybrid36encode(segatomnum,5)
-            fseg.write('{0:>5s}'.format(str(hybatomnum)))
-            #f.write('*****')
-        fseg.write(' ') # <-- One blank space
-        # Data type: Atom name: Cols 13 - 16
-        # This one is complicated and depends on size of string
-        if len(str(refatoms[i])) == 1:
-            fseg.write(' ' + '{0:>1s}'.format(str(refatoms[i])) + '  ')
-            element = str(refatoms[i])
-        elif len(str(refatoms[i])) == 2:
-            fseg.write(' ' + '{0:>2s}'.format(str(refatoms[i])) + ' ')
-            element = str(refatoms[i])[0]
-        elif len(str(refatoms[i])) == 3:
-            fseg.write(' ' + '{0:>3s}'.format(str(refatoms[i])))
-            element = str(refatoms[i])[0]
-        elif len(str(refatoms[i])) == 4:
-            fseg.write('{0:>4s}'.format(str(refatoms[i])))
-            element = str(refatoms[i])[1]
-        # Data type: Alternate location indicator: Col 17 
-        # <-- This is typically empty
-        fseg.write(' ')
-        # Data type: Residue name: Cols 18 - 20
-        fseg.write('{0:>3s}'.format(str(restype)))
-        # Data type: Chain identifier: Col 22 <-- Insert extra column 21
-        # Use chain 'A' here
-        fseg.write('{0:>2s}'.format(str('A')))
-        # Data type: Residue sequence number: Cols 23 - 26
-        if resnum < 10000:
-            fseg.write('{0:>4d}'.format(int(resnum)))
-        else:
-            hybresnum = hybrid36encode(atomnum,4)
-            fseg.write('{0:>4s}'.format(str(hybresnum)))
-            #f.write('****')
-        fseg.write('    ') # <-- Four blank spaces
-        # Data type: X coordinates: Cols 31 - 38 (8.3)
-        fseg.write('{0:>8.3f}'.format(float(basecrds[i,0])))
-        # Data type: Y coordinates: Cols 39 - 46 (8.3)
-        fseg.write('{0:>8.3f}'.format(float(basecrds[i,1])))
-        # Data type: Z coordinates: Cols 47 - 54 (8.3)
-        fseg.write('{0:>8.3f}'.format(float(basecrds[i,2])))
-        # Data type: Occupancy: Cols 55 - 60 (6.2)
-        fseg.write('{0:>6.2f}'.format(float(1.0)))
-        # Data type: Temperature factor: Cols 61 - 66 (6.2)
-        fseg.write('{0:>6.2f}'.format(float(0.0)))
-        fseg.write('      ') # <-- Six blank spaces
-        # Write SEGID here <-- This is a NAMD hack that allows for a "large"
-        # number of segments or chains (I've allowed for up to 9999 which is
-        # unreasonably large)
-        fseg.write('{0:>4d}'.format(chainnum+1))
-        # Data type: Element symbol: Cols 77 - 78
-        fseg.write('{0:>2s}'.format(str(element)))
-        # Data type: Charge: Cols 79 - 80 <-- Currently leaving this blank
-        fseg.write('  \n') # <-- Move to next line
-
-        # Iterate atom number
-        segatomnum += 1
-
-    #f.close()
+    fseg.write(''.join(seglines))
+    segatomnum += numatoms
 
     return atomnum, mmatomnum, segatomnum
+
+# The mmCIF and numpy outputs are written at the end of a run, from one array
+# of all the atoms in the structure.  Neither format has the PDB limits on
+# coordinates, serial numbers, or chain counts, and the .npy file can be
+# loaded with numpy.load without parsing any text.
+
+# Fields of the atom array: the chain (numbered from 1, as the PDB models
+# are), residue number within the chain, residue name, atom name, element
+# symbol, and XYZ coordinates
+ATOM_DTYPE = np.dtype([('chain', 'i4'), ('resnum', 'i4'), ('resname', 'S3'),
+                       ('atom', 'S4'), ('element', 'S2'), ('xyz', 'f8', (3,))])
+
+# 4. Function to collect residues into an atom array.  Each residue is a tuple
+#    of (chain, resnum, restype, refatoms, basecrds)
+def atomArray(residues):
+
+    numatoms = sum(len(residue[3]) for residue in residues)
+    atoms = np.zeros(numatoms, dtype=ATOM_DTYPE)
+    start = 0
+    for chain, resnum, restype, refatoms, basecrds in residues:
+        end = start + len(refatoms)
+        atoms['chain'][start:end] = chain
+        atoms['resnum'][start:end] = resnum
+        atoms['resname'][start:end] = str(restype)
+        atoms['atom'][start:end] = [str(atom) for atom in refatoms]
+        atoms['element'][start:end] = [pdbAtomFields(atom)[1].strip()
+                                       for atom in refatoms]
+        atoms['xyz'][start:end] = np.asarray(basecrds, dtype=float)
+        start = end
+
+    return atoms
+
+# 5. Function to name a chain for mmCIF: A-Z, then AA, AB, ... without limit
+def cifChainId(chain):
+
+    chainid = ''
+    while chain > 0:
+        chain, i = divmod(chain - 1, 26)
+        chainid = chr(ord('A') + i) + chainid
+
+    return chainid
+
+# 6. Function to write an atom array as an mmCIF file
+def writeMMCIF(path, name, atoms):
+
+    fields = ['group_PDB', 'id', 'type_symbol', 'label_atom_id',
+              'label_comp_id', 'label_asym_id', 'label_seq_id', 'Cartn_x',
+              'Cartn_y', 'Cartn_z', 'occupancy', 'B_iso_or_equiv',
+              'pdbx_PDB_model_num']
+    chainids = {}
+    atomids = {}
+    with open(path, 'w', PDB_BUFFER_SIZE) as f:
+        f.write('data_' + name + '\n#\nloop_\n')
+        f.write(''.join('_atom_site.' + field + '\n' for field in fields))
+        lines = []
+        for i, (chain, resnum, resname, atom, element, xyz) in enumerate(zip(
+                atoms['chain'].tolist(), atoms['resnum'].tolist(),
+                atoms['resname'].tolist(), atoms['atom'].tolist(),
+                atoms['element'].tolist(), atoms['xyz'].tolist())):
+            if chain not in chainids:
+                chainids[chain] = cifChainId(chain)
+            if atom not in atomids:
+                # Atom names with primes, like O5', must be quoted
+                atomids[atom] = atom.decode()
+                if "'" in atomids[atom]:
+                    atomids[atom] = '"' + atomids[atom] + '"'
+            lines.append('ATOM %d %s %s %s %s %d %.3f %.3f %.3f 1.00 0.00 1\n' %
+                         (i + 1, element.decode(), atomids[atom],
+                          resname.decode(), chainids[chain], resnum,
+                          xyz[0], xyz[1], xyz[2]))
+            if len(lines) >= 100000:
+                f.write(''.join(lines))
+                lines = []
+        f.write(''.join(lines))
+        f.write('#\n')
   
 # IV. Matrix transformation functions 
 
@@ -635,6 +507,39 @@ def axisangletoeul(angle, axis):
 
     return mat
 
+# 6. Function to generate the transformation matrices from the origin to
+#    many base coordinate systems at once.  Equivalent to getTransMat from
+#    xyzorigin to each frame {centroid, centroid + e1, centroid + e2,
+#    centroid + e3}, with the SVD fits batched over all frames, since the
+#    triads from the .cndo file are only approximately orthonormal.
+#    Returns (N,3,3) rotations and (N,3) translations.
+def getFrameTransMats(nodes, triads):
+
+    mob = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]], dtype=float)
+    tar = np.concatenate((nodes[:,np.newaxis,:],
+                          nodes[:,np.newaxis,:] + triads), axis=1)
+
+    mob_com = mob.mean(0)
+    tar_com = tar.mean(1)
+    mob = mob - mob_com
+    tar = tar - tar_com[:,np.newaxis,:]
+    matrix = np.matmul(mob.T, tar)
+
+    U, s, Vh = linalg.svd(matrix)
+    Id = np.tile(np.eye(3), (len(matrix), 1, 1))
+    Id[:,2,2] = np.sign(linalg.det(matrix))
+    rotation = np.matmul(np.swapaxes(Vh, 1, 2),
+                         np.matmul(Id, np.swapaxes(U, 1, 2)))
+
+    return rotation, tar_com - mob_com
+
+# 7. Function to transform one set of coordinates by many transformations,
+#    returning an (N, numatoms, 3) array
+def applyTransMats(rotations, translations, coords):
+
+    return np.einsum('nij,aj->nai', rotations, coords) + \
+           translations[:,np.newaxis,:]
+
 # V. Functions for encoding large numbers
 
 # 1. Function to encode a decimal using base36 notation
@@ -670,9 +575,74 @@ def hybrid36encode(number,digits):
 
     return hyb36str
 
-# VI. Main PDBGen Function Definition
+# VI. Progress reporting and logging
+#
+# Progress is reported through a callback, progress(stage, fraction), which
+# by default draws a progress bar on stdout.  Calls are throttled to whole
+# percent changes and a minimum interval, so that reporting costs next to
+# nothing however many bases there are.
+#
+# The log verbosity sets whether a few lines are logged for every base as
+# well.  For large designs those lines dominate the run time, especially when
+# the log is shown in a window.
+
+# Log the header, input parameters, and errors only
+VERBOSITY_QUIET = 0
+# Also log the strand type and residues printed for every base
+VERBOSITY_BASES = 1
+
+# Minimum interval between progress reports, in seconds
+PROGRESS_INTERVAL = 0.1
+
+# Log for the messages left out at lower verbosity
+class NullLog(object):
+
+    def write(self, text):
+        pass
 
-def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
+    def close(self):
+        pass
+
+# 1. Function to draw a progress bar for a pdbgen stage on stdout
+def stdoutProgress(stage, fraction):
+
+    nn = int(np.ceil(fraction * 20.0))
+    pp = int(np.ceil(fraction * 100.0))
+    sys.stdout.write('\r' + stage + '... [' + '{:<20}'.format('='*nn) + ']' + 
+                     '{:>4}'.format(pp) + '%')
+    sys.stdout.flush()
+
+# 2. Class to throttle the progress reports of a stage over total items
+class ProgressReporter(object):
+
+    def __init__(self, stage, total, callback=stdoutProgress,
+                 interval=PROGRESS_INTERVAL):
+
+        self.stage = stage
+        self.total = max(total, 1)
+        self.callback = callback
+        self.interval = interval
+        self.percent = 0
+        self.time = time.time()
+        if callback:
+            callback(stage, 0.0)
+
+    def update(self, done):
+
+        percent = int(100.0 * done / self.total)
+        if percent == self.percent or not self.callback:
+            return
+        now = time.time()
+        if percent < 100 and now - self.time < self.interval:
+            return
+        self.percent = percent
+        self.time = now
+        self.callback(self.stage, float(done) / self.total)
+
+# VII. Main PDBGen Function Definition
+
+def pdbgen(filename,abtype,natype,inputdir,outputdir,log,formats=('pdb',),
+           verbosity=VERBOSITY_BASES,progress=stdoutProgress):
     
     """
     This function creates PDB files for a data structure input as a .cndo
@@ -685,6 +655,10 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
       natype --> 'DNA' or 'RNA'
       inputdir --> directory with input .cndo file
       outputdir --> directory for .pdb and .log output files
+      formats --> output formats, any of 'pdb' (the three PDB files), 'cif'
+                  (mmCIF), and 'npy' (numpy atom array, see ATOM_DTYPE)
+      verbosity --> VERBOSITY_QUIET or VERBOSITY_BASES, for a line per base
+      progress --> callback(stage, fraction) for progress reports, or None
     
     Returns
     -------
@@ -701,8 +675,13 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
         sys.stdout.write('\nNucleic acid type not currently available. Aborting...\n\n')
         return
     
-    # Use the given file-like logging object
+    # Use the given file-like logging object, and a log for the messages
+    # about every base, if those are wanted
     fid = log
+    if verbosity >= VERBOSITY_BASES:
+        basefid = fid
+    else:
+        basefid = NullLog()
 
     # Initialization block
     fid.write('\n\n')
@@ -736,6 +715,16 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
     dNode = np.asarray(dNode)
     triad = np.asarray(triad)
 
+    # Parse the basepairing ids once, and map each base id to its basepair
+    # index and strand type (scaffold = 1, staple = 2).  Where an id appears
+    # more than once, the first basepair wins, as for a scan of id_nt.
+    ntid1 = np.array([int(bp[1]) for bp in id_nt], dtype=int)
+    ntid2 = np.array([int(bp[2]) for bp in id_nt], dtype=int)
+    basepairofid = {}
+    for j in range(len(id_nt) - 1, -1, -1):
+        basepairofid[int(ntid2[j])] = (j, 2)
+        basepairofid[int(ntid1[j])] = (j, 1)
+
     # 1.1. dnaInfo.dnaTop contains the sequential topology
     # {dnaTop, id, up, down, across, seq}
 
@@ -785,14 +774,21 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
     # Note: unless we shift the center of coordinates {0.0, 0.0, 0.0}, the
     # maximum effective size of the nanoparticle is 
     # {1999.998, 1999.998, 1999.998} Angstroms
-    if minxyz <= float(-1000.0):
-        sys.stdout.write('Minimum XYZ value is too large for ' + 
-                         'PDB generation. Aborting...\n\n')
-        return
-    elif maxxyz >= float(10000.0):
-        sys.stdout.write('Maximum XYZ value is too large for ' + 
-                         'PDB generation. Aborting...\n\n')
-        return
+    # The mmCIF and numpy outputs have no such limit, so are still written
+    writepdb = 'pdb' in formats
+    otherformats = [fmt for fmt in formats if fmt != 'pdb']
+    if minxyz <= float(-1000.0) or maxxyz >= float(10000.0):
+        if minxyz <= float(-1000.0):
+            sys.stdout.write('Minimum XYZ value is too large for ' + 
+                             'PDB generation. ')
+        else:
+            sys.stdout.write('Maximum XYZ value is too large for ' + 
+                             'PDB generation. ')
+        if not otherformats:
+            sys.stdout.write('Aborting...\n\n')
+            return
+        sys.stdout.write('Skipping PDB files...\n\n')
+        writepdb = False
     else:
         pass
 
@@ -823,12 +819,17 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
 
     fid.write('Starting DNA nanostructural routing procedure...\n')
 
-    # Create array for unrouteTemp
+    # Create array for unrouteTemp, and integer columns of its base ids and
+    # up, down, and across pointers, parsed once
     unrouteTemp = np.asarray(dnaTop)
     numbases = len(unrouteTemp[:,0])
-    routeTemp = np.zeros((numbases,5),dtype=object)
-    visited = np.zeros(numbases,dtype=int)
-    routeindex = 0
+    topids = unrouteTemp[:,1].astype(int)
+    topup = unrouteTemp[:,2].astype(int)
+    topdown = unrouteTemp[:,3].astype(int)
+    topacross = unrouteTemp[:,4].astype(int)
+
+    # Index from base id to its row of unrouteTemp
+    rowofid = dict(zip(topids.tolist(), range(numbases)))
 
     sys.stdout.write('There are ' + str(numbases) + 
                      ' total bases in the structure...\n')
@@ -846,114 +847,57 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
         sys.stdout.write('WARNING: Atom IDs greater than 99999 atoms will' +
                          ' be output in hybrid base36 notation\n')
 
-    # Loop through all of the bases
-    sys.stdout.write('\n1. DNA nanostructural routing... [                    ]   0%')
-    for ii in range(numbases):
-        
-        # Print progress bar
-        nn = int(np.ceil((float(ii+1) / float(numbases)) * 20.0))
-        pp = int(np.ceil((float(ii+1) / float(numbases)) * 100.0))
-        sys.stdout.write('\r1. DNA nanostructural routing... [' + 
-                         '{:<20}'.format('='*nn) + ']' + '{:>4}'.format(pp) + 
-                         '%')
-        sys.stdout.flush()
-
-        # Base-pairing info for base
-        base = unrouteTemp[ii,1:]
-        baseid = int(unrouteTemp[ii,1])
-        baseup = int(unrouteTemp[ii,2])
-        basedown = int(unrouteTemp[ii,3])
-        baseacross = int(unrouteTemp[ii,4])
-        baseseq = str(unrouteTemp[ii,5])
-
-        # Check if base is a terminal 5' end and not visited yet
-        if baseup == -1 and visited[ii] == 0:
-            # Append base to route
-            routeTemp[routeindex,:] = base
-            routeindex += 1
-            visited[ii] = 1
-            # Set initial length of strand
-            strlen = 1
-            while basedown != -1:
-                nextbaseid = basedown
-                # Check if next base is correct one
-                # Fails if ii == numbases - 1
-                if ii + strlen < numbases - 1:
-                    tempnextbaseid = int(unrouteTemp[ii+strlen,1])
-                    if nextbaseid == tempnextbaseid:
-                        # Base-pairing info for base
-                        base = unrouteTemp[ii+strlen,1:]
-                        baseid = int(unrouteTemp[ii+strlen,1])
-                        baseup = int(unrouteTemp[ii+strlen,2])
-                        basedown = int(unrouteTemp[ii+strlen,3])
-                        baseacross = int(unrouteTemp[ii+strlen,4])
-                        baseseq = str(unrouteTemp[ii+strlen,5])
-                    else:
-                        # First try unrouteTemp[basedown-1]
-                        tempnextbaseid = int(unrouteTemp[basedown-1,1])
-                        if nextbaseid == tempnextbaseid:
-                            base = unrouteTemp[basedown-1,1:]
-                            baseid = int(unrouteTemp[basedown-1,1])
-                            baseup = int(unrouteTemp[basedown-1,2])
-                            basedown = int(unrouteTemp[basedown-1,3])
-                            baseacross = int(unrouteTemp[basedown-1,4])
-                            baseseq = str(unrouteTemp[basedown-1,5])
-                        else:
-                            # If all else fails!
-                            # Loop through to find next base in sequence
-                            for jj in range(numbases):
-                                # Base-pairing info for base
-                                base = unrouteTemp[jj,1:]
-                                baseid = int(unrouteTemp[jj,1])
-                                baseup = int(unrouteTemp[jj,2])
-                                basedown = int(unrouteTemp[jj,3])
-                                baseacross = int(unrouteTemp[jj,4])
-                                baseseq = str(unrouteTemp[jj,5])
-                                if baseid == nextbaseid:
-                                    break
-                                else:
-                                    continue
-                else:
-                    # Loop through to find next base in sequence
-                    for jj in range(numbases):
-                        # Base-pairing info for base
-                        base = unrouteTemp[jj,1:]
-                        baseid = int(unrouteTemp[jj,1])
-                        baseup = int(unrouteTemp[jj,2])
-                        basedown = int(unrouteTemp[jj,3])
-                        baseacross = int(unrouteTemp[jj,4])
-                        baseseq = str(unrouteTemp[jj,5])
-                        if baseid == nextbaseid:
-                            break
-                        else:
-                            continue
-                routeTemp[routeindex,:] = base
-                routeindex += 1
-                strlen += 1
-            else:
-                # Base is a terminal 3' end
-                # Continue the loop
-                if basedown == -1:
-                    numchains += 1
-                    continue
-                else:
-                    fid.write('...Error in routing info...\n')
-                    break      
+    # Route each strand from its terminal 5' end, taking strands in the order
+    # of their 5' ends in dnaTop, and following down pointers through the
+    # id-to-row index
+    sys.stdout.write('\n')
+    routeprogress = ProgressReporter('1. DNA nanostructural routing', numbases,
+                                     progress)
+    routerows = []
+    for ii in np.flatnonzero(topup == -1).tolist():
+        row = ii
+        routerows.append(row)
+        while topdown[row] != -1:
+            row = rowofid.get(int(topdown[row]))
+            if row is None:
+                fid.write('...Error in routing info...\n')
+                break
+            routerows.append(row)
+        else:
+            # Base is a terminal 3' end
+            numchains += 1
+            
+            # Report progress, once per strand
+            routeprogress.update(len(routerows))
+            continue
+        break
+
+    # Routed base-pairing info: id, up, down, across, and sequence of each base
+    routeTemp = np.zeros((numbases,5),dtype=object)
+    routeTemp[:len(routerows),0] = topids[routerows].tolist()
+    routeTemp[:len(routerows),1] = topup[routerows].tolist()
+    routeTemp[:len(routerows),2] = topdown[routerows].tolist()
+    routeTemp[:len(routerows),3] = topacross[routerows].tolist()
+    routeTemp[:len(routerows),4] = unrouteTemp[routerows,5].tolist()
 
     sys.stdout.write('\n\nThere are ' + str(numchains) + 
                      ' total chains in the structure...\n')
-    if numchains > 63:
+    if numchains > 63 and writepdb:
         sys.stdout.write('WARNING: Skipping standard PDB file generation' +
                          ' due to large (>63) number of chains.\n')
     
     # Open PDB files for appending
-    if numchains <= 63:
-        fpdb = open(outputdir + filename + '.pdb', 'a')
+    if numchains <= 63 and writepdb:
+        fpdb = open(outputdir + filename + '.pdb', 'a', PDB_BUFFER_SIZE)
     else:
         fpdb = ''
         
-    fmm = open(outputdir + filename + '-multimodel.pdb', 'a')
-    fseg = open(outputdir + filename + '-segid.pdb', 'a')
+    if writepdb:
+        fmm = open(outputdir + filename + '-multimodel.pdb', 'a', PDB_BUFFER_SIZE)
+        fseg = open(outputdir + filename + '-segid.pdb', 'a', PDB_BUFFER_SIZE)
+
+    # Residues for the atom array of the mmCIF and numpy outputs
+    residues = []
 
     # Tags for ssDNA
     ssfirst = 0 # ID of first nucleotide in ss region
@@ -964,16 +908,36 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
     # Go through each base in routed structure
     fid.write('\nExtract coordinates for each base in routed structure...\n')
 
-    sys.stdout.write('\n2. PDB generation... [                    ]   0%')
+    # Transform the reference coordinates of every basepaired base to its
+    # base coordinate system up front, in one batch per residue type
+    rotations, translations = getFrameTransMats(
+        dNode[:,1:4].astype(float), triad[:,1:10].astype(float).reshape(-1,3,3))
+    refbases = {}
+    if abtype == 'B' and natype == 'DNA':
+        refbases = {(1, 'A'): bdna.Ascaf, (1, 'C'): bdna.Cscaf,
+                    (1, 'G'): bdna.Gscaf, (1, 'T'): bdna.Tscaf,
+                    (2, 'A'): bdna.Astap, (2, 'C'): bdna.Cstap,
+                    (2, 'G'): bdna.Gstap, (2, 'T'): bdna.Tstap}
+    pairedbases = {}
+    for ii in range(numbases):
+        baseid = int(routeTemp[ii,0])
+        if int(routeTemp[ii,3]) != -1 and baseid in basepairofid:
+            bpid, type = basepairofid[baseid]
+            pairedbases.setdefault((type, str(routeTemp[ii,4])), []).append((ii, bpid))
+    pairedcrds = {}
+    for key, bases in pairedbases.items():
+        if key in refbases:
+            rows, bpids = zip(*bases)
+            bpids = list(bpids)
+            pairedcrds.update(zip(rows, applyTransMats(rotations[bpids],
+                translations[bpids], refbases[key].crds)))
+
+    sys.stdout.write('\n')
+    pdbprogress = ProgressReporter('2. PDB generation', numbases, progress)
     for ii in range(numbases):
 
-        # Print progress bar
-        nn = int(np.ceil((float(ii+1) / float(numbases)) * 20.0))
-        pp = int(np.ceil((float(ii+1) / float(numbases)) * 100.0))
-        sys.stdout.write('\r2. PDB generation... [' + 
-                         '{:<20}'.format('='*nn) + ']' + '{:>4}'.format(pp) + 
-                         '%')
-        sys.stdout.flush()
+        # Report progress
+        pdbprogress.update(ii + 1)
 
         # Get base-pairing info
         base = routeTemp[ii,:]
@@ -988,7 +952,7 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
         type = 0 # scaf = 1, stap = 2, ssdna = 3
         
         # Check if the base is 5'-end
-        if baseup == -1:
+        if baseup == -1 and writepdb:
             # Multi-model PDB starts new model here
             fmm.write('MODEL' + '{0:>9s}'.format(str(chainnum + 1)) + '\n')   
 
@@ -1016,60 +980,25 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
         # First Check if base is unpaired
         if baseacross == -1:
             type = 3
-            fid.write('...Unpaired base...\n')
+            basefid.write('...Unpaired base...\n')
             pass
         else:
             # Otherwise, Extract basepairid
-            for j, bp in enumerate(id_nt):
+            if baseid in basepairofid:
+                bpid, type = basepairofid[baseid]
                 # Scaffold strand
-                if baseid == int(bp[1]):
-                    bpid = int(j)
-                    type = 1
-                    fid.write('...Scaffold strand...\n')
-                    break
+                if type == 1:
+                    basefid.write('...Scaffold strand...\n')
                 # Staple strand
-                elif baseid == int(bp[2]):
-                    bpid = int(j)
-                    type = 2
-                    fid.write('...Staple strand...\n')
-                    break
+                else:
+                    basefid.write('...Staple strand...\n')
 
         #print base, type
 
-        # Only basepaired sequences have coordinates
-        if type == 1 or type == 2:
-            # Extract Centroid of Base
-            xx0, yy0, zz0 = float(dNode[bpid,1]), float(dNode[bpid,2]), \
-                            float(dNode[bpid,3])
-            #print xx0, yy0, zz0
-
-            # Extract Coordinate System of Base
-            xx1, xx2, xx3 = float(triad[bpid,1]), float(triad[bpid,2]), \
-                            float(triad[bpid,3]) # X-axis
-            yy1, yy2, yy3 = float(triad[bpid,4]), float(triad[bpid,5]), \
-                            float(triad[bpid,6]) # Y-axis
-            zz1, zz2, zz3 = float(triad[bpid,7]), float(triad[bpid,8]), \
-                            float(triad[bpid,9]) # Z-axis
-
-            #print xx1, xx2, xx3
-            #print yy1, yy2, yy3
-            #print zz1, zz2, zz3
-
-            # Get transformation matrix for origin to base coordinate system
-
-            xyzorigin = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]])    
-
-            xyzbase = np.array([[xx0, yy0, zz0],
-                                [xx0 + xx1, yy0 + xx2, zz0 + xx3],
-                                [xx0 + yy1, yy0 + yy2, zz0 + yy3],
-                                [xx0 + zz1, yy0 + zz2, zz0 + zz3]])
-
-            #print xyzorigin, xyzbase
-
-            transformMat = getTransMat(xyzorigin, xyzbase)
-
-        # For unpaired sequences, need to calculate the reference frame
-        elif type == 3:
+        # Basepaired sequences were transformed to their base coordinate
+        # systems above.  For unpaired sequences, need to calculate the
+        # reference frame
+        if type == 3:
 
             # Whole ss region will be calculated within this statement
             ssfirst = baseid
@@ -1101,25 +1030,19 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
             #print baseup, basedown
 
             # Print ssDNA characteristics
-            fid.write('  ssDNA region (first: ' + str(ssfirst) + ', last: ' + 
+            basefid.write('  ssDNA region (first: ' + str(ssfirst) + ', last: ' + 
                       str(sslast) + ', length: ' + str(sslength) + ')\n')     
 
             # Extract coordinates of upstream base
-            for j, bp in enumerate(id_nt):
+            if upbase in basepairofid:
+                bpidup, typeup = basepairofid[upbase]
+                basefid.write('...Upstream base ID is ' + str(bpidup) + '...\n')
                 # Scaffold strand
-                if upbase == int(bp[1]):
-                    bpidup = int(j)
-                    fid.write('...Upstream base ID is ' + str(bpidup) + '...\n')
-                    typeup = 1
-                    fid.write('...Upstream base is scaffold strand...\n')
-                    break
+                if typeup == 1:
+                    basefid.write('...Upstream base is scaffold strand...\n')
                 # Staple strand
-                elif upbase == int(bp[2]):
-                    bpidup = int(j)
-                    fid.write('...Upstream base ID is ' + str(bpidup) + '...\n')
-                    typeup = 2
-                    fid.write('...Upstream base is staple strand...\n')
-                    break
+                else:
+                    basefid.write('...Upstream base is staple strand...\n')
 
             # Extract Centroid of Upstream Base
             xx0up, yy0up, zz0up = float(dNode[bpidup,1]), float(dNode[bpidup,2]), \
@@ -1141,21 +1064,15 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
                                  [xx0up + zz1up, yy0up + zz2up, zz0up + zz3up]])
 
             # Extract coordinates of downstream base
-            for j, bp in enumerate(id_nt):
+            if downbase in basepairofid:
+                bpiddo, typedo = basepairofid[downbase]
+                basefid.write('...Downstream base ID is ' + str(bpiddo) + '...\n')
                 # Scaffold strand
-                if downbase == int(bp[1]):
-                    bpiddo = int(j)
-                    fid.write('...Downstream base ID is ' + str(bpiddo) + '...\n')
-                    typedo = 1
-                    fid.write('...Downstream base is scaffold strand...\n')
-                    break
+                if typedo == 1:
+                    basefid.write('...Downstream base is scaffold strand...\n')
                 # Staple strand
-                elif downbase == int(bp[2]):
-                    bpiddo = int(j)
-                    fid.write('...Downstream base ID is ' + str(bpiddo) + '...\n')
-                    typedo = 2
-                    fid.write('...Downstream base is staple strand...\n')
-                    break
+                else:
+                    basefid.write('...Downstream base is staple strand...\n')
 
             # Extract Centroid of Downstream Base
             xx0do, yy0do, zz0do = float(dNode[bpiddo,1]), float(dNode[bpiddo,2]), \
@@ -1276,39 +1193,39 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
                 restype = ''
                 if typeup == 1 and abtype == 'B' and natype == 'DNA': # Scaffold strand
                     if baseseq == 'A':
-                        refcrds = bdna.Ascaf[:,3:6]
-                        refatoms = bdna.Ascaf[:,0]
+                        refcrds = bdna.Ascaf.crds
+                        refatoms = bdna.Ascaf.atoms
                         restype = 'ADE'
                     elif baseseq == 'C':
-                        refcrds = bdna.Cscaf[:,3:6]
-                        refatoms = bdna.Cscaf[:,0]
+                        refcrds = bdna.Cscaf.crds
+                        refatoms = bdna.Cscaf.atoms
                         restype = 'CYT'
                     elif baseseq == 'G':
-                        refcrds = bdna.Gscaf[:,3:6]
-                        refatoms = bdna.Gscaf[:,0]
+                        refcrds = bdna.Gscaf.crds
+                        refatoms = bdna.Gscaf.atoms
                         restype = 'GUA'
                     elif baseseq == 'T':
-                        refcrds = bdna.Tscaf[:,3:6]
-                        refatoms = bdna.Tscaf[:,0]
+                        refcrds = bdna.Tscaf.crds
+                        refatoms = bdna.Tscaf.atoms
                         restype = 'THY'
                     else:
                         fid.write('...Error: No base sequence for scaffold strand...\n')
                 elif typeup == 2 and abtype == 'B' and natype == 'DNA': # Staple strand
                     if baseseq == 'A':
-                        refcrds = bdna.Astap[:,3:6]
-                        refatoms = bdna.Astap[:,0]
+                        refcrds = bdna.Astap.crds
+                        refatoms = bdna.Astap.atoms
                         restype = 'ADE'
                     elif baseseq == 'C':
-                        refcrds = bdna.Cstap[:,3:6]
-                        refatoms = bdna.Cstap[:,0]
+                        refcrds = bdna.Cstap.crds
+                        refatoms = bdna.Cstap.atoms
                         restype = 'CYT'
                     elif baseseq == 'G':
-                        refcrds = bdna.Gstap[:,3:6]
-                        refatoms = bdna.Gstap[:,0]
+                        refcrds = bdna.Gstap.crds
+                        refatoms = bdna.Gstap.atoms
                         restype = 'GUA'
                     elif baseseq == 'T':
-                        refcrds = bdna.Tstap[:,3:6]
-                        refatoms = bdna.Tstap[:,0]
+                        refcrds = bdna.Tstap.crds
+                        refatoms = bdna.Tstap.atoms
                         restype = 'THY'
                     else:
                         fid.write('...Error: No base sequence for staple strand...\n')
@@ -1371,11 +1288,17 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
                 # Write out PDB file sequentially
                 # Pass {filename, chain, residue number, atom number, residue type,
                 # atom types, base coords} to PDB writer
-                atomnum, mmatomnum, segatomnum = writePDBresidue(filename, chlist, 
-                                                 chainnum, resnum, atomnum, 
-                                                 mmatomnum, segatomnum, restype, 
-                                                 refatoms, basecrds, numchains, fid,
-                                                 outputdir, fpdb, fmm, fseg)
+                if writepdb:
+                    atomnum, mmatomnum, segatomnum = writePDBresidue(filename, 
+                                                     chlist, chainnum, resnum, 
+                                                     atomnum, mmatomnum, 
+                                                     segatomnum, restype, 
+                                                     refatoms, basecrds, 
+                                                     numchains, basefid, 
+                                                     outputdir, fpdb, fmm, fseg)
+                if otherformats:
+                    residues.append((chainnum + 1, resnum, restype, refatoms,
+                                     basecrds))
 
                 # Iterate residue indexing
                 resnum += 1
@@ -1386,39 +1309,39 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
         restype = ''
         if type == 1 and abtype == 'B' and natype == 'DNA': # Scaffold strand
             if baseseq == 'A':
-                refcrds = bdna.Ascaf[:,3:6]
-                refatoms = bdna.Ascaf[:,0]
+                refcrds = bdna.Ascaf.crds
+                refatoms = bdna.Ascaf.atoms
                 restype = 'ADE'
             elif baseseq == 'C':
-                refcrds = bdna.Cscaf[:,3:6]
-                refatoms = bdna.Cscaf[:,0]
+                refcrds = bdna.Cscaf.crds
+                refatoms = bdna.Cscaf.atoms
                 restype = 'CYT'
             elif baseseq == 'G':
-                refcrds = bdna.Gscaf[:,3:6]
-                refatoms = bdna.Gscaf[:,0]
+                refcrds = bdna.Gscaf.crds
+                refatoms = bdna.Gscaf.atoms
                 restype = 'GUA'
             elif baseseq == 'T':
-                refcrds = bdna.Tscaf[:,3:6]
-                refatoms = bdna.Tscaf[:,0]
+                refcrds = bdna.Tscaf.crds
+                refatoms = bdna.Tscaf.atoms
                 restype = 'THY'
             else:
                 fid.write('...Error: No base sequence for scaffold strand...\n')
         elif type == 2 and abtype == 'B' and natype == 'DNA': # Staple strand
             if baseseq == 'A':
-                refcrds = bdna.Astap[:,3:6]
-                refatoms = bdna.Astap[:,0]
+                refcrds = bdna.Astap.crds
+                refatoms = bdna.Astap.atoms
                 restype = 'ADE'
             elif baseseq == 'C':
-                refcrds = bdna.Cstap[:,3:6]
-                refatoms = bdna.Cstap[:,0]
+                refcrds = bdna.Cstap.crds
+                refatoms = bdna.Cstap.atoms
                 restype = 'CYT'
             elif baseseq == 'G':
-                refcrds = bdna.Gstap[:,3:6]
-                refatoms = bdna.Gstap[:,0]
+                refcrds = bdna.Gstap.crds
+                refatoms = bdna.Gstap.atoms
                 restype = 'GUA'
             elif baseseq == 'T':
-                refcrds = bdna.Tstap[:,3:6]
-                refatoms = bdna.Tstap[:,0]
+                refcrds = bdna.Tstap.crds
+                refatoms = bdna.Tstap.atoms
                 restype = 'THY'
             else:
                 fid.write('...Error: No base sequence for staple strand...\n')
@@ -1429,31 +1352,35 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
             fid.write('...Error: Base sequence not labelled as scaffold or staple strand...\n')
             continue
 
-        # Now transform reference coordinates to base coordinate system
-        basecrds = applyTransMat(transformMat, refcrds)
+        # Reference coordinates transformed to base coordinate system
+        basecrds = pairedcrds[ii]
 
         # Write out PDB file sequentially
         # Pass {filename, chain, residue number, atom number, residue type, 
         # atom types, base coords} to PDB writer 
-        atomnum, mmatomnum, segatomnum = writePDBresidue(filename, chlist, 
-                                         chainnum, resnum, atomnum, mmatomnum, 
-                                         segatomnum, restype, refatoms, 
-                                         basecrds, numchains, fid, outputdir,
-                                         fpdb, fmm, fseg)
+        if writepdb:
+            atomnum, mmatomnum, segatomnum = writePDBresidue(filename, chlist, 
+                                             chainnum, resnum, atomnum, 
+                                             mmatomnum, segatomnum, restype, 
+                                             refatoms, basecrds, numchains, 
+                                             basefid, outputdir, fpdb, fmm, fseg)
+        if otherformats:
+            residues.append((chainnum + 1, resnum, restype, refatoms, basecrds))
 
         # Iterate residue indexing
         resnum += 1
         if basedown == -1:
           
-            # Standard PDB end chain
-            if numchains <= 63:
-                fpdb.write('TER\n')
-            
-            # Chain segment PDB end chain
-            fseg.write('TER\n')
-            
-            # Multi-model PDB ends model here
-            fmm.write('TER\nENDMDL\n')
+            if writepdb:
+                # Standard PDB end chain
+                if numchains <= 63:
+                    fpdb.write('TER\n')
+                
+                # Chain segment PDB end chain
+                fseg.write('TER\n')
+                
+                # Multi-model PDB ends model here
+                fmm.write('TER\nENDMDL\n')
             
             # Iterate chainnum and return mmatomnum to 1
             chainnum += 1
@@ -1473,20 +1400,32 @@ def pdbgen(filename,abtype,natype,inputdir,outputdir,log):
     # Finalization of script
     fid.write('\n  PDB Generation Successful!  \n\n')
     sys.stdout.write('\n\nPDB Generation Successful!\n')
-    if numchains <= 63:
+    if numchains <= 63 and writepdb:
         sys.stdout.write('Standard PDB file is output as ' + filename + '.pdb\n')
         sys.stdout.write('    This file can be opened in any visualizer...\n')
-    sys.stdout.write('Multimodel PDB file is output as ' + filename + '-multimodel.pdb\n')
-    sys.stdout.write('    This file can be opened in UCSD Chimera...\n')
-    sys.stdout.write('Chain segment PDB file is output as ' + filename + '-chseg.pdb\n')
-    sys.stdout.write('    This file can be opened in VMD...\n')
+    if writepdb:
+        sys.stdout.write('Multimodel PDB file is output as ' + filename + '-multimodel.pdb\n')
+        sys.stdout.write('    This file can be opened in UCSD Chimera...\n')
+        sys.stdout.write('Chain segment PDB file is output as ' + filename + '-chseg.pdb\n')
+        sys.stdout.write('    This file can be opened in VMD...\n')
+
+    # Write the mmCIF and numpy outputs from one array of all atoms
+    if otherformats:
+        atoms = atomArray(residues)
+    if 'cif' in formats:
+        writeMMCIF(outputdir + filename + '.cif', filename, atoms)
+        sys.stdout.write('mmCIF file is output as ' + filename + '.cif\n')
+    if 'npy' in formats:
+        np.save(outputdir + filename + '-atoms.npy', atoms)
+        sys.stdout.write('Numpy atom array is output as ' + filename + '-atoms.npy\n')
     sys.stdout.write('Happy PDB viewing!\n\n')
     
     # Close any open files
-    if numchains <= 63:
+    if numchains <= 63 and writepdb:
         fpdb.close()
-    fmm.close()
-    fseg.close()
+    if writepdb:
+        fmm.close()
+        fseg.close()
     fid.close()
     
     return
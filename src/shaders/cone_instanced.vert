@@ -0,0 +1,113 @@
+#version 330 core
+
+// Instanced variant of the cone imposter.  Each instance is one cone, and the
+// instanced mesh is a 14-vertex triangle strip visiting the corners of a box;
+// this shader places those corners around the cone, as cone_imposter.geom
+// does for Lines input.  Draws with cone_imposter.frag.
+
+// Box corner of this vertex, as (right, up, out) flags
+in vec3 boxCorner;
+
+// Per-instance attributes; radius is that of the cone's base
+in vec3 instanceBase;
+in vec3 instanceEnd;
+in float radius;
+in uint instanceColor;
+
+out CylinderPoint {
+    vec3 surface_point;
+    vec3 axis;
+    vec3 base;
+    vec3 end_cyl;
+    vec3 U;
+    vec3 V;
+    float H;
+    float radius;
+    float cap;
+    float inv_sqr_height;
+    vec4 color;
+} vs_out;
+
+uniform mat4 projectionMatrix;
+uniform mat4 modelView;
+uniform mat3 modelViewNormal;
+
+#ifdef PALETTE_SIZE
+// Colors are slots of the decoration palette
+uniform vec4 palette[PALETTE_SIZE];
+
+vec4 unpackColor( uint c ){
+    return palette[c];
+}
+#else
+// Colors are packed RGBA8, with red in the lowest byte
+vec4 unpackColor( uint c ){
+    return vec4( uvec4( c, c >> 8, c >> 16, c >> 24 ) & 0xffu ) / 255.0;
+}
+#endif
+
+void main(){
+
+    vec3 attr_axis = instanceEnd - instanceBase;
+
+    vs_out.color = unpackColor( instanceColor );
+    vs_out.cap = 1;
+
+    // calculate reciprocal of squared height
+    vs_out.inv_sqr_height = 1.0 / dot(attr_axis, attr_axis);
+
+    // h is a normalized cylinder axis
+    vec3 h = normalize(attr_axis);
+    // axis is the cylinder axis in modelview coordinates
+    vs_out.axis = normalize(modelViewNormal * h);
+    // u, v, h is local system of coordinates
+    vec3 u = cross(h, vec3(1.0, 0.0, 0.0));
+    if (dot(u,u) < 0.001) 
+      u = cross(h, vec3(0.0, 1.0, 0.0));
+    u = normalize(u);
+    vec3 v = normalize(cross(u, h));
+
+    // transform to modelview coordinates
+    vs_out.U = normalize(modelViewNormal * u);
+    vs_out.V = normalize(modelViewNormal * v);
+    vs_out.radius = length( modelViewNormal * (v * radius ) );
+
+    vec4 base4 = modelView * vec4(instanceBase, 1.0);
+    vs_out.base = base4.xyz;
+    vec4 end4 = modelView * vec4(instanceEnd, 1.0);
+    vs_out.end_cyl = end4.xyz;
+
+    float right_v = boxCorner.x;
+    float up_v = boxCorner.y;
+    float out_v = boxCorner.z;
+    vs_out.H = 1.0 - up_v;
+
+    vec4 vertex = vec4(instanceBase, 1.0);
+    vertex.xyz += up_v * attr_axis;
+    vertex.xyz += (2.0 * right_v - 1.0) * radius * u;
+    vertex.xyz += (2.0 * out_v - 1.0) * radius * v;
+    vertex.xyz += (2.0 * up_v - 1.0) * radius * h;
+
+    vec4 tvertex = modelView * vertex;
+    vs_out.surface_point = tvertex.xyz;
+
+    gl_Position = projectionMatrix * tvertex;
+
+    // clamp z on front clipping plane if impostor box would be clipped.
+    // (we ultimatly want to clip on the calculated depth in the fragment
+    // shader, not the depth of the box face)
+    if (gl_Position.z / gl_Position.w < -1.0) {
+        // upper bound of possible cylinder z extend
+        float diff = abs(base4.z - end4.z) + radius * 3.5;
+
+        // z-`diff`-offsetted vertex
+        vec4 inset = tvertex;
+        inset.z -= diff;
+        inset = projectionMatrix * inset;
+
+        // if offsetted vertex is within front clipping plane, then clamp
+        if (inset.z / inset.w > -1.0) {
+            gl_Position.z = -gl_Position.w;
+        }
+    }
+}
@@ -4,7 +4,16 @@
 
 in vec3 vertexPosition;
 in float radius;
+#ifdef PALETTE_SIZE
+// Color as a slot of the decoration palette
+in uint paletteIndex;
+uniform vec4 palette[PALETTE_SIZE];
+#elif defined(COMPACT_VERTICES)
+// Color packed as RGBA8, with red in the lowest byte
+in uint vertexColor;
+#else
 in vec4 vertexColor;
+#endif
 
 out EyeSpaceVertex {
     vec3 vertex;
@@ -21,6 +30,12 @@ void main()
 
     vs_out.vertex = vertexPosition;
     vs_out.radius = radius;
+#ifdef PALETTE_SIZE
+    vs_out.color = palette[paletteIndex];
+#elif defined(COMPACT_VERTICES)
+    vs_out.color = vec4( uvec4( vertexColor, vertexColor >> 8, vertexColor >> 16, vertexColor >> 24 ) & 0xffu ) / 255.0;
+#else
     vs_out.color = vertexColor;
+#endif
     gl_Position = modelView * vec4( vertexPosition, 1.0 );
 }